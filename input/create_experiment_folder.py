@@ -3,11 +3,14 @@
 # Then copy the files from the main directories to the new directories based on the indices
 # A new gridlist_cities_idx.csv file is created with the indices of the grid cells
 # This file can identify the outputs of the model with the location of the cities
-# The input files are copied to the new directories based on the indices
+# The input files are hard linked (or copied, if linking is not possible) to the new directories based on the indices
+# Derived exports (e.g. RClimdex text files) can be written in the same pass (see extract_experiment)
 
-from typing import Union, List, Dict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Optional, Tuple, Union, List, Dict
 from pathlib import Path
 import csv
+import os
 import shutil
 import sys
 import uuid
@@ -16,7 +19,9 @@ import uuid
 sys.path.append('../src')
 
 from _geos import find_indices # type: ignore
-from caete import str_or_path  # type: ignore
+from caete import str_or_path, read_bz2_file  # type: ignore
+
+metadata_filename = "ISIMIP_HISTORICAL_METADATA.pbz2"
 
 
 def get_location_data(filename: Union[Path, str]) -> List[Dict[str, Union[float, str]]]:
@@ -63,11 +68,76 @@ def get_indices(filename: Union[Path, str] = './gridlist_cities.csv') -> None:
     return idx
 
 
-def create_experiment_input2(
+def get_gridcells(locations: List[Dict[str, Union[float, str]]]) -> Dict[Tuple[int, int], List[str]]:
+    """Maps the (y, x) indices of each gridcell to the names of the locations inside it"""
+    cells: Dict[Tuple[int, int], List[str]] = {}
+    for loc in locations:
+        y, x = find_indices(loc['lat'], loc['lon'])
+        cells.setdefault((int(y), int(x)), []).append(str(loc['name']))
+    return cells
+
+
+def link_or_copy(src: Path, dest: Path, link: bool = True) -> None:
+    """Hard link src to dest. Copy the file if linking is not possible (e.g. different file systems)"""
+    if dest.exists():
+        if link and dest.samefile(src):
+            return None
+        dest.unlink()
+    if link:
+        try:
+            os.link(src, dest)
+            return None
+        except OSError:
+            pass
+    shutil.copy2(src, dest)
+
+
+# Exporter: called with the input data of a gridcell (dict), the location names in the gridcell,
+# the source folder and the content of the metadata file of the source folder
+Exporter = Callable[[Dict, List[str], Path, tuple], None]
+
+
+def _extract_folder(src: Path, dest: Path, cells: Dict[Tuple[int, int], List[str]],
+                    link: bool, exporters: List[Exporter]) -> Tuple[Path, int]:
+    """Extract the gridcells of one source folder. Each gridcell file is read at most once"""
+    dest.mkdir(exist_ok=True, parents=True)
+    link_or_copy(src / metadata_filename, dest / metadata_filename, link)
+    metadata = read_bz2_file(src / metadata_filename) if exporters else None
+    for (y, x), names in cells.items():
+        file_name = f"input_data_{y}-{x}.pbz2"
+        link_or_copy(src / file_name, dest / file_name, link)
+        if exporters:
+            data = read_bz2_file(src / file_name)
+            for exporter in exporters:
+                exporter(data, names, src, metadata)
+    return dest, len(cells)
+
+
+def extract_experiment(
     filename: Union[Path, str] = './gridlist_cities.csv',
-    src_folders: List[Union[Path, str]] = None,
-    dest_folders: List[Union[Path, str]] = None
-) -> None:
+    src_folders: Optional[List[Union[Path, str]]] = None,
+    dest_folders: Optional[List[Union[Path, str]]] = None,
+    exporters: Optional[List[Exporter]] = None,
+    link: bool = True,
+    nprocs: Optional[int] = None
+) -> Dict[Tuple[int, int], List[str]]:
+    """Extract the gridcells of a gridlist from several source folders (scenarios) in one parallel pass.
+
+    The gridlist is read once. The input files (and the metadata file) are hard linked to the
+    destination folders, or copied if linking is not possible. Exporters (e.g. rclimdex_exporter)
+    receive the data of each extracted gridcell, so derived files are written in the same pass.
+
+    Args:
+        filename (Union[Path, str], optional): gridlist file (lon, lat and name columns). Defaults to './gridlist_cities.csv'.
+        src_folders (List[Union[Path, str]]): source folders
+        dest_folders (List[Union[Path, str]]): destination folders, in the same order as src_folders
+        exporters (Optional[List[Exporter]], optional): callables (must be picklable). Defaults to None.
+        link (bool, optional): hard link the files instead of copying. Defaults to True.
+        nprocs (Optional[int], optional): number of processes (one folder per task). Defaults to None (number of CPUs).
+
+    Returns:
+        Dict[Tuple[int, int], List[str]]: (y, x) of the extracted gridcells -> location names
+    """
     if src_folders is None or dest_folders is None:
         raise ValueError("Source and destination folders must be provided")
 
@@ -75,34 +145,56 @@ def create_experiment_input2(
         raise ValueError("Source and destination folders lists must have the same length")
 
     # check if all the folders exist
-    for src, dest in zip(src_folders, dest_folders):
-        src_path = Path(src)
-        dest_path = Path(dest)
-        if not src_path.exists():
+    for src in src_folders:
+        if not Path(src).exists():
             raise FileNotFoundError(f"Source folder {src} does not exist")
-        if not dest_path.exists():
-            dest_path.mkdir(exist_ok=True, parents=True)
 
-    idx = get_indices(filename)
+    cells = get_gridcells(get_location_data(filename))
+    exporters = exporters or []
 
-    # Ensure destination directories exist
-    for dest in dest_folders:
-        dest_path = Path(dest)
-        dest_path.mkdir(exist_ok=True, parents=True)
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        futures = [executor.submit(_extract_folder, Path(src), Path(dest), cells, link, exporters)
+                   for src, dest in zip(src_folders, dest_folders)]
+        for future in as_completed(futures):
+            dest, n = future.result()
+            print(f"{dest}: {n} gridcells")
+    return cells
 
-    # Based on index, find the required files and copy them
-    for indices in idx:
-        y, x = indices
-        file_name = Path(f"input_data_{y}-{x}.pbz2")
-        metadata_file = Path(f"ISIMIP_HISTORICAL_METADATA.pbz2")
 
-        for src, dest in zip(src_folders, dest_folders):
-            src_path = Path(src) / file_name
-            src_path_metadata = Path(src) / metadata_file
-            dest_path = Path(dest) / file_name
-            dest_path_metadata = Path(dest) / metadata_file
-            shutil.copy(src_path, dest_path)
-            shutil.copy(src_path_metadata, dest_path_metadata)
+def create_experiment_input2(
+    filename: Union[Path, str] = './gridlist_cities.csv',
+    src_folders: List[Union[Path, str]] = None,
+    dest_folders: List[Union[Path, str]] = None
+) -> None:
+    extract_experiment(filename, src_folders, dest_folders)
+
+
+class rclimdex_exporter:
+    """Exporter that writes RClimdex text files (see prepDataForRClimdex.py) for each location"""
+
+    def __init__(self, scenarios: Dict[Union[Path, str], Tuple[str, str]],
+                 output_path: Union[Path, str] = "./rclimdex/") -> None:
+        """
+        Args:
+            scenarios (Dict[Union[Path, str], Tuple[str, str]]): source folder -> (model, scenario).
+            Gridcells from other folders are not exported.
+            output_path (Union[Path, str], optional): output folder. Defaults to "./rclimdex/".
+        """
+        self.scenarios = {Path(k).resolve(): v for k, v in scenarios.items()}
+        self.output_path = Path(output_path)
+        self._dates: Dict[Path, object] = {}
+
+
+    def __call__(self, data: Dict, names: List[str], src: Path, metadata: tuple) -> None:
+        from prepDataForRClimdex import dateIndex, writeRClimdex
+        src = Path(src).resolve()
+        if src not in self.scenarios:
+            return None
+        model, scen = self.scenarios[src]
+        if src not in self._dates:
+            self._dates[src] = dateIndex(metadata)
+        for name in names:
+            writeRClimdex(data, self._dates[src], name, model, scen, self.output_path)
 
 
 if __name__ == '__main__':
@@ -150,10 +242,17 @@ if __name__ == '__main__':
     ]
 
 
-    create_experiment_input2(
+    # RClimdex files of the MPI-ESM1-2-HR scenarios are written in the same pass
+    # rclimdex = rclimdex_exporter({'./MPI-ESM1-2-HR/historical': ('MPI-ESM1-2-HR', 'historical'),
+    #                               './MPI-ESM1-2-HR/ssp370': ('MPI-ESM1-2-HR', 'ssp370'),
+    #                               './MPI-ESM1-2-HR/ssp585': ('MPI-ESM1-2-HR', 'ssp585')})
+    exporters = []
+
+    extract_experiment(
         filename=_gridlist,
         src_folders=src_folders,
-        dest_folders=dest_folders
+        dest_folders=dest_folders,
+        exporters=exporters
     )
     # Create a new file (gridlist) with the two extra columns with indices of the grid cells
     if write_gridlist_with_indices:
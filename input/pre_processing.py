@@ -6,12 +6,14 @@ import concurrent.futures
 import os
 import sys
 import pickle as pkl
+import shutil
+import tempfile
+import time
 import tomllib
 
 from netCDF4 import Dataset, MFDataset # type: ignore
-from numba import njit
 from numpy.typing import NDArray
-from typing import Generator
+from typing import Generator, Tuple
 
 import numpy as np
 
@@ -71,6 +73,11 @@ parser.add_argument('--mode', type=str, default="spinclim", help='Mode of the da
 parser.add_argument('--mask-file', type=str, default="./mask/mask_raisg-360-720.npy",
                         help="Path to the mask file (default: ./mask/mask_raisg-360-720.npy)")
 parser.add_argument('--test', action='store_true', help="Run a test to check if the data was correctly processed")
+parser.add_argument('--block-size', type=int, default=365,
+                        help="Minimum number of time steps read from the netCDF files in each read. "
+                             "Rounded up to a multiple of the netCDF chunk size (default: 365)")
+parser.add_argument('--nprocs', type=int, default=os.cpu_count(),
+                        help="Number of processes reading the netCDF files and writing the gridcell files (default: number of CPUs)")
 
 
 header = """CAETE-Copyright 2017- LabTerra
@@ -81,43 +88,42 @@ header = """CAETE-Copyright 2017- LabTerra
 
             Pre-processing tool for input data preparation"""
 
-with open("./pre_processing.toml", 'rb') as f:
-    # Works only with python 3.11 and above
-    config_data = tomllib.load(f)
+# OUTPUT FILE WITH METADATA
+metadata_filename_str = "ISIMIP_HISTORICAL_METADATA.pbz2"
 
-# Parse the arguments
-args = parser.parse_args()
 
-# Set the global variables
-dataset = args.dataset
-mode = args.mode
+def load_config(fpath="./pre_processing.toml"):
+    with open(fpath, 'rb') as f:
+        # Works only with python 3.11 and above
+        return tomllib.load(f)
 
-# OUTPUT FILE WITH METADATA
-metadata_filename_str = "ISIMIP_HISTORICAL_METADATA.pbz2"
 
-# NerCDF files with raw data to be processed
-raw_data = Path(f"{dataset}/{mode}_raw")
-assert raw_data.exists(), "Raw data folder does not exists"
-
-# INPUT FILES WITH SOIL DATA (NUTRIENTS)
-soil_data = Path(config_data["soil_nutrients_data"])
-assert soil_data.exists(), "Soil data folder does not exists"
-
-# Load mask
-mask_file = Path(args.mask_file)
-assert mask_file.exists(), "Mask file does not exists"
-mask = np.load(mask_file)
-
-# dump folder. CAETE input files are stored here
-shared_data = Path(f"{dataset}/{mode}")
-os.makedirs(shared_data, exist_ok=True)
-assert shared_data.exists(), "Shared data folder does not exists"
-
-# if there are files in the shared_data folder, remove them
-if args.test:
-    # We dont want to remove the files if we are testing
-    pass
-else:
+def setup_folders(dataset, mode, soil_folder):
+    """Check the input folders and create the output folder.
+    Returns the raw data, soil data and shared data folders"""
+    # NerCDF files with raw data to be processed
+    raw_data = Path(f"{dataset}/{mode}_raw")
+    assert raw_data.exists(), "Raw data folder does not exists"
+
+    # INPUT FILES WITH SOIL DATA (NUTRIENTS)
+    soil_data = Path(soil_folder)
+    assert soil_data.exists(), "Soil data folder does not exists"
+
+    # dump folder. CAETE input files are stored here
+    shared_data = Path(f"{dataset}/{mode}")
+    os.makedirs(shared_data, exist_ok=True)
+    assert shared_data.exists(), "Shared data folder does not exists"
+    return raw_data, soil_data, shared_data
+
+
+def load_mask(mask_file):
+    mask_file = Path(mask_file)
+    assert mask_file.exists(), "Mask file does not exists"
+    return np.load(mask_file)
+
+
+def clean_shared_data(shared_data):
+    """Remove the files of a previous run from the shared_data folder"""
     try:
         for file in shared_data.glob("*"):
             os.remove(file)
@@ -175,17 +181,14 @@ def print_progress(iteration, total, prefix='', suffix='', decimals=2, bar_lengt
     sys.stdout.flush()
 
 
-@njit
-def get_values_at(array, mask=mask):
-    size = np.logical_not(mask).sum()
-    out = np.zeros(size, dtype=np.float32)
-    n = 0
-    for Y in range(360):
-        for X in range(720):
-            if not mask[Y][X]:
-                out[n] = array[Y, X]
-                n += 1
-    return out
+def get_values_at(array, mask_idx):
+    """Get the values of the gridcells in the mask
+
+    array: (360, 720) or a block of time steps (time, 360, 720)
+    Returns an array with shape (ngrid,) or (ngrid, time)"""
+    array = np.ma.getdata(array)
+    flat = array.reshape(array.shape[:-2] + (-1,))
+    return flat[..., mask_idx].T.astype(np.float32)
 
 
 class ds_metadata:
@@ -301,7 +304,7 @@ class input_data:
             self._clean_memory()
 
 
-def read_clim_data(var:str) -> MFDataset | Dataset:
+def get_clim_files(var:str, raw_data:Path) -> list:
     try:
         files = raw_data.glob(f"*_{var}_*")
     except:
@@ -311,8 +314,13 @@ def read_clim_data(var:str) -> MFDataset | Dataset:
 
     if len(files_list) == 0:
         raise FileNotFoundError(f"No netCDF file for variable {var} in {raw_data}")
+    return files_list
+
+
+def read_clim_data(var:str, raw_data:Path) -> MFDataset | Dataset:
+    files_list = get_clim_files(var, raw_data)
 
-    elif len(files_list) == 1:
+    if len(files_list) == 1:
         reader = Dataset
         to_read = files_list[0]
 
@@ -333,18 +341,32 @@ def get_dataset_size(dataset:MFDataset | Dataset) -> int:
     return out
 
 
-def _read_clim_data_(var:str) -> Generator[NDArray, None, None]:
-    with read_clim_data(var) as dataset:
+def get_block_size(files:list, var:str, block_size:int) -> int:
+    """Round the block size up to a multiple of the chunk size (time axis) of the variable.
+    MFDataset variables do not expose the chunking, thus it is read from the first file"""
+    with Dataset(files[0]) as dataset:
+        chunking = dataset.variables[var].chunking()
+    if chunking == "contiguous" or chunking is None:
+        return block_size
+    chunk_time = int(chunking[0])
+    return -(-block_size // chunk_time) * chunk_time
+
+
+def _read_clim_data_(var:str, raw_data:Path, block_size:int=365) -> Generator[Tuple[int, NDArray], None, None]:
+    """Read blocks of time steps. Yields the first time step of the block and the block (time, lat, lon)"""
+    with read_clim_data(var, raw_data) as dataset:
         try:
             zero_dim = get_dataset_size(dataset)
         except:
             raise ValueError("Cannot get dataset size")
 
-        for i in range(zero_dim):
-            yield dataset.variables[var][i, :, :].data
+        block_size = get_block_size(get_clim_files(var, raw_data), var, block_size)
+        for t0 in range(0, zero_dim, block_size):
+            t1 = min(t0 + block_size, zero_dim)
+            yield t0, dataset.variables[var][t0:t1, :, :]
 
 
-def read_soil_data(var):
+def read_soil_data(var, soil_data, config_data):
     if var == 'tn':
         return np.load(os.path.join(soil_data, Path(config_data["tn_file"])))
     elif var == 'tp':
@@ -359,10 +381,38 @@ def read_soil_data(var):
         raise ValueError("Variable not found")
 
 
-def process_gridcell(grd:input_data , var, data):
-    grd.load()
-    grd._load_dict(var, data)
-    grd.write()
+def open_buffer(fpath, shape, mode="r"):
+    """Open the (ngrid, tsize) float32 buffer of a climate variable"""
+    return np.memmap(fpath, dtype=np.float32, mode=mode, shape=shape)
+
+
+def read_variable(var, raw_data, mask_idx, buffer_path, shape, block_size):
+    """Read a climate variable into its buffer. Runs in a separate process.
+    Returns the variable name, the number of bytes read and the elapsed time"""
+    start = time.perf_counter()
+    nbytes = 0
+    buffer = open_buffer(buffer_path, shape, mode="r+")
+    for t0, block in _read_clim_data_(var, raw_data, block_size):
+        buffer[:, t0:t0 + block.shape[0]] = get_values_at(block, mask_idx)
+        nbytes += block.nbytes
+    buffer.flush()
+    del buffer
+    return var, nbytes, time.perf_counter() - start
+
+
+def write_gridcells(dpath, g0, yx, soil_records, buffers, shape):
+    """Write the complete input data (soil and climate) of a block of gridcells.
+    Each gridcell file is written once. Climate data is read from the variable buffers"""
+    g1 = g0 + len(yx)
+    clim = {var: np.array(open_buffer(fpath, shape)[g0:g1]) for var, fpath in buffers.items()}
+    for i, ((y, x), soil_record) in enumerate(zip(yx, soil_records)):
+        grd = input_data(y, x, dpath)
+        for var in buffers:
+            grd._load_dict(var, clim[var][i])
+        for var, data in soil_record.items():
+            grd._load_dict(var, data)
+        grd.write()
+    return len(yx)
 
 
 # def process_data(j, hurs, tas, pr, ps, rsds, sfcwind):
@@ -378,14 +428,14 @@ def process_gridcell(grd:input_data , var, data):
 
 
 @timer
-def main():
+def main(raw_data, soil_data, shared_data, mask, config_data, block_size=365, nprocs=None):
     # SAVE METADATA
     variables = ['hurs', 'tas', 'pr', 'ps', 'rsds', 'sfcwind']
 
     #TODO: add indices and time metadata to each gridcell file
     # Lets get rid of the metdata file
     # Add also dataset name and mode to the gridcell file
-    dss = [read_clim_data(var) for var in variables]
+    dss = [read_clim_data(var, raw_data) for var in variables]
     ancillary_data = ds_metadata(dss)
     ancillary_data.fill_metadata(dss[0])
     ancillary_data.write(shared_data / metadata_filename_str)
@@ -394,115 +444,69 @@ def main():
         ds.close()
     del dss
 
-    input_templates = []
-    ngrid = 0
-    for Y in range(360):
-        for X in range(720):
-            if not mask[Y][X]:
-                ngrid += 1
-                input_templates.append(input_data(Y, X, shared_data))
-    input_templates = np.array(input_templates, dtype=object)
+    # Flat (row major) index of the gridcells in the mask. Same order as the gridcell files
+    mask_idx = np.flatnonzero(np.logical_not(mask))
+    grid_y, grid_x = np.unravel_index(mask_idx, mask.shape)
+    ngrid = mask_idx.size
 
     # Read Soil data
-    tn = read_soil_data('tn') # Total Nitrogen
-    tp = read_soil_data('tp') # Total Phosphorus
-    ap = read_soil_data('ap') # Available Phosphorus
-    ip = read_soil_data('ip') # Inorganic Phosphorus
-    op = read_soil_data('op') # Organic Phosphorus
-
-    # Load soil data
-    for grd in input_templates:
-        print(f"Processing soil data for gridcell {grd.y}-{grd.x}{' ' * 20}", end="\r")
-        total_nitrogen = tn[grd.y, grd.x].copy(order="F")
-        total_phosphorus = tp[grd.y, grd.x].copy(order="F")
-        available_phosphorus = ap[grd.y, grd.x].copy(order="F")
-        inorganic_phosphorus = ip[grd.y, grd.x].copy(order="F")
-        organic_phosphorus = op[grd.y, grd.x].copy(order="F")
-
-        assert total_nitrogen >= 0, "Total Nitrogen must be positive"
-        assert total_phosphorus >= 0, "Total Phosphorus must be positive"
-        assert available_phosphorus >= 0, "Available Phosphorus must be positive"
-        assert inorganic_phosphorus >= 0, "Inorganic Phosphorus must be positive"
-        assert organic_phosphorus >= 0, "Organic Phosphorus must be positive"
-
-        grd._load_dict('tn', total_nitrogen)
-        grd._load_dict('tp', total_phosphorus)
-        grd._load_dict('ap', available_phosphorus)
-        grd._load_dict('ip', inorganic_phosphorus)
-        grd._load_dict('op', organic_phosphorus)
-        grd.write()
-
-    # Load clim_data and write to input templates
-    array_data = []
+    soil_variables = ['tn', 'tp', 'ap', 'ip', 'op']
+    soil_names = ["Total Nitrogen", "Total Phosphorus", "Available Phosphorus",
+                  "Inorganic Phosphorus", "Organic Phosphorus"]
+    soil = {}
+    for var, name in zip(soil_variables, soil_names):
+        soil[var] = read_soil_data(var, soil_data, config_data)
+        assert np.all(soil[var][grid_y, grid_x] >= 0), f"{name} must be positive"
+
+    # Load clim_data
     variables = ['hurs', 'tas', 'pr', 'ps', 'rsds', 'sfcwind']
 
-    tsize = get_dataset_size(read_clim_data(variables[0])) # all datasets have the same size
-
-    _data = dict(zip(variables, [np.zeros((ngrid, tsize), dtype=np.float32) for _ in range(len(variables))]))
-
-    hurs_gen = _read_clim_data_('hurs')
-    tas_gen = _read_clim_data_('tas')
-    pr_gen = _read_clim_data_('pr')
-    ps_gen = _read_clim_data_('ps')
-    rsds_gen = _read_clim_data_('rsds')
-    sfcwind_gen = _read_clim_data_('sfcwind')
-
-    i = 0
-    print(f"Reading data: {variables}{'' * 20}")
-    print_progress(i, tsize, prefix='Reading data:', suffix='Complete')
-    for hurs, tas, pr, ps, rsds, sfcwind, j in zip(hurs_gen, tas_gen, pr_gen, ps_gen, rsds_gen, sfcwind_gen, range(tsize)):
-        _data["hurs"][:, j] = get_values_at(hurs)
-        _data["tas"][:, j] = get_values_at(tas)
-        _data["pr"][:, j] = get_values_at(pr)
-        _data["ps"][:, j] = get_values_at(ps)
-        _data["rsds"][:, j] = get_values_at(rsds)
-        _data["sfcwind"][:, j] = get_values_at(sfcwind)
-        print_progress(i+1, tsize, prefix='Reading data:', suffix='Complete')
-        i += 1
-    # i = 0
-    # with concurrent.futures.ThreadPoolExecutor() as executor:
-    #     futures = [
-    #         executor.submit(process_data, j, hurs, tas, pr, ps, rsds, sfcwind)
-    #         for hurs, tas, pr, ps, rsds, sfcwind, j in zip(hurs_gen, tas_gen, pr_gen, ps_gen, rsds_gen, sfcwind_gen, range(tsize))
-    #         ]
-
-    #     print(f"Reading data: {variables}{'' * 20}")
-    #     print_progress(i, tsize, prefix='Reading data:', suffix='Complete')
-    #     for future in concurrent.futures.as_completed(futures):
-    #         result = future.result()
-    #         j = result["j"]
-    #         _data["hurs"][:, j] = result["hurs"]
-    #         _data["tas"][:, j] = result["tas"]
-    #         _data["pr"][:, j] = result["pr"]
-    #         _data["ps"][:, j] = result["ps"]
-    #         _data["rsds"][:, j] = result["rsds"]
-    #         _data["sfcwind"][:, j] = result["sfcwind"]
-    #         i += 1
-    #         print_progress(i, tsize, prefix='Reading data:', suffix='Complete')
-
-    array_data = _data["hurs"], _data["tas"], _data["pr"], _data["ps"], _data["rsds"], _data["sfcwind"]
-
-    print("\033[94m Writing data to files \033[0m")
-    # Write data to files in parallel
-    tasks = []
-    # Collect all tasks
-    for var, data in zip(variables, array_data):
-        for i, grd in enumerate(input_templates):
-            tasks.append((grd, var, data[i]))
-
-    # Write data to files
-    with concurrent.futures.ThreadPoolExecutor(max_workers=256) as executor:
-        futures = [executor.submit(process_gridcell, grd, var, data) for grd, var, data in tasks]
-        concurrent.futures.wait(futures)
-
-    # for var, data in zip(variables, array_data):
-    #     print(f"Writing \033[94m{var}\033[0m{' ' * 20}", end="\r")
-    #     with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-    #         futures = [executor.submit(process_gridcell, grd, var, data[i]) for i, grd in enumerate(input_templates)]
-    #         concurrent.futures.wait(futures)
-
-
-def test(var, y=160, x=236, sample=500):
+    with read_clim_data(variables[0], raw_data) as ds:
+        tsize = get_dataset_size(ds) # all datasets have the same size
+    shape = (ngrid, tsize)
+
+    # Each variable is read by a separate process into a (ngrid, tsize) float32 buffer (memory mapped file)
+    buffer_dir = Path(tempfile.mkdtemp(prefix=".buffers_", dir=shared_data))
+    buffers = {var: buffer_dir / f"{var}.dat" for var in variables}
+    # The buffers are removed even if reading or writing fails
+    try:
+        for fpath in buffers.values():
+            open_buffer(fpath, shape, mode="w+").flush()
+
+        print(f"Reading data: {variables}{'' * 20}")
+        start = time.perf_counter()
+        total_bytes = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(variables), nprocs or len(variables))) as executor:
+            futures = [executor.submit(read_variable, var, raw_data, mask_idx, buffers[var], shape, block_size)
+                       for var in variables]
+            for future in concurrent.futures.as_completed(futures):
+                var, nbytes, elapsed = future.result()
+                total_bytes += nbytes
+                print(f"Read {var}: {nbytes / 1024 ** 2:.1f} MB in {elapsed:.1f} s ({nbytes / 1024 ** 2 / elapsed:.1f} MB/s)")
+        elapsed = time.perf_counter() - start
+        print(f"Read {total_bytes / 1024 ** 2:.1f} MB in {elapsed:.1f} s ({total_bytes / 1024 ** 2 / elapsed:.1f} MB/s)")
+
+        print("\033[94m Writing data to files \033[0m")
+        # Each gridcell file is assembled in memory and written once.
+        # Blocks of gridcells are written in parallel by a process pool
+        grid_block = 64
+        written = 0
+        print_progress(written, ngrid, prefix='Writing data:', suffix='Complete')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nprocs) as executor:
+            futures = []
+            for g0 in range(0, ngrid, grid_block):
+                g1 = min(g0 + grid_block, ngrid)
+                yx = list(zip(grid_y[g0:g1].tolist(), grid_x[g0:g1].tolist()))
+                soil_records = [{var: soil[var][y, x].copy(order="F") for var in soil_variables} for y, x in yx]
+                futures.append(executor.submit(write_gridcells, shared_data, g0, yx, soil_records, buffers, shape))
+            for future in concurrent.futures.as_completed(futures):
+                written += future.result()
+                print_progress(written, ngrid, prefix='Writing data:', suffix='Complete')
+    finally:
+        shutil.rmtree(buffer_dir, ignore_errors=True)
+
+
+def test(var, raw_data, shared_data, y=160, x=236, sample=500):
     GREEN = "\033[92m"
     RED = "\033[91m"
     RESET = "\033[0m"
@@ -517,7 +521,7 @@ def test(var, y=160, x=236, sample=500):
     with bz2.BZ2File(file_name, mode='r') as fh:
         pbz2_data = pkl.load(fh)
 
-    dss = read_clim_data(var)
+    dss = read_clim_data(var, raw_data)
     # get a slice of the data
     arr = dss.variables[var][:sample, y, x]
     saved_arr = pbz2_data[var][:sample]
@@ -535,6 +539,14 @@ if __name__ == "__main__":
     print("\n", header, "\n")
     print("\033[0m")
 
+    config_data = load_config()
+    args = parser.parse_args()
+    dataset = args.dataset
+    mode = args.mode
+    raw_data, soil_data, shared_data = setup_folders(dataset, mode, config_data["soil_nutrients_data"])
+    mask_file = Path(args.mask_file)
+    mask = load_mask(mask_file)
+
     if args.test:
         print(f"Testing dataset: {dataset}, Mode: {mode}")
         # Collect the indices of the input_data files to perform the test
@@ -554,9 +566,12 @@ if __name__ == "__main__":
         for var in ['hurs', 'tas', 'pr', 'ps', 'rsds', 'sfcwind']:
             for y, x in indices:
                 print(f"Testing {var} for gridcell {y}-{x}")
-                test(var, y=y, x=x)
+                test(var, raw_data, shared_data, y=y, x=x)
             print(f"Tested files {tested}\n\n")
     else:
+        # if there are files in the shared_data folder, remove them
+        # We dont want to remove the files if we are testing
+        clean_shared_data(shared_data)
         print("\nProcessing details:")
         print("\033[91m")
         print(f"Dataset: {dataset}, Mode: {mode}")
@@ -565,4 +580,4 @@ if __name__ == "__main__":
         print(f"Mask file loaded from {mask_file}")
         print(f"The processed data will be stored in {shared_data}\n")
         print("\033[0m")
-        main()
+        main(raw_data, soil_data, shared_data, mask, config_data, args.block_size, args.nprocs)
@@ -23,15 +23,11 @@ SCEN = ["historical", "ssp370", "ssp585"]
 # Convert prec to kg m-2 day-1
 precConvFactor = 8.64e4
 
-coord = pandas.read_csv(
-    "gridlist_with_idx_53f049b0a72548eb86a68a34f2c9d30d.csv",
-    index_col="name")
-
-MUNICIPIOS = list(coord.index)
+# Gridlist with the indices of the gridcells (see create_experiment_folder.py)
+gridlist = "gridlist_with_idx_53f049b0a72548eb86a68a34f2c9d30d.csv"
 
 # Output data
 outputPath = Path("./rclimdex/")
-os.makedirs(outputPath, exist_ok=True)
 
 cwd = os.getcwd
 ROOT = cwd()
@@ -46,7 +42,10 @@ def openBZ2(filepath:Path)-> dict:
 
 
 def openFile(filepath:Path) -> tuple:
-    dt = openBZ2(filepath)
+    return splitData(openBZ2(filepath))
+
+
+def splitData(dt: dict) -> tuple:
     tasmax = dt['tas'] + 2.0
     tasmin = dt['tas'] - 2.0
     pr = dt['pr']
@@ -54,17 +53,8 @@ def openFile(filepath:Path) -> tuple:
     return (pr, tasmax, tasmin)
 
 
-def main(model, scen):
-
-    # iter over models
-    data_path = Path(f"./{model}").resolve()
-    scen_path = data_path / scen
-    print(scen_path.resolve())
-    metadata = scen_path / "ISIMIP_HISTORICAL_METADATA.pbz2"
-    print(metadata.resolve().exists())
-    with bz2.BZ2File(metadata, mode='r') as fh:
-        ancillData = pickle.load(fh)
-
+def dateIndex(ancillData) -> pandas.DatetimeIndex:
+    """Daily index of the input data. ancillData: content of ISIMIP_HISTORICAL_METADATA.pbz2"""
     calendar = ancillData[0]['calendar']
     time_unit = ancillData[0]['units']
     ndays = ancillData[0]['time_index'][:].size
@@ -72,45 +62,67 @@ def main(model, scen):
     tindex = cftime.num2date(range_days, time_unit, calendar)
     start = tindex[0]
     end = tindex[-1]
-    idx = pandas.date_range(strDate(start), strDate(end), freq="D")
+    return pandas.date_range(strDate(start), strDate(end), freq="D")
 
-    # return idx, start, end
-    # Iterate over gridpoints
-    for muni in MUNICIPIOS:
-        # Read Climatic Data
-        nx = int(coord.loc(0)[muni]['x'])
-        ny = int(coord.loc(0)[muni]['y'])
-        filename = scen_path/Path(f"input_data_{ny}-{nx}.pbz2")
-        pr, tasmax, tasmin = openFile(filename)
 
-        # Write a dict with the available range
-        dataDict = {"YEAR" : idx.year,
-                    "MONTH": idx.month,
-                    "DAY"  : idx.day,
-                    "PRCP" : pandas.Series(pr, index=idx) * precConvFactor,
-                    "TMAX" : pandas.Series(tasmax, index=idx) - 273.15,
-                    "TMIN" : pandas.Series(tasmin, index=idx) - 273.15}
+def writeRClimdex(dt: dict, idx: pandas.DatetimeIndex, muni: str, model: str, scen: str,
+                  output_path: Path = outputPath) -> Path:
+    """Write the RClimdex file of a municipality from the input data (dict) of its gridcell"""
+    pr, tasmax, tasmin = splitData(dt)
 
-        df = pandas.DataFrame(dataDict)
+    # Write a dict with the available range
+    dataDict = {"YEAR" : idx.year,
+                "MONTH": idx.month,
+                "DAY"  : idx.day,
+                "PRCP" : pandas.Series(pr, index=idx) * precConvFactor,
+                "TMAX" : pandas.Series(tasmax, index=idx) - 273.15,
+                "TMIN" : pandas.Series(tasmin, index=idx) - 273.15}
 
-        # Set data ranges 2
-        Start = datetime.datetime(1961, 1, 1, 0, 0) \
-            if scen == "historical" \
-                else datetime.datetime(2041, 1, 1, 0, 0)
+    df = pandas.DataFrame(dataDict)
 
-        End = datetime.datetime(1990, 12, 31, 0, 0) \
-            if scen == "historical" else \
-                datetime.datetime(2070, 12, 31, 0, 0)
+    # Set data ranges 2
+    Start = datetime.datetime(1961, 1, 1, 0, 0) \
+        if scen == "historical" \
+            else datetime.datetime(2041, 1, 1, 0, 0)
 
-        # The final dict
-        to_write = df[Start:End]
+    End = datetime.datetime(1990, 12, 31, 0, 0) \
+        if scen == "historical" else \
+            datetime.datetime(2070, 12, 31, 0, 0)
 
-        final_filename = Path(os.path.join(outputPath.resolve(), f"RClimDex-DATA_{muni}_{model}-{scen}.csv"))
-        to_write.to_csv(final_filename, header=False, index=False)
+    # The final dict
+    to_write = df[Start:End]
+
+    os.makedirs(output_path, exist_ok=True)
+    final_filename = Path(os.path.join(Path(output_path).resolve(), f"RClimDex-DATA_{muni}_{model}-{scen}.csv"))
+    to_write.to_csv(final_filename, header=False, index=False)
+    return final_filename
+
+
+def main(model, scen, coord):
+    """Write the RClimdex files of all municipalities in coord from an already extracted folder.
+    To extract the gridcells and write the RClimdex files in the same pass, use
+    create_experiment_folder.extract_experiment with a rclimdex_exporter"""
+
+    # iter over models
+    data_path = Path(f"./{model}").resolve()
+    scen_path = data_path / scen
+    print(scen_path.resolve())
+    metadata = scen_path / "ISIMIP_HISTORICAL_METADATA.pbz2"
+    print(metadata.resolve().exists())
+    idx = dateIndex(openBZ2(metadata))
+
+    # Iterate over gridpoints
+    for muni in coord.index:
+        # Read Climatic Data
+        nx = int(coord.loc(0)[muni]['x'])
+        ny = int(coord.loc(0)[muni]['y'])
+        filename = scen_path/Path(f"input_data_{ny}-{nx}.pbz2")
+        writeRClimdex(openBZ2(filename), idx, muni, model, scen)
 
 
 if __name__ == "__main__":
+    coord = pandas.read_csv(gridlist, index_col="name")
     for model in MODS:
         for scen in SCEN:
             print(model, scen)
-            main(model, scen)
+            main(model, scen, coord)
@@ -1,11 +1,12 @@
+import os
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, Tuple
 
 import unittest
 import numpy as np
+from numpy.typing import NDArray
 
 from numba import jit
-import pyproj
 from config import fetch_config
 
 config_file = Path("../src/caete.toml").resolve()
@@ -13,6 +14,12 @@ config_file = Path("../src/caete.toml").resolve()
 config = fetch_config(config_file)
 datum = config.crs.datum # type: ignore
 
+# Folder of the mask files. The cell area tables are cached here
+mask_dir = Path("../input/mask").resolve()
+
+# Cell area tables of this process: (dy, dx, datum) -> area of the cells in each row
+_area_tables: Dict[Tuple[float, float, str], NDArray[np.float64]] = {}
+
 
 def calculate_area(center_lat:float, center_lon:float, dx:float=0.5, dy:float=0.5, datum=datum)->float:
     """Calculates the area of a cell on the Earth's surface given the center coordinates and the cell resolution
@@ -34,6 +41,9 @@ def calculate_area(center_lat:float, center_lon:float, dx:float=0.5, dy:float=0.
     assert center_lat >= -90 + (dy/2) and center_lat <= 90 - (dy/2), f"center_lat must match the resolution. Expected range: {-90+(dy/2)},{90-(dy/2)}"
     assert center_lon >= -180 + (dx/2) and center_lon <= 180 - (dx/2), f"center_lon must match the resolution. Expected range:{-180+(dx/2)},{180-(dx/2)}"
 
+    # pyproj is imported only when areas are calculated (see area_table)
+    import pyproj
+
     # Define a geographic coordinate system with WGS84 datum
     geod = pyproj.Geod(ellps=datum)
 
@@ -54,6 +64,80 @@ def calculate_area(center_lat:float, center_lon:float, dx:float=0.5, dy:float=0.
 
     return area
 
+
+def _area_rows(dx: float, dy: float, datum: str) -> NDArray[np.float64]:
+    """Area of the cells in each row of the global grid (row 0 is the northernmost).
+    Same calculation as calculate_area, for all rows at once"""
+    import pyproj
+
+    geod = pyproj.Geod(ellps=datum)
+    nrows = int(round(180.0 / dy))
+    center_lat = 90.0 - dy / 2 - dy * np.arange(nrows)
+    ll_lat = center_lat - dy / 2
+    ur_lat = center_lat + dy / 2
+    # The area does not depend on the longitude
+    ll_lon = np.full(nrows, -dx / 2)
+    ur_lon = np.full(nrows, dx / 2)
+
+    _, _, top_edge_length = geod.inv(ll_lon, ur_lat, ur_lon, ur_lat)
+    _, _, bottom_edge_length = geod.inv(ll_lon, ll_lat, ur_lon, ll_lat)
+    _, _, left_edge_length = geod.inv(ll_lon, ll_lat, ll_lon, ur_lat)
+    _, _, right_edge_length = geod.inv(ur_lon, ll_lat, ur_lon, ur_lat)
+
+    return 0.25 * (np.asarray(top_edge_length) + np.asarray(bottom_edge_length)) *\
+                  (np.asarray(left_edge_length) + np.asarray(right_edge_length))
+
+
+def area_table(dx: float = 0.5, dy: float = 0.5, datum: str = datum) -> NDArray[np.float64]:
+    """Area (m2) of the cells in each row (y index) of the global grid.
+
+    The table is calculated once and cached in memory and on disk (in the mask folder,
+    cell_area_<datum>_<dy>x<dx>.npy). pyproj is used only if the table is not cached.
+
+    Args:
+        dx (float): Cell resolution in the x-direction, degrees
+        dy (float): Cell resolution in the y-direction, degrees
+        datum (str, optional): Datum used for the calculation. Defaults to the datum in caete.toml
+
+    Returns:
+        NDArray[np.float64]: area of the cells, shape=(180/dy,)
+    """
+    assert dx > 0 and dy > 0, "dx and dy must be positive"
+    key = (float(dy), float(dx), datum)
+    table = _area_tables.get(key)
+    if table is not None:
+        return table
+
+    nrows = int(round(180.0 / dy))
+    fpath = mask_dir / f"cell_area_{datum}_{dy}x{dx}.npy"
+    try:
+        table = np.load(fpath)
+        if table.shape != (nrows,):
+            table = None
+    except (OSError, ValueError):
+        table = None
+
+    if table is None:
+        table = _area_rows(dx, dy, datum)
+        try:
+            tmp = fpath.with_name(f"{fpath.name}.{os.getpid()}.tmp")
+            with open(tmp, "wb") as fh:
+                np.save(fh, table)
+            os.replace(tmp, fpath)
+        except OSError:
+            # e.g. read only input folder. Keep the table in memory
+            pass
+
+    table.flags.writeable = False
+    _area_tables[key] = table
+    return table
+
+
+def cell_area(y: int, dx: float = 0.5, dy: float = 0.5, datum: str = datum) -> float:
+    """Area (m2) of a cell of the global grid given its y index. See area_table"""
+    return float(area_table(dx, dy, datum)[y])
+
+
 @jit(nopython=True, cache=True)
 def find_indices_xy(N: float, W: float, res_y: float = 0.5, res_x: float = 0.5, rounding: int = 2) -> Tuple[int, int]:
     """
@@ -289,6 +373,15 @@ class TestFunctions(unittest.TestCase):
             calculate_area(0, 0, 1, -1)
 
 
+    def test_area_table(self):
+        # The table must match calculate_area for all rows
+        for res in (0.5, 1.0):
+            table = _area_rows(res, res, "WGS84")
+            for y in (0, 1, int(45 / res), int(90 / res), int(180 / res) - 1):
+                lat, lon = find_coordinates_xy(y, 0, res, res)
+                self.assertAlmostEqual(table[y] * 1e-6, calculate_area(lat, lon, res, res, "WGS84") * 1e-6, delta=1e-6)
+
+
     def test_find_indices(self):
 
         self.assertEqual(find_indices_xy(0, 0, 0.5, 0.5), find_indices(0, 0, 0.5))
@@ -0,0 +1,37 @@
+# -*-coding:utf-8-*-
+# "CAETÊ"
+# Author:  João Paulo Darela Filho
+"""
+Copyright 2017- LabTerra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Benchmark suite of CAETÊ.
+
+Times the main steps of the model with the bundled site (k34) and test (input/*_test) data:
+the daily community budget (daily_budget) with several numbers of living PLS, the soil
+decomposition (carbon3), one simulated year of a gridcell (save on and off), the setup of the
+gridcells of a region and a one year run of a small region in parallel (run_region_map).
+
+Results are saved as JSON with information about the machine and can be compared
+with a saved baseline. Run from the src folder:
+
+    python -m benchmarks list
+    python -m benchmarks run -o baseline.json
+    python -m benchmarks run -o current.json --baseline baseline.json
+    python -m benchmarks compare baseline.json current.json
+
+Generated data (PLS table, outputs of the benchmark regions) is kept in ../outputs/benchmarks.
+"""
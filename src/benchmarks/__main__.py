@@ -0,0 +1,87 @@
+# -*-coding:utf-8-*-
+# "CAETÊ"
+# Author:  João Paulo Darela Filho
+"""
+Copyright 2017- LabTerra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Command line interface of the benchmark suite. Run from the src folder:
+
+    python -m benchmarks list
+    python -m benchmarks run [-k NAME ...] [-r REPEAT] [-o results.json] [--baseline baseline.json]
+    python -m benchmarks compare baseline.json current.json [-t 0.1]
+"""
+
+import argparse
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks.suite import BENCHMARKS, BENCHMARK_PATH, compare, context, load, run, save
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="CAETÊ benchmark suite")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("list", help="List the benchmarks")
+
+    prun = sub.add_parser("run", help="Run the benchmarks and save the results (JSON)")
+    prun.add_argument("-k", "--names", nargs="+", default=None, help="Benchmarks to run (default: all)")
+    prun.add_argument("-r", "--repeat", type=int, default=None, help="Number of times of each benchmark")
+    prun.add_argument("-o", "--output", type=Path, default=None,
+                      help="Results file (default: ../outputs/benchmarks/results_<date>.json)")
+    prun.add_argument("-p", "--pls-table", type=Path, default=None, help="Main PLS table (csv)")
+    prun.add_argument("-g", "--gridcells", type=int, default=4, help="Number of gridcells of the small region")
+    prun.add_argument("-n", "--nprocs", type=int, default=4, help="Number of processes of the small region")
+    prun.add_argument("-b", "--baseline", type=Path, default=None, help="Compare with this results file")
+    prun.add_argument("-t", "--threshold", type=float, default=0.1, help="Regression threshold (fraction)")
+
+    pcmp = sub.add_parser("compare", help="Compare two results files")
+    pcmp.add_argument("baseline", type=Path)
+    pcmp.add_argument("current", type=Path)
+    pcmp.add_argument("-t", "--threshold", type=float, default=0.1, help="Regression threshold (fraction)")
+
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for name, bench in BENCHMARKS.items():
+            print(f"{name:<24} {bench.description}")
+        return 0
+
+    if args.command == "run":
+        ctx = context(args.pls_table, args.gridcells, args.nprocs)
+        results = run(args.names, args.repeat, ctx)
+        output = args.output
+        if output is None:
+            output = BENCHMARK_PATH / f"results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        save(results, output)
+        print(f"Results saved in {output}")
+        if args.baseline is None:
+            return 0
+        baseline, current = load(args.baseline), results
+    else:
+        baseline, current = load(args.baseline), load(args.current)
+
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower than the baseline: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
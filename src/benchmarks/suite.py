@@ -0,0 +1,392 @@
+# -*-coding:utf-8-*-
+# "CAETÊ"
+# Author:  João Paulo Darela Filho
+"""
+Copyright 2017- LabTerra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Benchmark cases, runner and results (JSON).
+
+A benchmark is a setup function registered with the register decorator. The setup receives
+the shared context and returns the function that is timed. Each benchmark is timed repeat
+times. Each time is the mean of number calls of the timed function.
+"""
+
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from parameters import output_path
+
+# Bundled data
+SITE_DATA = Path("../k34").resolve()
+REGION_DATA = Path("../input/MPI-ESM1-2-HR/historical_test").resolve()
+CO2_DATA = Path("../input/co2/historical_CO2_annual_1765-2024.csv").resolve()
+
+# Generated data (PLS table, outputs of the benchmark regions)
+BENCHMARK_PATH = output_path / "benchmarks"
+
+# Simulated year
+YEAR = 1901
+
+# Numbers of living PLS in the daily_budget benchmarks (limited by npls_max, see caete.toml)
+LIVING_PLS = (10, 50, 200, 500)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the progress messages of the model"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+class benchmark:
+    """A benchmark case"""
+
+    def __init__(self, name: str, setup: Callable[["context"], Callable[[], Any]],
+                 repeat: int = 5, number: int = 1, warmup: int = 1, description: str = "") -> None:
+        """
+        Args:
+            name (str): name of the benchmark
+            setup (Callable[[context], Callable[[], Any]]): returns the function that is timed
+            repeat (int, optional): number of times. Defaults to 5.
+            number (int, optional): calls of the timed function per time. Defaults to 1.
+            warmup (int, optional): calls before timing (e.g. JIT compilation). Defaults to 1.
+            description (str, optional): Defaults to "".
+        """
+        self.name = name
+        self.setup = setup
+        self.repeat = repeat
+        self.number = number
+        self.warmup = warmup
+        self.description = description
+
+
+    def run(self, ctx: "context", repeat: Optional[int] = None) -> Dict[str, Any]:
+        """Time the benchmark. Returns the times (seconds per call) and their statistics"""
+        repeat = self.repeat if repeat is None else repeat
+        func = self.setup(ctx)
+        with quiet():
+            for _ in range(self.warmup):
+                func()
+        times: List[float] = []
+        gc.collect()
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with quiet():
+                for _ in range(repeat):
+                    t0 = time.perf_counter()
+                    for _ in range(self.number):
+                        func()
+                    times.append((time.perf_counter() - t0) / self.number)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return {"description": self.description,
+                "repeat": repeat,
+                "number": self.number,
+                "times": times,
+                "min": min(times),
+                "median": statistics.median(times),
+                "mean": statistics.fmean(times),
+                "stdev": statistics.stdev(times) if len(times) > 1 else 0.0}
+
+
+# Registered benchmarks, in execution order
+BENCHMARKS: Dict[str, benchmark] = {}
+
+
+def register(name: str, repeat: int = 5, number: int = 1, warmup: int = 1, description: str = ""):
+    """Decorator. Register a setup function as a benchmark"""
+    def decorator(setup: Callable[["context"], Callable[[], Any]]):
+        BENCHMARKS[name] = benchmark(name, setup, repeat, number, warmup, description)
+        return setup
+    return decorator
+
+
+class context:
+    """Data shared by the benchmarks. Created on first use"""
+
+    def __init__(self, pls_file: Optional[Path] = None, ngridcells: int = 4, nprocs: int = 4) -> None:
+        """
+        Args:
+            pls_file (Optional[Path], optional): main PLS table (csv). Defaults to None: a table
+            with 2 * npls_max PLS is generated (seed=1) and kept in BENCHMARK_PATH.
+            ngridcells (int, optional): number of gridcells of the small region. Defaults to 4.
+            nprocs (int, optional): number of processes used by the small region. Defaults to 4.
+        """
+        self.pls_file = pls_file
+        self.ngridcells = ngridcells
+        self.nprocs = nprocs
+        self._main_table: Optional[np.ndarray] = None
+        self._site: Any = None
+        self._outputs: List[Path] = []
+
+
+    def main_table(self) -> np.ndarray:
+        if self._main_table is None:
+            from metacommunity import pls_table
+            if self.pls_file is None:
+                from caete_module import global_par as gp
+                npls = 2 * int(gp.npls)
+                self.pls_file = BENCHMARK_PATH / "PLS_MAIN" / f"pls_attrs-{npls}.csv"
+                if not self.pls_file.exists():
+                    from plsgen import table_gen
+                    with quiet():
+                        table_gen(npls, self.pls_file.parent, False, seed=1)
+            self._main_table = pls_table.read_pls_table(self.pls_file)
+        return self._main_table
+
+
+    def region(self, clim_data: Path, ngridcells: Optional[int] = None) -> Any:
+        """A new region with the first ngridcells gridcells in clim_data. Gridcells are not set"""
+        from parameters import tsoil, ssoil, hsoil
+        from region import region
+        name = f"benchmarks/region_{os.getpid()}_{len(self._outputs)}"
+        r = region(name, clim_data, (tsoil, ssoil, hsoil), CO2_DATA, self.main_table())
+        self._outputs.append(r.output_path)
+        if ngridcells is not None:
+            r.yx_indices = r.yx_indices[:ngridcells]
+            r.climate_files = r.climate_files[:ngridcells]
+        r.nproc = self.nprocs
+        return r
+
+
+    def site(self) -> Any:
+        """The gridcell of the site (k34) after one month of simulation (save off)"""
+        if self._site is None:
+            r = self.region(SITE_DATA)
+            with quiet():
+                r.set_gridcells()
+                r[0].run_gridcell(f"{YEAR}-01-01", f"{YEAR}-01-31", save=False, verbose=False)
+            self._site = r[0]
+        return self._site
+
+
+    def cleanup(self) -> None:
+        """Remove the outputs of the benchmark regions"""
+        for path in self._outputs:
+            shutil.rmtree(path, ignore_errors=True)
+        self._outputs = []
+        self._site = None
+
+
+def _budget_args(grd: Any, nliving: int) -> tuple:
+    """Arguments of daily_budget for the first community of a gridcell with nliving living PLS.
+    Biomass pools are set as in a new community (see community.py)"""
+    from community import community
+
+    np.random.seed(0)
+    pls_array = next(iter(grd.metacomm)).pls_array
+    comm = community((np.arange(pls_array.shape[1], dtype=np.int32), pls_array))
+    npls = comm.npls
+    living = np.arange(min(nliving, npls))
+
+    def inflate(values: np.ndarray) -> np.ndarray:
+        out = np.zeros(npls, order='F')
+        out[living] = values[living]
+        return out
+
+    sto = np.zeros(shape=(3, npls), order='F')
+    sto[:, living] = comm.vp_sto[:, living]
+    cv = grd.conversion_factors
+    return (comm.pls_array, grd.wp_water_upper_mm, grd.wp_water_lower_mm, grd.soil_temp,
+            grd.tas[0] - cv.tas, grd.ps[0] * cv.ps, grd.rsds[0] * cv.rsds, grd.rhs[0] * cv.rhs,
+            grd.sp_available_n, grd.sp_available_p, grd.sp_organic_n, grd.sp_organic_p, grd.sp_organic_p,
+            grd.find_co2(YEAR), sto, inflate(comm.vp_cleaf), inflate(comm.vp_cwood), inflate(comm.vp_croot),
+            np.zeros(npls, order='F'), grd.wmax_mm, np.zeros(npls, order='F'))
+
+
+def _daily_budget(nliving: int) -> Callable[["context"], Callable[[], Any]]:
+    def setup(ctx: context) -> Callable[[], Any]:
+        from caete_module import budget as model
+        args = _budget_args(ctx.site(), nliving)
+        return lambda: model.daily_budget(*args)
+    return setup
+
+
+for _n in LIVING_PLS:
+    register(f"daily_budget[{_n}]", repeat=10, number=20,
+             description=f"One community daily budget with {_n} living PLS (site k34)")(_daily_budget(_n))
+
+
+@register("carbon3", repeat=10, number=1000, description="Soil decomposition, one day (site k34)")
+def _carbon3(ctx: context) -> Callable[[], Any]:
+    from caete_module import soil_dec
+    grd = ctx.site()
+    args = (grd.soil_temp, (grd.swp.w1 + grd.swp.w2) / grd.wmax_mm, grd.litter_l[-1], grd.cwd[-1],
+            grd.litter_fr[-1], np.copy(grd.lnc[:, -1]), np.copy(grd.sp_csoil), np.copy(grd.sp_snc))
+    return lambda: soil_dec.carbon3(*args)
+
+
+def _run_gridcell(save: bool) -> Callable[["context"], Callable[[], Any]]:
+    def setup(ctx: context) -> Callable[[], Any]:
+        grd = ctx.site()
+        return lambda: grd.run_gridcell(f"{YEAR}-01-01", f"{YEAR}-12-31", save=save, verbose=False)
+    return setup
+
+
+register("run_gridcell[save]", repeat=3, warmup=0,
+         description="One simulated year of a gridcell, outputs saved (site k34)")(_run_gridcell(True))
+register("run_gridcell[nosave]", repeat=3, warmup=0,
+         description="One simulated year of a gridcell, outputs not saved (site k34)")(_run_gridcell(False))
+
+
+@register("set_gridcells", repeat=3, warmup=0, description="Setup of the gridcells of a small region (historical_test)")
+def _set_gridcells(ctx: context) -> Callable[[], Any]:
+    r = ctx.region(REGION_DATA, ctx.ngridcells)
+
+    def func() -> None:
+        r.gridcells = []
+        r.set_gridcells()
+    return func
+
+
+@register("run_region_map", repeat=2, warmup=0,
+          description="One simulated year of a small region in parallel, outputs saved (historical_test)")
+def _run_region_map(ctx: context) -> Callable[[], Any]:
+    from worker import worker
+    r = ctx.region(REGION_DATA, ctx.ngridcells)
+    with quiet():
+        r.set_gridcells()
+    period = (f"{YEAR}-01-01", f"{YEAR}-12-31")
+    return lambda: r.run_region_starmap(worker.transient_run_brk, period)
+
+
+def machine_info() -> Dict[str, Any]:
+    """Information about the machine and the software"""
+    from importlib.metadata import version, PackageNotFoundError
+
+    def pkg_version(name: str) -> Optional[str]:
+        try:
+            return version(name)
+        except PackageNotFoundError:
+            return None
+
+    info: Dict[str, Any] = {"hostname": platform.node(),
+                            "platform": platform.platform(),
+                            "machine": platform.machine(),
+                            "processor": platform.processor(),
+                            "cpu_count": os.cpu_count(),
+                            "python": sys.version.split()[0],
+                            "numpy": np.__version__,
+                            "numba": pkg_version("numba")}
+    if hasattr(os, "sysconf"):
+        try:
+            info["memory_gb"] = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+        except (ValueError, OSError):
+            pass
+    try:
+        import caete_jit
+        info["aot_kernels"] = caete_jit.AOT
+    except ImportError:
+        pass
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True)
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                capture_output=True, text=True, check=True)
+        info["git_commit"] = commit.stdout.strip()
+        info["git_dirty"] = bool(status.stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def run(names: Optional[List[str]] = None, repeat: Optional[int] = None,
+        ctx: Optional[context] = None, verbose: bool = True) -> Dict[str, Any]:
+    """Run benchmarks
+
+    Args:
+        names (Optional[List[str]], optional): benchmarks to run. Defaults to None (all).
+        repeat (Optional[int], optional): overrides the number of times of each benchmark. Defaults to None.
+        ctx (Optional[context], optional): shared data. Defaults to None (a new context).
+        verbose (bool, optional): print the results. Defaults to True.
+
+    Returns:
+        Dict[str, Any]: results (see save)
+    """
+    names = list(BENCHMARKS) if names is None else names
+    not_in = set(names) - set(BENCHMARKS)
+    assert len(not_in) == 0, f"Unknown benchmarks: {sorted(not_in)}"
+    ctx = context() if ctx is None else ctx
+    results: Dict[str, Any] = {}
+    try:
+        for name in names:
+            results[name] = BENCHMARKS[name].run(ctx, repeat)
+            if verbose:
+                print(f"{name:<24} median {format_time(results[name]['median']):>10}  "
+                      f"min {format_time(results[name]['min']):>10}")
+    finally:
+        ctx.cleanup()
+    return {"created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "machine": machine_info(),
+            "pls_table": str(ctx.pls_file),
+            "results": results}
+
+
+def save(results: Dict[str, Any], fpath: Path) -> None:
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    with open(fpath, "w") as fh:
+        json.dump(results, fh, indent=2)
+
+
+def load(fpath: Path) -> Dict[str, Any]:
+    with open(fpath) as fh:
+        return json.load(fh)
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.3f} {unit}"
+    return f"{seconds / 1e-9:.1f} ns"
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float = 0.1) -> List[str]:
+    """Compare the medians of two results. Prints a table and returns the names of the
+    benchmarks that are slower than the baseline by more than threshold (fraction)"""
+    regressions = []
+    print(f"{'benchmark':<24} {'baseline':>12} {'current':>12} {'ratio':>8}")
+    for name, res in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<24} {'-':>12} {format_time(res['median']):>12} {'-':>8}")
+            continue
+        ratio = res["median"] / base["median"]
+        flag = ""
+        if ratio > 1.0 + threshold:
+            flag = "  slower"
+            regressions.append(name)
+        elif ratio < 1.0 - threshold:
+            flag = "  faster"
+        print(f"{name:<24} {format_time(base['median']):>12} {format_time(res['median']):>12} {ratio:>8.3f}{flag}")
+    if baseline.get("machine", {}).get("hostname") != current.get("machine", {}).get("hostname"):
+        print("Warning: the results were obtained in different machines")
+    return regressions
@@ -0,0 +1,66 @@
+# -*-coding:utf-8-*-
+# "CAETÊ"
+# Author:  João Paulo Darela Filho
+"""
+Copyright 2017- LabTerra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Ahead of time compilation of the kernels in jit_kernels.py (numba.pycc).
+
+Creates the extension module caete_aot in the src folder. caete_jit uses it if it is
+available, so the processes do not compile (or load from the numba cache) the kernels and
+do not import numba. Run with `make aot` (or python build_aot.py). Build it again after
+changing the kernels. Remove the extension (make clean_so) to go back to the JIT version.
+"""
+
+import sys
+from pathlib import Path
+
+from numba.pycc import CC
+
+import jit_kernels
+
+MODNAME = "caete_aot"
+
+# Exported kernels and their signatures. The compiled functions do not check the types of the
+# arguments: caete_jit converts the arrays to these dtypes before calling them
+SIGNATURES = {
+    "pft_area_frac": "f4[:](f4[:], f4[:], f4[:])",
+    "inflate_array": "f4[:](i8, f4[:], i8[:])",
+    "atm_canopy_coupling": "f4(f4, f4, f4, f4)",
+    "masked_mean": "f4(i1[:], f4[:])",
+    "masked_mean_2D": "f4[:](i1[:], f4[:, :])",
+    "cw_mean": "f4(f8[:], f4[:])",
+    "cw_variance": "f4(f8[:], f4[:], f4)",
+    "shannon_entropy": "f8(f8[:])",
+    "shannon_evenness": "f8(f8[:])",
+    "shannon_diversity": "f8(f8[:])",
+}
+
+
+def build(output_dir: Path = Path(__file__).parent, verbose: bool = False) -> None:
+    """Compile the kernels into the extension module caete_aot"""
+    cc = CC(MODNAME)
+    cc.output_dir = str(output_dir)
+    cc.verbose = verbose
+    for name, signature in SIGNATURES.items():
+        cc.export(name, signature)(getattr(jit_kernels, name).py_func)
+    cc.compile()
+
+
+if __name__ == "__main__":
+    build(verbose="-v" in sys.argv)
+    print(f"{MODNAME} created in {Path(__file__).parent.resolve()}")
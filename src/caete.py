@@ -99,6 +99,7 @@ DESCRIPTION = """ CAETE-DVM-CNP - Carbon and Ecosystem Trait-based Evaluation Mo
 import bz2
 import copy
 import csv
+import json
 import logging
 import multiprocessing as mp
 import os
@@ -121,17 +122,17 @@ from joblib import dump, load
 from numpy.typing import NDArray
 
 import metacommunity as mc
-from _geos import calculate_area, find_coordinates_xy, find_indices_xy
+from _geos import cell_area, find_coordinates_xy, find_indices_xy
 from config import Config, fetch_config, fortran_runtime
 from hydro_caete import soil_water
-from output import budget_output
+from output import budget_output, output_profile, region_reducer, daily_outputs, iteration_outputs
+from forcing import forcing_view
+from region_store import region_store, store_fname
+from output_cache import get_cache, spin_cache
 from caete_jit import inflate_array, masked_mean, masked_mean_2D, cw_mean
 from caete_jit import shannon_entropy, shannon_evenness, shannon_diversity
 from caete_jit import atm_canopy_coupling
 
-# Tuples with hydrological parameters for the soil water calculations
-from parameters import hsoil, ssoil, tsoil
-
 
 # This code is only relevant in Windows systems. It adds the fortran compiler dlls to the PATH
 # so the shared library can find the fortran runtime libraries of the intel one API compiler (ifx)
@@ -158,6 +159,8 @@ lock = mp.Lock()
 
 # Output file extension
 out_ext = ".pkz"
+# Metadata of the spins in each gridcell output folder
+manifest_name = "manifest.json"
 
 warnings.simplefilter("default")
 
@@ -317,6 +320,22 @@ def parse_date(date_string):
             pass
     raise ValueError('No valid date format found')
 
+def spin_metadata(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Metadata of the data of a spin (the dict returned by gridcell_output._flush_output)
+
+    Returns:
+        Dict[str, Any]: sind, eind, calendar, time_unit, frequency and
+        variables: {name: {shape, dtype, nbytes}} of the output arrays
+    """
+    variables = {name: {"shape": list(value.shape), "dtype": value.dtype.str, "nbytes": int(value.nbytes)}
+                 for name, value in data.items() if isinstance(value, np.ndarray) and value.size > 0}
+    return {"sind": int(data["sind"]),
+            "eind": int(data["eind"]),
+            "calendar": data["calendar"],
+            "time_unit": data["time_unit"],
+            "frequency": data.get("frequency", "daily"),
+            "variables": variables}
+
 # Timer wrapper
 def timer(method):
     @wraps(method)
@@ -358,14 +377,14 @@ class state_zero:
         assert type(y) == type(x), "x and y must be of the same type"
 
 
-        # Configuration data
-        self.config:Config = fetch_config("caete.toml")
-        self.afex_config = self.config.fertilization # type: ignore
+        # Configuration data. The gridcell keeps only the sections and values it uses (see _set_config)
+        config: Config = fetch_config("caete.toml")
+        self._set_config(config)
         self.co2_data: Optional[Dict[int, float]] = None
 
         # CRS
-        self.yres = self.config.crs.yres # type: ignore
-        self.xres = self.config.crs.xres # type: ignore
+        self.yres = config.crs.yres # type: ignore
+        self.xres = config.crs.xres # type: ignore
 
         self.y, self.x = find_indices_xy(N = y, W = x, res_y=self.yres,
                                          res_x=self.xres,rounding=2) if isinstance(x, float) else (y, x)
@@ -373,8 +392,8 @@ class state_zero:
         self.lat, self.lon = find_coordinates_xy(self.y, self.x, res_y=self.yres,                   # type: ignore
                                                  res_x=self.xres) if isinstance(x, int) else (y, x)
 
-        self.cell_area = calculate_area(self.lat, self.lon,
-                                        dx=self.xres, dy=self.yres)
+        # Cell area (m2) from the per row area table (see _geos.area_table)
+        self.cell_area = cell_area(self.y, dx=self.xres, dy=self.yres)
 
         # Files & IO
         self.xyname = f"{self.y}-{self.x}"
@@ -382,7 +401,7 @@ class state_zero:
         self.input_fname = f"input_data_{self.xyname}.pbz2"
         self.input_fpath = None
         self.data = None
-        self.doy_months = set(self.config.doy_months) # type: ignore
+        self.doy_months = set(config.doy_months) # type: ignore
 
         # Name of the dump folder where this gridcell will dump model outputs.
         # It is a child from ../outputs - defined in caete.toml
@@ -415,6 +434,38 @@ class state_zero:
         # counts the execution of a time slice (a call of self.run_spinup)
         self.run_counter = 0
 
+        # Output backend. See the [output] section in caete.toml
+        # With the "store" backend, flushed spins are appended to the region store (region_store.py)
+        self.output_backend: str = config.output.backend # type: ignore
+
+        # Annual metacommunity state: "log" appends to a columnar log (metacommunity.metacomm_log)
+        # "pkz" writes one file per year with the full state (including limitation status)
+        self.metacomm_format: str = config.output.metacomm_format # type: ignore
+
+        # Time index, shapes and dtypes of the output arrays of each flushed spin
+        self.spin_metadata: Dict[int, Dict[str, Any]] = {}
+
+        # Output profile: variables and frequency of the outputs of this gridcell
+        self.output_profile: output_profile = output_profile.from_config(config.output, self.xyname) # type: ignore
+
+        # Online regional reductions (see output.region_reducer). The partials of the flushed
+        # spins are kept in reducer_partials until the region merges them
+        self.reducer: Optional[region_reducer] = region_reducer.from_config(config.output) # type: ignore
+        if self.reducer is not None:
+            self.reducer.check(self.output_profile)
+        self.reducer_partials: List[Tuple[int, Dict]] = []
+
+
+    def _set_config(self, config: Config) -> None:
+        """Copy the configuration values used by the run and the output readers.
+        The gridcell does not keep the Config object, so it is not pickled with the gridcell"""
+        self.afex_config: Config = config.fertilization # type: ignore
+        self.conversion_factors: Config = config.conversion_factors_isimip # type: ignore
+        self.store_name: str = config.output.store_name # type: ignore
+        # Memory cap of the spin cache (output_cache.py) and number of threads reading spins
+        self.cache_mb: Optional[int] = getattr(config.output, "cache_mb", None)
+        self.read_threads: int = getattr(config.output, "read_threads", 4)
+
 
 class climate:
     """class with climate data"""
@@ -647,7 +698,7 @@ class gridcell_output:
         self.run_counter: int = 0
         self.flush_data:Optional[Dict]
         self.emaxm: List = []
-        self.tsoil: List = []
+        self.tsoil: NDArray
         self.soil_temp:NDArray
         self.photo:NDArray
         self.ls :NDArray
@@ -684,6 +735,11 @@ class gridcell_output:
         self.lnc:NDArray
         self.storage_pool:NDArray
         self.carbon_costs:NDArray
+        # Output arrays of the variables in the output profile
+        self.out_vars: Dict[str, NDArray] = {}
+        # Output period of each day of the running spin and the day where each period starts
+        self.output_period: NDArray[np.int64]
+        self.output_period_start: NDArray[np.int64]
 
 
     def _allocate_output(self, n, npls, ncomms, save=True):
@@ -705,33 +761,18 @@ class gridcell_output:
         if not save:
             return None
 
-        # Daily outputs
+        # Output arrays. Only the variables in the output profile are allocated.
+        # With monthly or annual outputs the arrays have one entry per period
+        nperiods = int(self.output_period[-1]) + 1
         self.emaxm = []
-        self.tsoil = []
-        self.photo = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.aresp = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.npp = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.inorg_n = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.inorg_p = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.sorbed_n = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.sorbed_p = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.snc = np.zeros(shape=(8, n), order='F', dtype=np.dtype("float32"))
-        self.hresp = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.rcm = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.f5 = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.rm = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.rg = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.wue = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.cue = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.carbon_deficit = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.nmin = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.pmin = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.vcmax = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.carbon_costs = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.lai = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.csoil = np.zeros(shape=(4, n), order='F', dtype=np.dtype("float32"))
-        self.wsoil = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
-        self.specific_la = np.zeros(shape=(n,), order='F', dtype=np.dtype("float32"))
+        self.out_vars = {}
+        for name, (attr, lead) in daily_outputs.items():
+            if not self.output_profile.wants(name):
+                setattr(self, attr, None)
+                continue
+            arr = np.zeros(shape=lead + (nperiods,), order='F', dtype=np.dtype("float32"))
+            setattr(self, attr, arr)
+            self.out_vars[name] = arr
 
 
     def _flush_output(self, run_descr, index):
@@ -754,52 +795,48 @@ class gridcell_output:
         else:
             spiname = run_descr + str(self.run_counter) + out_ext
 
-        self.outputs[spiname] = os.path.join(self.out_dir, spiname) # type: ignore
-        to_pickle = {'emaxm': np.array(self.emaxm),
-                     "tsoil": np.array(self.tsoil),
-                     "photo": self.photo,
-                     "aresp": self.aresp,
-                     'npp': self.npp,
-                     'rnpp': self.rnpp,
-                     'lai': self.lai,
-                     'csoil': self.csoil,
-                     'inorg_n': self.inorg_n,
-                     'inorg_p': self.inorg_p,
-                     'sorbed_n': self.sorbed_n,
-                     'sorbed_p': self.sorbed_p,
-                     'snc': self.snc,
-                     'hresp': self.hresp,
-                     'rcm': self.rcm,
-                     'f5': self.f5,
-                     'runom': self.runom,
-                     'evapm': self.evapm,
-                     'wsoil': self.wsoil,
-                     'rm': self.rm,
-                     'rg': self.rg,
-                     'wue': self.wue,
-                     'cue': self.cue,
-                     'cdef': self.carbon_deficit,
-                     'nmin': self.nmin,
-                     'pmin': self.pmin,
-                     'vcmax': self.vcmax,
-                     'specific_la': self.specific_la,
-                     'nupt': self.nupt,
-                     'pupt': self.pupt,
-                     'litter_l': self.litter_l,
-                     'cwd': self.cwd,
-                     'litter_fr': self.litter_fr,
-                     'lnc': self.lnc,
-                     'ls': self.ls,
-                     'c_cost': self.carbon_costs,
-                     'storage_pool': self.storage_pool,
-                     'calendar': self.calendar,    # Calendar name # type: ignore
-                     'time_unit': self.time_unit,  # Time unit # type: ignore
-                     'sind': index[0],
-                     'eind': index[1]}
+        profile = self.output_profile
+        # Profiles with save = false are only used by the region reducers
+        if profile.save and self.output_backend == "store":
+            # All spins are stored in the region store
+            fname = store_fname(self.store_name, profile.frequency)
+            self.outputs[spiname] = os.path.join(self.out_dir.parent, fname)
+        elif profile.save:
+            self.outputs[spiname] = os.path.join(self.out_dir, spiname) # type: ignore
+        aggregate = profile.frequency != "daily"
+        ndays = np.bincount(self.output_period).astype(np.float32)
+        if profile.wants('emaxm'):
+            to_pickle['emaxm'] = np.array(self.emaxm)
+        for name, arr in self.out_vars.items():
+            if aggregate and name not in profile.sums:
+                arr /= ndays
+            to_pickle[name] = arr
+        # Iteration arrays are daily. Aggregate by period
+        for name, (attr, _) in iteration_outputs.items():
+            if not profile.wants(name):
+                continue
+            arr = getattr(self, attr)
+            if aggregate:
+                arr = np.add.reduceat(arr, self.output_period_start, axis=-1)
+                if name not in profile.sums:
+                    arr = arr / ndays
+            to_pickle[name] = arr
+        to_pickle['calendar'] = self.calendar    # Calendar name # type: ignore
+        to_pickle['time_unit'] = self.time_unit  # Time unit # type: ignore
+        to_pickle['sind'] = index[0]
+        to_pickle['eind'] = index[1]
+        if aggregate:
+            to_pickle['frequency'] = profile.frequency
+        if profile.save:
+            self.spin_metadata[self.run_counter] = spin_metadata(to_pickle)
+            self.spin_metadata[self.run_counter]["file"] = spiname
+            self._write_manifest()
+
         # Flush attrs
         dummy_array = np.empty(0, dtype=np.float32)
+        self.out_vars = {}
         self.emaxm: List = []
-        self.tsoil: List = []
+        self.tsoil: NDArray = dummy_array
         self.photo: NDArray = dummy_array
         self.aresp: NDArray = dummy_array
         self.npp: NDArray = dummy_array
@@ -839,6 +876,17 @@ class gridcell_output:
         return to_pickle
 
 
+    def _write_manifest(self) -> None:
+        """Write the metadata of the flushed spins to manifest.json in the gridcell output folder"""
+        manifest = {"gridcell": self.xyname, # type: ignore
+                    "spins": [dict(spin=spin, **meta) for spin, meta in sorted(self.spin_metadata.items())]}
+        fpath = Path(self.out_dir) / manifest_name # type: ignore
+        tmp = fpath.with_suffix(".tmp")
+        with open(tmp, "w") as fh:
+            json.dump(manifest, fh)
+        os.replace(tmp, fpath)
+
+
     def _save_output(self, data_obj: Dict[str, Union[NDArray, str, int]]):
         """Compress and save output data
         data_object: dict; the dict returned from _flush_output
@@ -936,20 +984,27 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
 
 
     def change_input(self,
-                    input_fpath:Union[Path, str, None]=None,
+                    input_fpath:Union[Path, str, forcing_view, None]=None,
                     stime_i:Union[Dict, None]=None,
                     co2:Union[Dict, str, Path, None]=None)->None:
         """modify the input data for the gridcell
 
         Args:
-            input_fpath (Union[Path, str], optional): _description_. Defaults to None.
+            input_fpath (Union[Path, str, forcing_view], optional): input folder or a forcing view (forcing.py). Defaults to None.
             stime_i (Union[Dict, None], optional): _description_. Defaults to None.
+            With a forcing view, the time metadata of the view is used if stime_i is None.
             co2 (Union[Dict, str, Path, None], optional): _description_. Defaults to None.
 
         Returns:
             None: Changes the input data for the gridcell
         """
-        if input_fpath is not None:
+        if isinstance(input_fpath, forcing_view):
+            self.input_fpath = input_fpath
+            self.data = input_fpath.read(self.input_fname)
+            self._set_clim(self.data)
+            if stime_i is None:
+                stime_i = input_fpath.metadata()[0]
+        elif input_fpath is not None:
             #TODO prevent errors here
             self.input_fpath = Path(os.path.join(input_fpath, self.input_fname))
             assert self.input_fpath.exists()
@@ -972,7 +1027,7 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
 
 
     def set_gridcell(self,
-                      input_fpath:Union[Path, str],
+                      input_fpath:Union[Path, str, forcing_view],
                       stime_i: Dict,
                       co2: Dict,
                       tsoil: Tuple[NDArray[np.float64], NDArray[np.float64], NDArray[np.float64]],
@@ -982,7 +1037,8 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
         """ PREPARE A GRIDCELL TO RUN in the meta-community mode
 
         Args:
-            input_fpath (Union[Path, str]): path to the input file with climatic and soil data
+            input_fpath (Union[Path, str, forcing_view]): path to the input file with climatic and soil data,
+            or a forcing view (forcing.py)
             stime_i (Dict): dictionary with the time index and units
             co2 (Dict): dictionary with the CO2 data
             pls_table (np.ndarray): np.array with the functional traits data
@@ -991,14 +1047,14 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
             hsoil (Tuple[np.ndarray]):
         """
         # Input data
-        self.input_fpath = str_or_path(input_fpath)
+        self.input_fpath = input_fpath if isinstance(input_fpath, forcing_view) else str_or_path(input_fpath)
 
         # # Meta-community
         # We want to run queues of gridcells in parallel. So each gridcell receives a copy of the PLS table object
 
         # Number of communities in the metacommunity. Defined in the config file {caete.toml}
         # Each gridcell has one metacommunity wuth ncomms communities
-        self.ncomms:int = self.config.metacomm.n  #type: ignore # Number of communities
+        self.ncomms:int = fetch_config("caete.toml").metacomm.n  #type: ignore # Number of communities
 
         # Metacommunity object
         self.metacomm:mc.metacommunity = mc.metacommunity(self.ncomms, self.get_from_main_array)
@@ -1007,7 +1063,10 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
         # Read climate drivers and soil characteristics, incl. nutrients, for this gridcell
         # Having all data to one gridcell in a file enables to create/start the gricells in parallel (threading)
         # TODO: implement this multithreading in the region class to start all gridcells in parallel
-        self.data = read_bz2_file(self.input_fpath)
+        if isinstance(self.input_fpath, forcing_view):
+            self.data = self.input_fpath.read(self.input_fname)
+        else:
+            self.data = read_bz2_file(self.input_fpath)
 
         # Read climate data
         self._set_clim(self.data)
@@ -1113,7 +1172,7 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
         afex_mode = self.afex_config.afex_mode # type: ignore
 
         # Slice&Catch climatic input and make conversions
-        cv = self.config.conversion_factors_isimip # type: ignore
+        cv = self.conversion_factors
 
         temp: NDArray[np.float32] = self.tas[lower_bound: upper_bound + 1] - cv.tas   # Air temp: model uses °C
         prec: NDArray[np.float32] = self.pr[lower_bound: upper_bound + 1] * cv.pr     # Precipitation: model uses  mm/day
@@ -1167,6 +1226,12 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
         # executed repeatedly between the start and end dates
         # provided in the arguments
 
+        if save:
+            # Map the days of the run to the periods of the output profile
+            self.output_period, self.output_period_start = output_profile.period_index(
+                self.start_index, self.end_index, self.time_unit, self.calendar, self.output_profile.frequency)
+            assert self.output_period.size == steps.size, "Time index of the input data is not daily"
+
         for s in range(spin):
 
             self._allocate_output(steps.size, self.metacomm.comm_npls, len(self.metacomm), save)
@@ -1228,6 +1293,14 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
                 uptake_strategy_n = np.ma.masked_all((xsize, self.metacomm.comm_npls, 366), dtype=np.int8)
                 uptake_strategy_p = np.ma.masked_all((xsize, self.metacomm.comm_npls, 366), dtype=np.int8)
 
+                # (output array, community values) of the variables in the output profile
+                cwm_outputs = [(self.out_vars[name], values) for name, values in
+                               (("photo", photo), ("aresp", aresp), ("npp", npp), ("lai", lai),
+                                ("rcm", rcm), ("f5", f5), ("rm", rm), ("rg", rg), ("wue", wue),
+                                ("cue", cue), ("cdef", carbon_deficit), ("vcmax", vcmax),
+                                ("specific_la", specific_la), ("c_cost", cc))
+                               if name in self.out_vars]
+
             # <- Daily loop
 
             for step in range(steps.size):
@@ -1439,8 +1512,12 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
                 if save:
                     if julian_day == 365:
                         y = today.year
-                        filename = self.out_dir/f"metacommunity_{y}.pkz"
-                        self.metacomm.save_state(filename, y)
+                        if self.metacomm_format == "log":
+                            filename = self.out_dir/"metacomm_log"
+                            self.metacomm.log_state(mc.metacomm_log(filename), y)
+                        else:
+                            filename = self.out_dir/f"metacommunity_{y}.pkz"
+                            self.metacomm.save_state(filename, y)
                         self.metacomm_output[y] = filename
 
                         for community in self.metacomm:
@@ -1611,38 +1688,31 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
                     self.nupt[:, step] = masked_mean_2D(self.metacomm.mask, nupt)
                     self.pupt[:, step] = masked_mean_2D(self.metacomm.mask, pupt)
                     self.storage_pool[:, step] = masked_mean_2D(self.metacomm.mask, storage_pool.astype(np.float32))
-                    self.carbon_costs[step] = masked_mean(self.metacomm.mask, cc)
-                    self.tsoil.append(self.soil_temp)
-                    self.photo[step] = masked_mean(self.metacomm.mask, photo)
-                    self.aresp[step] = masked_mean(self.metacomm.mask, aresp)
-                    self.npp[step] = masked_mean(self.metacomm.mask, npp)
                     self.rnpp[step] = masked_mean(self.metacomm.mask, rnpp_mt)
-                    self.lai[step] = masked_mean(self.metacomm.mask, lai)
-                    self.rcm[step] = masked_mean(self.metacomm.mask, rcm)
-                    self.f5[step] = masked_mean(self.metacomm.mask, f5)
-                    self.rm[step] = masked_mean(self.metacomm.mask, rm)
-                    self.rg[step] = masked_mean(self.metacomm.mask, rg)
-                    self.wue[step] = masked_mean(self.metacomm.mask, wue)
-                    self.cue[step] = masked_mean(self.metacomm.mask, cue)
-                    self.carbon_deficit[step] = masked_mean(self.metacomm.mask, carbon_deficit)
-                    self.vcmax[step] = masked_mean(self.metacomm.mask, vcmax)
-                    self.specific_la[step] = masked_mean(self.metacomm.mask, specific_la)
-                    self.hresp[step] = soil_out['hr']
-                    self.csoil[:, step] = soil_out['cs']
-                    self.wsoil[step] = self.wp_water_upper_mm + self.wp_water_lower_mm
-                    self.inorg_n[step] = self.sp_in_n
-                    self.inorg_p[step] = self.sp_in_p
-                    self.sorbed_n[step] = self.sp_so_n
-                    self.sorbed_p[step] = self.sp_so_p
-                    self.snc[:, step] = soil_out['snc']
-                    self.nmin[step] = self.sp_available_n
-                    self.pmin[step] = self.sp_available_p
                     self.ls[step] = living_pls
 
+                    # Outputs are accumulated in the period of the day (the day itself for daily outputs)
+                    p = self.output_period[step]
+                    for out_array, values in cwm_outputs:
+                        out_array[p] += masked_mean(self.metacomm.mask, values)
+                    for name, value in (("tsoil", self.soil_temp),
+                                        ("hresp", soil_out['hr']),
+                                        ("csoil", soil_out['cs']),
+                                        ("wsoil", self.wp_water_upper_mm + self.wp_water_lower_mm),
+                                        ("inorg_n", self.sp_in_n),
+                                        ("inorg_p", self.sp_in_p),
+                                        ("sorbed_n", self.sp_so_n),
+                                        ("sorbed_p", self.sp_so_p),
+                                        ("snc", soil_out['snc']),
+                                        ("nmin", self.sp_available_n),
+                                        ("pmin", self.sp_available_p)):
+                        if name in self.out_vars:
+                            self.out_vars[name][..., p] += value
+
             # <- Out of the daily loop
             sv: Thread
             if save:
-                if s > 0:
+                if s > 0 and self.output_profile.save and self.output_backend != "store":
                     while True:
                         if sv.is_alive(): # type: ignore
                             sleep(0.5)
@@ -1652,11 +1722,24 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
                 self.executed_iterations.append((start_date, end_date))
                 self.flush_data = self._flush_output(
                     'spin', (self.start_index, self.end_index))
+                if self.reducer is not None:
+                    self.reducer_partials.append((self.run_counter, self.reducer.partial(
+                        self.flush_data, self.output_period_start, self.cell_area, self.output_profile)))
+                if not self.output_profile.save:
+                    self.flush_data = None
+                    continue
+                if self.output_backend == "store":
+                    # Append the spin to the region store (created by the region)
+                    fpath = self.outputs[self.spin_metadata[self.run_counter]["file"]]
+                    region_store(fpath).append(
+                        (self.y, self.x), self.run_counter, self.flush_data)
+                    self.flush_data = None
+                    continue
                 sv = Thread(target=self._save_output, args=(self.flush_data,))
                 sv.start()
         # Finish the last thread
         # <- Out of spin loop
-        if save:
+        if save and self.output_profile.save and self.output_backend != "store":
             while True:
                 if sv.is_alive():
                     sleep(0.5)
@@ -1676,7 +1759,7 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
 
 
     def __fetch_spin_data(self, spin) -> dict:
-        """Get the data from a spin file"""
+        """Get the data from a spin file. The returned arrays are read only"""
         if len(self.outputs) == 0:
             raise AssertionError("No output data available. Run the model first")
         if spin < 10:
@@ -1688,13 +1771,22 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
         else:
             name = f'spin{spin}.pkz'
 
-        with open(self.outputs[name], 'rb') as fh:
-            spin_dt = load(fh)
-        return spin_dt
+        if self.output_backend == "store":
+            fpath = self.outputs[name]
+            return get_cache(self.cache_mb).get(
+                spin_cache.file_key(fpath, (self.y, self.x), spin),
+                lambda: region_store(fpath).read_spin((self.y, self.x), spin))
+
+        def load_spin() -> dict:
+            with open(self.outputs[name], 'rb') as fh:
+                return load(fh)
+        # Decompressed spins are kept in the LRU cache of the process (output_cache.py)
+        return get_cache(self.cache_mb).get(
+            spin_cache.file_key(self.outputs[name]), load_spin)
 
 
     def _fetch_metacommunity_data(self, year) -> dict:
-        """Get the data from a metacommunity output file"""
+        """Get the data from a metacommunity output file ("pkz" metacomm_format)"""
         filename = self.metacomm_output.get(year)
         if filename is None:
             raise KeyError(f"No data available for year {year}")
@@ -1726,10 +1818,21 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
 
 
         years = self._get_years()
+        output = {}
+        paths = {Path(self.metacomm_output[y]) for y in years}
+        if len(paths) == 1 and next(iter(paths)).is_dir():
+            # Columnar log: one read per variable
+            log = mc.metacomm_log(next(iter(paths)))
+            for variable in vnames:
+                log_years, values = log.read(variable)
+                if not np.array_equal(log_years, years):
+                    values = values[np.searchsorted(log_years, years)]
+                output[f"{variable}_{self.xyname}"] = values
+            return output
+
         fetched_data = []
         for y in years:
             fetched_data.append(self._fetch_metacommunity_data(y))
-        output = {}
 
         for variable in vnames:
             outarr = np.zeros(len(years), dtype=np.float32)
@@ -1748,6 +1851,12 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
 
         years = self._get_years()
         assert year in years, f"Year {year} not available"
+        if Path(self.metacomm_output[year]).is_dir():
+            pls = mc.metacomm_log(self.metacomm_output[year]).read_pls(year)
+            return {"pls_id": pls["pls_id"],
+                    "vp_cleaf": pls["pls_vp_cleaf"],
+                    "vp_croot": pls["pls_vp_croot"],
+                    "vp_cwood": pls["pls_vp_cwood"]}
         fetched_data = self._fetch_metacommunity_data(year)
         communities = fetched_data["communities"]
 
@@ -1770,86 +1879,116 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
                 "vp_cwood": pls_cwood}
 
 
-    def _read_daily_output(self,
-                           period: Union[int, Tuple[int, int], None] = None,
-                           ) -> Union[Tuple, List[Any], Dict]:
-
-        """Read the daily output for this gridcell.
-
-        Warning: This method assumes that the ouptut files are time-ordered
-        The argument spinup, if true, will cause the function to return the data
-        for for one specified period. The period argument must be provided in this case.
-        """
+    def _spin_range(self, period: Union[int, Tuple[int, int], None] = None) -> List[int]:
+        """Spin numbers for a period argument (a spin, a (first, last) pair of spins or None for all spins)"""
         assert len(self.outputs) > 0, "No output data available. Run the model first"
-
         if isinstance(period, int):
             assert period > 0, "Period must be positive"
             assert period <= self.run_counter, "Period must be less than the number of spins"
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                return [executor.submit(self.__fetch_spin_data, period)]
-
+            return [period,]
         elif isinstance(period, tuple):
             assert period[1] <= self.run_counter, "Period must be less than the number of spins" # type: ignore
             assert period[0] < period[1], "Period must be a tuple with the start and end spins" # type: ignore
-            spins = range(period[0], period[1] + 1) # type: ignore
-            files = tuple((f"spin{x}" for x in spins))
+            return list(range(period[0], period[1] + 1)) # type: ignore
         elif period is None:
-            files:Tuple[str, ...] = tuple(path_str for path_str in self.outputs.values())
-            spins = range(1, len(files) + 1)
-        else:
-            raise ValueError("Invalid period argument, period must be an integer, tuple of integers, or None")
+            return list(range(1, len(self.outputs) + 1))
+        raise ValueError("Invalid period argument, period must be an integer, tuple of integers, or None")
+
+
+    def _load_manifest(self) -> Dict[int, Dict[str, Any]]:
+        """Metadata of the flushed spins. Read from manifest.json if it is not in memory"""
+        if len(self.spin_metadata) < self.run_counter:
+            fpath = Path(self.out_dir) / manifest_name
+            if fpath.exists():
+                with open(fpath, "r") as fh:
+                    manifest = json.load(fh)
+                for meta in manifest["spins"]:
+                    self.spin_metadata.setdefault(meta.pop("spin"), meta)
+        return self.spin_metadata
+
+
+    def _get_spin_metadata(self, spin: int) -> Dict[str, Any]:
+        """Metadata of a spin. Recorded when the spin is flushed (see _load_manifest).
+        For outputs written without metadata, the spin data is read"""
+        meta = self._load_manifest().get(spin)
+        if meta is None:
+            meta = spin_metadata(self.__fetch_spin_data(spin))
+            self.spin_metadata[spin] = meta
+        return meta
+
+
+    def _time_index(self, spins: Collection[int]) -> NDArray[np.int64]:
+        """Time index (days since time_unit) of each output step of a sequence of spins.
+        For monthly and annual outputs, the first day of each period. Only the spin metadata is used"""
+        index = []
+        for spin in spins:
+            meta = self._get_spin_metadata(spin)
+            if meta["frequency"] == "daily":
+                index.append(np.arange(meta["sind"], meta["eind"] + 1, dtype=np.int64))
+            else:
+                index.append(meta["sind"] + output_profile.period_index(
+                    meta["sind"], meta["eind"], self.time_unit, self.calendar, meta["frequency"])[1])
+        return np.concatenate(index)
 
-        with ThreadPoolExecutor(max_workers=len(files)) as executor:
-            futures = [executor.submit(self.__fetch_spin_data, spin) for spin in spins]
-        return futures
 
+    def find_spins(self, start_date: str, end_date: str) -> Union[int, Tuple[int, int]]:
+        """Find the spins with outputs in a time window. Only the spin metadata is used.
+
+        Args:
+            start_date (str): first day of the window. e.g. "1901-01-01"
+            end_date (str): last day of the window
 
-    def _reader_array(self, ndim:int, sample_data:NDArray) -> NDArray:
+        Returns:
+            Union[int, Tuple[int, int]]: a spin or a (first, last) pair of spins. Can be used as spin_slice
         """
-        Return a numpy array with one extra dimension.
-        This array is used to concatenate results comming from different spins
+        start = int(cftime.date2num(parse_date(start_date), self.time_unit, self.calendar))
+        end = int(cftime.date2num(parse_date(end_date), self.time_unit, self.calendar))
+        spins = [spin for spin, meta in sorted(self._load_manifest().items())
+                 if meta["sind"] <= end and meta["eind"] >= start]
+        if not spins:
+            raise ValueError(f"No outputs between {start_date} and {end_date}")
+        if len(spins) == 1:
+            return spins[0]
+        return spins[0], spins[-1]
 
-        Args:
-            ndim (int): Number of dimensions in the array
-            sample_data (np.ndarray): Sample data to build the array
 
-        Raises:
-            ValueError: If the number of dimensions is less than 1
-            NotImplementedError: If the number of dimensions is greater than 4
+    def print_variables(self) -> Dict[str, Dict[str, Any]]:
+        """Print the output variables (shape and dtype in the first spin). Only the spin metadata is used"""
+        variables = self._get_spin_metadata(1)["variables"]
+        for name, v in sorted(variables.items()):
+            print(f"{name}: shape={tuple(v['shape'])} dtype={v['dtype']}")
+        return variables
 
-        Returns:
-            np.ndarray: An array with one extra dimension and same dtype as sample_data
+
+    def _read_daily_output(self,
+                           period: Union[int, Tuple[int, int], None] = None,
+                           ) -> Union[Tuple, List[Any], Dict]:
+
+        """Read the daily output for this gridcell.
+
+        Warning: This method assumes that the ouptut files are time-ordered
+        The argument spinup, if true, will cause the function to return the data
+        for for one specified period. The period argument must be provided in this case.
+        Returns a list of futures with the data of each spin.
         """
-        if not ndim:
-            raise ValueError("Need the array dimensions to process. Stopping")
-        if ndim > 4:
-            raise NotImplementedError("Arrays with more than 4 axis are not supported")
-        if ndim == 1:
-            output = np.zeros(0, dtype=sample_data.dtype)
-        elif ndim == 2:
-            s = (sample_data.shape[0], 0)
-            output = np.zeros(s, dtype=sample_data.dtype)
-        elif ndim == 3:
-            s = (sample_data.shape[0],
-                self.ncomms,
-                0)
-            output = np.zeros(s, dtype=sample_data.dtype)
-        elif ndim == 4:
-            s = (sample_data.shape[0],
-                sample_data.shape[1],
-                self.ncomms,
-                0)
-            output = np.zeros(s, dtype=sample_data.dtype)
-        return output
+        spins = self._spin_range(period)
+        nthreads = min(len(spins), self.read_threads)
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            futures = [executor.submit(self.__fetch_spin_data, spin) for spin in spins]
+        return futures
 
 
     def _get_daily_data(self, variable: Union [str, Collection[str]] = "npp",
                             spin_slice: Union[int, Tuple[int, int], None] = None,
                             pp: bool=False,
                             return_time: bool=False,
-                            return_array: bool=False
+                            return_array: bool=False,
+                            memmap_dir: Union[str, Path, None] = None
                             ) -> Union[List, NDArray, Tuple[NDArray, NDArray], Tuple[Dict[str, NDArray], NDArray], List[NDArray]]:
-        """_summary_
+        """Read output variables of a sequence of spins.
+
+        The output arrays are allocated from the spin metadata and filled by a bounded
+        pool of threads. Each thread reads one spin and copies it into its slice of the output.
 
         Args:
             variable (Union[str, Collection[str]], optional): variable name or names. Defaults to "npp".
@@ -1857,7 +1996,8 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
             pp (bool, optional): Print available variable names in the output data and exits. Defaults to False.
             return_time (bool, optional): Return a collection of time objects with the days of simulation. Defaults to False.
             return_array (bool, optional): Returns one array or a tuple of arrays. Defaults to False.
-
+            memmap_dir (Union[str, Path, None], optional): If given, the output arrays are memory mapped
+            .npy files ({variable}_{y-x}.npy) in this folder. Defaults to None.
 
         Returns:
             Union[List, NDArray, Tuple[NDArray, NDArray], Tuple[Dict[str, NDArray], NDArray], List[NDArray]
@@ -1869,20 +2009,14 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
             variable = [variable,]
         assert isinstance(variable, Collection), "Variable must be a string or a collection of strings"
 
-
-        result = []
-        f = self._read_daily_output(period=None) if spin_slice is None else self._read_daily_output(period=spin_slice) # type: ignore
-        for _read_ in f:
-            result.append(_read_.result())
+        spins = self._spin_range(spin_slice)
+        metadata = [self._get_spin_metadata(spin) for spin in spins]
 
         # GEt start and end dates (by index)
-        sind = result[0]["sind"]
-        if len(result) == 1:
-            eind = result[0]["eind"]
-        elif len(result) > 1:
-            eind = result[-1]["eind"]
+        sind = metadata[0]["sind"]
+        eind = metadata[-1]["eind"]
 
-        variable_names: Set[str] = set(result[0].keys()) # Available variable names in the output data
+        variable_names: Set[str] = set(metadata[0]["variables"].keys()) # Available variable names in the output data
         variable_set: Set[str] = set(variable)
 
         if pp:
@@ -1892,29 +2026,35 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
         not_in = variable_set - variable_names
         assert len(not_in) == 0, f"No variable(s): {not_in} found in the output data"
 
-        output_list:List[NDArray] = []
-        varnames = []
-        for var in variable_set:
-            sample_data = result[0][var]
-
-            vtype = type(sample_data)
-
-            try:
-                ndim = len(sample_data.shape)
-            except:
-                ndim = 0
-
-            if vtype == np.ndarray:
-                varnames.append(var)
-                output = self._reader_array(ndim, sample_data)
-                for r in result:
-                    if not ndim:
-                        raise ValueError(f"Need the array dimensions to process. Stopping")
-                    output = np.concatenate((output, r[var]), axis=ndim - 1)
-                output_list.append(output)
+        # Allocate the output arrays. Arrays are returned in the order of the variable names
+        varnames = list(dict.fromkeys(variable))
+        outputs: Dict[str, NDArray] = {}
+        for var in varnames:
+            lengths = [meta["variables"][var]["shape"][-1] for meta in metadata]
+            dtype = metadata[0]["variables"][var]["dtype"]
+            shape = tuple(metadata[0]["variables"][var]["shape"][:-1]) + (sum(lengths),)
+            if memmap_dir is None:
+                outputs[var] = np.empty(shape, dtype=dtype)
             else:
-                print(f"Variable {var} is not a numpy array. Skipping")
-                continue
+                fpath = Path(memmap_dir) / f"{var}_{self.xyname}.npy"
+                outputs[var] = np.lib.format.open_memmap(fpath, mode="w+", dtype=dtype, shape=shape)
+        offsets = np.cumsum([0] + [meta["variables"][varnames[0]]["shape"][-1] for meta in metadata])
+
+        def fill(i: int, spin: int) -> None:
+            data = self.__fetch_spin_data(spin)
+            for var in varnames:
+                # Spins of a variable have the same length
+                outputs[var][..., offsets[i]:offsets[i + 1]] = data[var]
+
+        nthreads = min(len(spins), self.read_threads)
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            # list() raises the exceptions of the threads
+            list(executor.map(fill, range(len(spins)), spins))
+
+        output_list: List[NDArray] = [outputs[var] for var in varnames]
+        if memmap_dir is not None:
+            for arr in output_list:
+                arr.flush() # type: ignore
 
         if return_array:
             assert len(variable_set) == 1, "Only one variable can be returned as an array"
@@ -1932,8 +2072,12 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
             # # if the files were saved in a transient run. Files saved in a spinup
             # # will result in a datelist that corresponds to the start_date-end_date range -
             # i.e., the lenght of the datelist divides the lenght of the arrays n spinup times
-
-            datelist = cftime.num2date(np.arange(sind, eind + 1),
+            if metadata[0]["frequency"] != "daily":
+                # Monthly or annual outputs: the date of the first day of each period
+                time_index = self._time_index(spins)
+            else:
+                time_index = np.arange(sind, eind + 1)
+            datelist = cftime.num2date(time_index,
                                        units=self.time_unit,
                                        calendar=self.calendar)
 
@@ -1944,11 +2088,89 @@ class grd_mt(state_zero, climate, time, soil, gridcell_output):
             return output_dict, datelist  # return the Tuple[Dict[str, NDArray], NDArray[datetime]]
 
 
+    def resample(self, variable: Union[str, Collection[str]] = "npp",
+                 frequency: str = "monthly",
+                 how: str = "mean",
+                 spin_slice: Union[int, Tuple[int, int], None] = None,
+                 return_time: bool = False
+                 ) -> Union[NDArray, Dict[str, NDArray], Tuple[Union[NDArray, Dict[str, NDArray]], NDArray]]:
+        """Resample daily outputs to calendar months or years while reading.
+
+        Spins are read one at a time and reduced to periods, so only one spin of daily data
+        is in memory. A period that continues in the next spin is merged with it if the spins are
+        contiguous in time. Spins that repeat a period (e.g. a saved spinup) give one period per spin.
+
+        Args:
+            variable (Union[str, Collection[str]], optional): variable name or names (1D or 2D). Defaults to "npp".
+            frequency (str, optional): "monthly" or "annual". Defaults to "monthly".
+            how (str, optional): "mean", "sum", "min" or "max". Defaults to "mean".
+            spin_slice (Union[int, Tuple[int, int], None], optional): Slice of spins. Defaults to None.
+            return_time (bool, optional): Also return the date of the first day of each period. Defaults to False.
+
+        Returns:
+            An array (one variable) or a dict of arrays with shape ([layer,] period), and the dates if return_time
+        """
+        reducers = {"mean": np.add, "sum": np.add, "min": np.minimum, "max": np.maximum}
+        assert how in reducers, f"how must be one of {tuple(reducers)}"
+        assert frequency in ("monthly", "annual"), "frequency must be 'monthly' or 'annual'"
+        ufunc = reducers[how]
+        names = list(dict.fromkeys(get_args(variable)))
+
+        keys: List[NDArray] = []
+        starts: List[NDArray] = []
+        counts: List[NDArray] = []
+        parts: Dict[str, List[NDArray]] = {k: [] for k in names}
+        last_eind: Optional[int] = None
+        for spin in self._spin_range(spin_slice):
+            meta = self._get_spin_metadata(spin)
+            assert meta["frequency"] == "daily", f"Spin {spin} does not have daily outputs"
+            day_keys = output_profile.period_keys(meta["sind"], meta["eind"], self.time_unit,
+                                                  self.calendar, frequency)
+            # Periods are contiguous in the spin
+            first = np.concatenate(([0], np.nonzero(np.diff(day_keys))[0] + 1))
+            data = self.__fetch_spin_data(spin)
+            ndays = np.diff(np.append(first, day_keys.size))
+            reduced = {k: ufunc.reduceat(np.asarray(data[k], dtype=np.float64), first, axis=-1) for k in names}
+            if keys and keys[-1][-1] == day_keys[0] and meta["sind"] == last_eind + 1: # type: ignore
+                # The last period of the previous spin continues in this spin
+                for k in names:
+                    parts[k][-1][..., -1] = ufunc(parts[k][-1][..., -1], reduced[k][..., 0])
+                    reduced[k] = reduced[k][..., 1:]
+                counts[-1][-1] += ndays[0]
+                first, ndays = first[1:], ndays[1:]
+            last_eind = meta["eind"]
+            del data
+            if first.size == 0:
+                # The spin is inside the last period of the previous spin
+                continue
+            keys.append(day_keys[first])
+            starts.append(meta["sind"] + first)
+            counts.append(ndays)
+            for k in names:
+                parts[k].append(reduced[k])
+
+        ndays_all = np.concatenate(counts)
+        out: Dict[str, NDArray] = {}
+        for k in names:
+            arr = np.concatenate(parts[k], axis=-1)
+            if how == "mean":
+                arr /= ndays_all
+            out[k] = arr.astype(np.float32)
+
+        result: Union[NDArray, Dict[str, NDArray]] = out[names[0]] if len(names) == 1 else out
+        if return_time:
+            return result, cftime.num2date(np.concatenate(starts), self.time_unit, self.calendar)
+        return result
+
+
     def print_available_periods(self):
-        assert len(self.executed_iterations) > 0, "No output data available. Run the model first"
-        for i, period in enumerate(self.executed_iterations):
-            print(f"Period {i + 1}: {period[0]} - {period[1]}")
-        return i + 1
+        """Print the time span of each spin. Only the spin metadata is used"""
+        metadata = self._load_manifest()
+        assert len(metadata) > 0, "No output data available. Run the model first"
+        for spin, meta in sorted(metadata.items()):
+            start, end = cftime.num2date([meta["sind"], meta["eind"]], self.time_unit, self.calendar)
+            print(f"Period {spin}: {start.strftime('%Y-%m-%d')} - {end.strftime('%Y-%m-%d')}")
+        return len(metadata)
 
 
 if __name__ == '__main__':
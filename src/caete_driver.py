@@ -56,6 +56,13 @@ if __name__ == "__main__":
     transclim_files = "../input/20CRv3-ERA5/transclim_test/"
     counterclim_files = "../input/20CRv3-ERA5/counterclim_test/"
 
+    # The spinup forcing can also be a virtual view of another input folder (see forcing.py).
+    # e.g. the detrended 1901-1920 counterclim period repeated from 1801 to 1900:
+    # from forcing import cycle_view, subset_view, transform_view
+    # spinup_base = transform_view(subset_view(counterclim_files, "1901-01-01", "1920-12-31"), detrend=["tas"])
+    # spinclim_files = cycle_view(spinup_base, "1901-01-01", "1920-12-31", "1801-01-01", "1900-12-31")
+    # transclim_files = subset_view(spinclim_files, "1851-01-01", "1900-12-31")
+
     # Soil hydraulic parameters wilting point(RWC), field capacity(RWC) and water saturation(RWC)
     soil_tuple = tsoil, ssoil, hsoil
 
@@ -130,6 +137,6 @@ if __name__ == "__main__":
     # THis final state is not useful to restart the model, but it is useful to
     # access the model outputs and export it to other formats.
     r.clean_model_state()
-    fn.save_state_zstd(r, Path(f"./{region_name}_result.psz"))
+    fn.save_state_sharded(r, Path(f"./{region_name}_result.psz"))
 
     print("\n\nExecution time: ", (time.time() - time_start) / 60, " minutes", end="\n\n")
@@ -138,7 +138,7 @@ if __name__ == "__main__":
 
     # Save state file used to access the historical model outputs and export it to other formats.
     r.clean_model_state()
-    fn.save_state_zstd(r, Path(f"./{region_name}_result.psz"))
+    fn.save_state_sharded(r, Path(f"./{region_name}_result.psz"))
 
     # Update the input source to the transient run - ssp370 files
     print("\nUpdate input to ssp370")
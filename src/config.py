@@ -19,13 +19,20 @@ Copyright 2017- LabTerra
 """
 
 from pathlib import Path
-from typing import Union, Dict , Any, Optional
+from threading import Lock
+from typing import Union, Dict , Any, Optional, Tuple
+import os
 import tomllib
 
 
 """This file contains some parameters that are used in the code.
    Thehe is a class that read parameters stored in a toml file.
-   The configurations can be accessed using the fetch_config function."""
+   The configurations can be accessed using the fetch_config function.
+
+   Configurations are cached in each process, keyed by the path, modification time and
+   size of the toml file. All calls to fetch_config with an unchanged file return the same
+   read only Config object. Use reload_config after changing the file between phases of
+   an experiment."""
 
 # path to the fortran compiler dlls, used in windows systems.
 fortran_runtime = r"C:\Program Files (x86)\Intel\oneAPI\compiler\2024.1\bin"
@@ -38,21 +45,70 @@ class Config:
     Reads nested dictionaries as Config objects
     All the parameters are stored as attributes of the object
     Types are stored in the __annotations__ attribute
+    Config objects are read only. They are shared by all the objects of a process
     """
-    def __init__(self, d: Optional[Dict[str, Any]] = None) -> None:
-        self.__annotations__ = {}
+    def __init__(self, d: Optional[Dict[str, Any]] = None, source: Optional[Tuple[str, int, int]] = None) -> None:
+        """
+        Args:
+            d (Optional[Dict[str, Any]], optional): parameters. Defaults to None.
+            source (Optional[Tuple[str, int, int]], optional): path, modification time and size
+            of the toml file. Defaults to None.
+        """
+        object.__setattr__(self, "__annotations__", {})
+        object.__setattr__(self, "_source", source)
         if d is not None:
             for k, v in d.items():
                 if isinstance(v, dict):
-                    setattr(self, k, Config(v))
+                    object.__setattr__(self, k, Config(v))
                     self.__annotations__[k] = Config
                 else:
-                    setattr(self, k, v)
+                    # Lists are stored as tuples. The object is shared, it can not be changed
+                    object.__setattr__(self, k, tuple(v) if isinstance(v, list) else v)
                     self.__annotations__[k] = type(v)
 
 
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"Config is read only. Can not set '{name}'. Change the toml file and use reload_config")
+
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"Config is read only. Can not delete '{name}'")
+
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Return the parameters as a (nested) dictionary"""
+        out = {}
+        for k in self.__annotations__:
+            v = getattr(self, k)
+            if isinstance(v, Config):
+                out[k] = v.to_dict()
+            elif isinstance(v, tuple) and self.__annotations__[k] is list:
+                out[k] = list(v)
+            else:
+                out[k] = v
+        return out
+
+
+    def __reduce__(self):
+        # Unpickled objects are replaced by the cached Config of the same file, if any
+        return _unpickle_config, (self.to_dict(), self._source)
+
+
     def __repr__(self) -> str:
-        return f"Config({self.__dict__})"
+        return f"Config({self.to_dict()})"
+
+
+# Cache of configurations of this process: path -> Config
+_cache: Dict[str, Config] = {}
+_cache_lock = Lock()
+
+
+def _unpickle_config(d: Dict[str, Any], source: Optional[Tuple[str, int, int]]) -> Config:
+    if source is not None:
+        cached = _cache.get(source[0])
+        if cached is not None and cached._source == source:
+            return cached
+    return Config(d, source)
 
 
 def _fetch_config_parameters(config: Union[str, Path]) -> Dict[str, Any]:
@@ -71,5 +127,25 @@ def _fetch_config_parameters(config: Union[str, Path]) -> Dict[str, Any]:
 # Can be used in the code to get the parameters any the toml file
 def fetch_config(config: Union[str, Path] = config_file) -> Config:
     """ Get parameters from the a toml file.
-    Returns a Config object"""
-    return Config(_fetch_config_parameters(config))
+    Returns a Config object. The file is parsed again only if it was modified"""
+    path = str(Path(config).resolve())
+    st = os.stat(path)
+    source = (path, st.st_mtime_ns, st.st_size)
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached is not None and cached._source == source:
+            return cached
+        cfg = Config(_fetch_config_parameters(path), source)
+        _cache[path] = cfg
+    return cfg
+
+
+def reload_config(config: Optional[Union[str, Path]] = None) -> Optional[Config]:
+    """ Drop the cached configuration of a toml file (or all files if config is None).
+    Returns the configuration read from the file (None if config is None)"""
+    with _cache_lock:
+        if config is None:
+            _cache.clear()
+            return None
+        _cache.pop(str(Path(config).resolve()), None)
+    return fetch_config(config)
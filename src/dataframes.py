@@ -2,21 +2,31 @@
 # and create gridded and table outputs.
 # Author: Joao Paulo Darela Filho
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Union, Collection, Tuple, Dict, List
+from typing import Any, Union, Collection, Tuple, Dict, List, Optional
+import json
 import os
 
 from numpy.typing import NDArray
 import numpy as np
 import pandas as pd
+from netCDF4 import Dataset # type: ignore
 
-from worker import worker
+# pyarrow is optional. Without it, tables are exported as .npy bundles
+try:
+    import pyarrow as pa # type: ignore
+    import pyarrow.feather as feather # type: ignore
+    import pyarrow.parquet as pq # type: ignore
+except ImportError:
+    pa = None
+
+from worker import worker, sharded_region
 from region import region
 from caete import grd_mt, get_args
 from caete_jit import pft_area_frac
 
-from _geos import pan_amazon_region, get_region
+from _geos import pan_amazon_region, get_region, config, find_coordinates_xy
 
 #TODO: implement region configuration
 if pan_amazon_region is None:
@@ -29,8 +39,27 @@ ymin, ymax, xmin, xmax = get_region(pan_amazon_region)
 
 model_results: Path = Path("./pan_amazon_hist_result.psz")
 
-# Load the region file
-reg:region = worker.load_state_zstd(model_results)
+def load_results(fname: Union[str, Path] = model_results,
+                 subset: Union[List[Tuple[int, int]], None] = None) -> Union[region, sharded_region]:
+    """Open a region result file.
+
+    Sharded files (worker.save_state_sharded) are opened lazily: gridcells are read when accessed.
+    A subset of (y, x) gridcells can be loaded instead. Files saved with worker.save_state_zstd
+    are loaded entirely.
+
+    Args:
+        fname (Union[str, Path], optional): region result file. Defaults to model_results.
+        subset (Union[List[Tuple[int, int]], None], optional): (y, x) of the gridcells to load. Defaults to None.
+
+    Returns:
+        Union[region, sharded_region]: the region
+    """
+    if not worker.is_sharded(fname):
+        return worker.load_state_zstd(fname)
+    results = worker.load_state_sharded(fname)
+    if subset is not None:
+        return results.load(subset)
+    return results
 
 
 def get_spins(r:region, gridcell=0):
@@ -40,7 +69,12 @@ def get_spins(r:region, gridcell=0):
 
 def print_variables(r:region):
     """Prints the available variables for each gridcell in the region"""
-    reg[0]._get_daily_data("DUMMY", 1, pp=True)
+    return r[0].print_variables()
+
+def grid_shape() -> Tuple[int, int]:
+    """Number of rows and columns of the global grid. Defined by crs.yres and crs.xres in caete.toml"""
+    return int(round(180 / config.crs.yres)), int(round(360 / config.crs.xres)) # type: ignore
+
 
 #=========================================
 # Functions dealing with gridded outputs
@@ -61,6 +95,9 @@ class gridded_data:
             variables (Collection[str]): which variables to read from the gridcell
             spin_slice (Union[int, Tuple[int, int], None]): which spin slice to read
 
+        Spin data is read through the spin cache of the process (see output_cache.py).
+        Reading other variables of the same spins does not decompress the files again.
+
         Returns:
             _type_: _description_
         """
@@ -113,6 +150,85 @@ class gridded_data:
         return dict(zip(dim_names, (time, coord, data)))
 
 
+    @staticmethod
+    def stack_variables(data: dict) -> Tuple[List[NDArray], List[str]]:
+        """Stack the time series of the gridcells in a dict generated by aggregate_region_data.
+        2D variables (e.g. csoil) are split in one array per layer, named {var}_{layer}
+
+        Args:
+            data (dict): a dict generated by aggregate_region_data
+
+        Returns:
+            Tuple[List[NDArray], List[str]]: arrays with shape (time, gridcell) and their names
+        """
+        assert "data" in data.keys(), "The input dict must contain the 'data' keyword"
+        assert isinstance(data["data"][0], dict), "Data must be a dict"
+        arrays_dict = data["data"]
+        variables = list(arrays_dict[0].keys())  # holds variable names being processed
+
+        arrays = []
+        array_names = []
+        for var in variables:
+            # (gridcell, [layer,] time)
+            stacked = np.stack([d[var] for d in arrays_dict])
+            if stacked.ndim == 2:
+                arrays.append(stacked.T)
+                array_names.append(var)
+            elif stacked.ndim == 3:
+                for k in range(stacked.shape[1]):
+                    arrays.append(stacked[:, k, :].T)
+                    array_names.append(f"{var}_{k + 1}")
+            else:
+                raise NotImplementedError(f"Variable {var}: arrays with more than 2 axis are not supported")
+        return arrays, array_names
+
+
+    @staticmethod
+    def create_region_arrays(data: dict,
+                             bbox: Optional[Dict[str, int]] = None,
+                             layout: str = "bbox") -> Dict:
+        """Reads a dict generated by aggregate_region_data and reorganize the data as
+        gridded arrays covering only the region, or as sparse (time, gridcell) arrays.
+
+        The grid is defined by crs.yres and crs.xres in caete.toml.
+
+        Args:
+            data (dict): a dict generated by aggregate_region_data
+            bbox (Optional[Dict[str, int]], optional): bounding box (ymin, ymax, xmin, xmax indices, see _geos.define_region).
+            Gridcells outside the box are dropped. Defaults to None (the extent of the gridcells).
+            layout (str, optional): "bbox" for masked arrays with shape (time, y, x) or "sparse"
+            for arrays with shape (time, gridcell). Defaults to "bbox".
+
+        Returns:
+            Dict: arrays, names, time and bbox ("bbox" layout) or coord ("sparse" layout, the (y, x) of each gridcell)
+        """
+        time = data["time"]
+        coords = np.asarray(data["coord"], dtype=np.int64)
+        arrays, array_names = gridded_data.stack_variables(data)
+
+        if layout == "sparse":
+            return {"arrays": arrays, "names": array_names, "time": time, "coord": coords}
+        assert layout == "bbox", "layout must be 'bbox' or 'sparse'"
+
+        nrows, ncols = grid_shape()
+        assert coords[:, 0].max() < nrows and coords[:, 1].max() < ncols, "Gridcells outside the grid"
+        if bbox is None:
+            bbox = {"ymin": int(coords[:, 0].min()), "ymax": int(coords[:, 0].max()) + 1,
+                    "xmin": int(coords[:, 1].min()), "xmax": int(coords[:, 1].max()) + 1}
+        inside = ((coords[:, 0] >= bbox["ymin"]) & (coords[:, 0] < bbox["ymax"]) &
+                  (coords[:, 1] >= bbox["xmin"]) & (coords[:, 1] < bbox["xmax"]))
+        yy = coords[inside, 0] - bbox["ymin"]
+        xx = coords[inside, 1] - bbox["xmin"]
+        shape = (bbox["ymax"] - bbox["ymin"], bbox["xmax"] - bbox["xmin"])
+
+        gridded = []
+        for arr in arrays:
+            out = np.ma.masked_all(shape=(arr.shape[0],) + shape, dtype=arr.dtype)
+            out[:, yy, xx] = arr[:, inside]
+            gridded.append(out)
+        return {"arrays": gridded, "names": array_names, "time": time, "bbox": bbox}
+
+
     @staticmethod
     def create_masked_arrays(data: dict):
         """ Reads a dict generated by aggregate_region_data and reorganize the data
@@ -125,34 +241,13 @@ class gridded_data:
             _type_: a tuple with a list of masked_arrays (for each variable)
             and the time array.
         """
-        time = data["time"]
-        coords = data["coord"]
-        # If it is only one variable, we put
         variables = list(data["data"][0].keys()) # holds variable names being processed
-
         dim = data["data"][0][variables[0]].shape
-
         # TODO: manage 2D and 3D arrays
         assert len(dim) == 1, "Only 1D array allowed"
-        arrays_dict = data["data"][:]
 
-        # Read dtypes
-        dtypes = []
-        for var in variables:
-            # We assume all gridcells have the same variables, thus we get the first one
-            dtypes.append(arrays_dict[0][var].dtype)
-
-        arrays = []
-        for i, var in enumerate(variables):
-            arrays.append(np.ma.masked_all(shape=(dim[0], 360, 720), dtype=dtypes[i]))
-
-        for i, var in enumerate(variables):
-            for j in range(len(coords)):
-                arrays[i][:, coords[j][0], coords[j][1]] = arrays_dict[j][var]
-        # Crop the arrays to the region of interest
-        arrays = [a[:, ymin:ymax, xmin:xmax] for a in arrays]
-
-        return arrays, time
+        gridded = gridded_data.create_region_arrays(data, pan_amazon_region)
+        return gridded["arrays"], gridded["time"]
 
 
     @staticmethod
@@ -167,60 +262,222 @@ class gridded_data:
             _type_: a tuple with a list of masked_arrays (for each variable),
             the time array, and the array names.
         """
-        time = data["time"]
-        coords = data["coord"]
+        gridded = gridded_data.create_region_arrays(data, pan_amazon_region)
+        return gridded["arrays"], gridded["time"], gridded["names"]
 
-        assert "data" in data.keys(), "The input dict must contain the 'data' keyword"
-        assert isinstance(data["data"][0], dict), "Data must be a dict"
-        variables = list(data["data"][0].keys())  # holds variable names being processed
 
-        arrays_dict = data["data"][:]
+    @staticmethod
+    def _netcdf_file(r: region,
+                     variable: str,
+                     fpath: Path,
+                     meta: Dict[str, Any],
+                     time_unit: str,
+                     calendar: str,
+                     bbox: Dict[str, int],
+                     chunks: List[int],
+                     complevel: int) -> Dataset:
+        """Create the netCDF file of one variable (CF conventions). Returns the open dataset. Used by save_netcdf"""
+        ny, nx = bbox["ymax"] - bbox["ymin"], bbox["xmax"] - bbox["xmin"]
+        layers = meta["shape"][:-1]
+        crs = r.get_crs()
+
+        ds = Dataset(fpath, mode="w", format="NETCDF4")
+        ds.setncattr("Conventions", "CF-1.8")
+        ds.setncattr("source", "CAETE-DVM")
+        ds.setncattr("region", str(r.name))
+        ds.createDimension("time", None)
+        ds.createDimension("lat", ny)
+        ds.createDimension("lon", nx)
+        # One dimension for each axis before the time axis: layer, layer1, ...
+        layer_dims = tuple("layer" if axis == 0 else f"layer{axis}" for axis in range(len(layers)))
+        for name, size in zip(layer_dims, layers):
+            ds.createDimension(name, size)
+
+        time_var = ds.createVariable("time", "f8", ("time",))
+        time_var.units = time_unit
+        time_var.calendar = calendar
+        time_var.standard_name = "time"
+
+        lat_var = ds.createVariable("lat", "f4", ("lat",))
+        lon_var = ds.createVariable("lon", "f4", ("lon",))
+        lat_var[:] = [find_coordinates_xy(y, bbox["xmin"], config.crs.yres, config.crs.xres)[0] # type: ignore
+                      for y in range(bbox["ymin"], bbox["ymax"])]
+        lon_var[:] = [find_coordinates_xy(bbox["ymin"], x, config.crs.yres, config.crs.xres)[1] # type: ignore
+                      for x in range(bbox["xmin"], bbox["xmax"])]
+        lat_var.units = crs["lat_units"]
+        lat_var.standard_name = "latitude"
+        lon_var.units = crs["lon_units"]
+        lon_var.standard_name = "longitude"
+
+        crs_var = ds.createVariable("crs", "i4")
+        crs_var.spatial_ref = crs["proj4"]
+        crs_var.proj4 = crs["proj4"]
+        crs_var.epsg_code = crs["epsg"]
+        crs_var.datum = crs["datum"]
+
+        chunks = chunks[:1] + [1] * len(layers) + chunks[1:]
+        var = ds.createVariable(variable, meta["dtype"], ("time",) + layer_dims + ("lat", "lon"),
+                                zlib=True, shuffle=True, complevel=complevel, chunksizes=tuple(chunks),
+                                fill_value=np.array(1e20, dtype=meta["dtype"]))
+        var.grid_mapping = "crs"
+        return ds
 
-        # Read dtypes
-        dtypes = []
-        for var in variables:
-            dtypes.append(arrays_dict[0][var].dtype)
 
-        # Allocate the arrays
-        arrays = []
-        array_names = []
-        for i, var in enumerate(variables):
-            dim = arrays_dict[0][var].shape
-            if len(dim) == 1:
-                arrays.append(np.ma.masked_all(shape=(dim[0], 360, 720), dtype=dtypes[i]))
-                array_names.append(var)
-            elif len(dim) == 2:
-                ny, nx = dim
-                for k in range(ny):
-                    arrays.append(np.ma.masked_all(shape=(nx, 360, 720), dtype=dtypes[i]))
-                    array_names.append(f"{var}_{k + 1}")
-        # Fill the arrays
-        array_index = 0
-        for i, var in enumerate(variables):
-            for j in range(len(coords)):
-                if len(arrays_dict[j][var].shape) == 1:
-                    arrays[array_index][:, coords[j][0], coords[j][1]] = arrays_dict[j][var]
-                elif len(arrays_dict[j][var].shape) == 2:
-                    ny, nx = arrays_dict[j][var].shape
-                    for k in range(ny):
-                        arrays[array_index + k][:, coords[j][0], coords[j][1]] = arrays_dict[j][var][k, :]
-            array_index += ny if len(arrays_dict[j][var].shape) == 2 else 1
+    @staticmethod
+    def _read_spin(gridcells: List[grd_mt], variables: List[str], spin: int, nthreads: int) -> Dict[str, NDArray]:
+        """Read one spin of several gridcells. The spin of a gridcell is read once for all variables.
+        Returns one (gridcell, [layer,] time) array per variable. Used by save_netcdf"""
+        variables_meta = gridcells[0]._get_spin_metadata(spin)["variables"]
+        out = {var: np.empty((len(gridcells),) + tuple(variables_meta[var]["shape"]),
+                             dtype=variables_meta[var]["dtype"]) for var in variables}
 
-        # Crop the arrays to the region of interest
-        arrays = [a[:, ymin:ymax, xmin:xmax] for a in arrays]
+        def read(i: int, grd: grd_mt) -> None:
+            data = grd._get_daily_data(variables, spin)
+            for var, arr in zip(variables, [data] if len(variables) == 1 else data):
+                out[var][i] = arr
 
-        return arrays, time, array_names
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            # list() raises the exceptions of the threads
+            list(executor.map(read, range(len(gridcells)), gridcells))
+        return out
 
 
     @staticmethod
-    def save_netcdf(data: dict, output_path: Path, file_name: str):
-        pass
+    def save_netcdf(r: region,
+                    variables: Union[str, Collection[str]],
+                    output_path: Path,
+                    spin_slice: Union[int, Tuple[int, int], None] = None,
+                    bbox: Optional[Dict[str, int]] = None,
+                    chunking: str = "timeseries",
+                    complevel: int = 4,
+                    nthreads: Optional[int] = None) -> List[Path]:
+        """Export region outputs to CF netCDF4 files, one file per variable ({variable}_{region name}.nc).
+
+        Data is streamed. Spins are read in order, each spin of a gridcell is read once for all
+        variables (by a pool of threads), and the data is buffered until whole time chunks are
+        available. Chunks are written once, at most 3650 time steps at a time. The memory used is
+        bounded by one block of 3650 time steps over the bounding box plus the data of one spin.
+
+        Args:
+            r (region): a region object
+            variables (Union[str, Collection[str]]): variable names
+            output_path (Path): folder for the netCDF files
+            spin_slice (Union[int, Tuple[int, int], None], optional): which spin slice to write. Defaults to None (all spins).
+            bbox (Optional[Dict[str, int]], optional): bounding box (see _geos.define_region). Defaults to None (the extent of the gridcells).
+            chunking (str, optional): "timeseries" (chunks with a long time axis and a small area) or
+            "map" (chunks with one time step and the whole area). Defaults to "timeseries".
+            complevel (int, optional): zlib compression level. Defaults to 4.
+            nthreads (Optional[int], optional): number of reader threads. Defaults to None (read_threads in caete.toml).
+
+        Returns:
+            List[Path]: paths of the files written
+        """
+        variables = list(dict.fromkeys(get_args(variables)))
+        os.makedirs(output_path, exist_ok=True)
+        spins = r[0]._spin_range(spin_slice)
+        coords = np.array([(grd.y, grd.x) for grd in r], dtype=np.int64)
+        if bbox is None:
+            bbox = {"ymin": int(coords[:, 0].min()), "ymax": int(coords[:, 0].max()) + 1,
+                    "xmin": int(coords[:, 1].min()), "xmax": int(coords[:, 1].max()) + 1}
+        inside = ((coords[:, 0] >= bbox["ymin"]) & (coords[:, 0] < bbox["ymax"]) &
+                  (coords[:, 1] >= bbox["xmin"]) & (coords[:, 1] < bbox["xmax"]))
+        gridcells = [grd for grd, keep in zip(r, inside) if keep]
+        yy = coords[inside, 0] - bbox["ymin"]
+        xx = coords[inside, 1] - bbox["xmin"]
+        ny, nx = bbox["ymax"] - bbox["ymin"], bbox["xmax"] - bbox["xmin"]
+
+        # Variable metadata from the first gridcell
+        sample = gridcells[0]
+        meta = sample._get_spin_metadata(spins[0])["variables"]
+        ntime = sum(sample._get_spin_metadata(s)["variables"][variables[0]]["shape"][-1] for s in spins)
+        if chunking == "timeseries":
+            chunks = [min(3650, ntime), min(ny, 8), min(nx, 8)]
+        elif chunking == "map":
+            chunks = [1, ny, nx]
+        else:
+            raise ValueError("chunking must be 'timeseries' or 'map'")
+        chunk_time = chunks[0]
+        # Number of time steps written at once (whole chunks)
+        block_time = chunk_time * max(1, 3650 // chunk_time)
+        nthreads = nthreads if nthreads is not None else getattr(r.config.output, "read_threads", 4) # type: ignore
+
+        fpaths = {var: Path(output_path) / f"{var}_{r.name}.nc" for var in variables}
+        datasets = {var: gridded_data._netcdf_file(r, var, fpaths[var], meta[var], sample.time_unit,
+                                                   sample.calendar, bbox, chunks, complevel)
+                    for var in variables}
+        # Data read and not yet written: (gridcell, [layer,] time) arrays and the time index
+        pending: Dict[str, NDArray] = {}
+        pending_time = np.zeros(0, dtype=np.int64)
+        t0 = 0
+        try:
+            for k, spin in enumerate(spins):
+                data = gridded_data._read_spin(gridcells, variables, spin, nthreads)
+                for var in variables:
+                    pending[var] = data[var] if k == 0 else np.concatenate((pending[var], data[var]), axis=-1)
+                pending_time = np.concatenate((pending_time, sample._time_index([spin])))
+                del data
+                # Write the whole chunks. The last chunk of the file can be partial
+                last = k == len(spins) - 1
+                nwrite = pending_time.size if last else pending_time.size - pending_time.size % chunk_time
+                for start in range(0, nwrite, block_time):
+                    stop = min(start + block_time, nwrite)
+                    for var, ds in datasets.items():
+                        values = pending[var][..., start:stop]
+                        block = np.full((stop - start,) + values.shape[1:-1] + (ny, nx),
+                                        ds.variables[var]._FillValue, dtype=values.dtype)
+                        # (gridcell, [layer,] time) -> (time, [layer,] gridcell)
+                        block[..., yy, xx] = np.moveaxis(values, (0, -1), (-1, 0))
+                        ds.variables[var][t0 + start:t0 + stop] = block
+                        ds.variables["time"][t0 + start:t0 + stop] = pending_time[start:stop]
+                        del block
+                for var in variables:
+                    pending[var] = pending[var][..., nwrite:].copy()
+                pending_time = pending_time[nwrite:]
+                t0 += nwrite
+        finally:
+            for ds in datasets.values():
+                ds.close()
+        return list(fpaths.values())
 
 # ======================================
 # Functions dealing with table outputs
 # ======================================
 
 
+def write_table(columns: Dict[str, NDArray], fpath: Path, fmt: str, metadata: Dict[str, Any]) -> Path:
+    """Write a table of numpy columns.
+
+    Args:
+        columns (Dict[str, NDArray]): column name -> 1D array
+        fpath (Path): file path without extension
+        fmt (str): "parquet", "feather" (need pyarrow) or "npy" (a folder with one .npy file per column)
+        metadata (Dict[str, Any]): table metadata (JSON serializable)
+
+    Returns:
+        Path: path of the table
+    """
+    if fmt == "npy":
+        fpath = fpath.with_suffix(".npy.d")
+        os.makedirs(fpath, exist_ok=True)
+        for name, values in columns.items():
+            np.save(fpath / f"{name}.npy", values)
+        with open(fpath / "columns.json", "w") as fh:
+            json.dump({"columns": list(columns), "metadata": metadata}, fh)
+        return fpath
+    if pa is None:
+        raise ImportError(f"pyarrow is necessary to write {fmt} files. Use fmt='npy'")
+    table = pa.table(columns).replace_schema_metadata({"caete": json.dumps(metadata)})
+    if fmt == "parquet":
+        fpath = fpath.with_suffix(".parquet")
+        pq.write_table(table, fpath, compression="zstd")
+    elif fmt == "feather":
+        fpath = fpath.with_suffix(".feather")
+        feather.write_feather(table, fpath, compression="zstd")
+    else:
+        raise ValueError("fmt must be 'parquet', 'feather' or 'npy'")
+    return fpath
+
+
 class table_data:
 
     @staticmethod
@@ -252,6 +509,113 @@ class table_data:
             df.to_csv(grd.out_dir / fname, index_label='day')
 
 
+    @staticmethod
+    def _daily_table(grd: grd_mt,
+                     variables: Union[str, Collection[str]],
+                     spin_slice: Union[int, Tuple[int, int], None],
+                     output_path: Path,
+                     fmt: str) -> Path:
+        """Export the daily outputs of a gridcell as a columnar table. Used by export_daily_tables"""
+        names = list(dict.fromkeys(get_args(variables)))
+        arrays = grd._get_daily_data(names, spin_slice)
+        data = dict(zip(names, [arrays] if len(names) == 1 else arrays)) # type: ignore
+        # Day of the output (days since time_unit)
+        day = grd._time_index(grd._spin_range(spin_slice)).astype(np.int32)
+
+        columns: Dict[str, NDArray] = {"day": day}
+        for k in names:
+            v = data[k]
+            if v.ndim == 1:
+                columns[k] = v
+            elif v.ndim == 2:
+                columns[f"{k}_sum"] = np.sum(v, axis=0, dtype=v.dtype)
+                for i in range(v.shape[0]):
+                    columns[f"{k}_{i+1}"] = np.ascontiguousarray(v[i, :])
+        return write_table(columns, output_path / f"grd_{grd.xyname}", fmt,
+                           {"y": int(grd.y), "x": int(grd.x), "lat": float(grd.lat), "lon": float(grd.lon),
+                            "day_units": grd.time_unit, "calendar": grd.calendar})
+
+
+    @staticmethod
+    def export_daily_tables(r: Union[region, sharded_region],
+                            variables: Union[str, Collection[str]],
+                            output_path: Path,
+                            spin_slice: Union[int, Tuple[int, int], None] = None,
+                            fmt: Optional[str] = None,
+                            nproc: Optional[int] = None) -> List[Path]:
+        """Export the daily outputs of a region as one columnar table per gridcell. Gridcells are
+        exported in parallel. Dates are stored as integer days (day column, units in the table metadata)
+        and the variables keep their dtype (float32).
+
+        Args:
+            r (Union[region, sharded_region]): a region
+            variables (Union[str, Collection[str]]): variable names
+            output_path (Path): output folder
+            spin_slice (Union[int, Tuple[int, int], None], optional): which spin slice to export. Defaults to None.
+            fmt (Optional[str], optional): "parquet", "feather" or "npy". Defaults to None (parquet if pyarrow is available, else npy).
+            nproc (Optional[int], optional): number of processes. Defaults to None (r.nproc).
+
+        Returns:
+            List[Path]: the tables written
+        """
+        fmt = fmt if fmt is not None else ("parquet" if pa is not None else "npy")
+        os.makedirs(output_path, exist_ok=True)
+        nproc = max(1, min(len(r), nproc if nproc is not None else r.nproc))
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            futures = [executor.submit(table_data._daily_table, grd, variables, spin_slice, Path(output_path), fmt)
+                       for grd in r]
+            return [future.result() for future in futures]
+
+
+    @staticmethod
+    def _metacomm_biomass_table(grd: grd_mt, output_path: Path, fmt: str) -> Path:
+        """Export the PLS biomass of the metacommunity of a gridcell (all years). Used by export_metacomm_biomass"""
+        parts: Dict[str, List[NDArray]] = {k: [] for k in ("year", "pls_id", "vp_cleaf", "vp_croot",
+                                                           "vp_cwood", "cveg", "ocp")}
+        for year in grd._get_years():
+            data = grd._read_annual_metacomm_biomass(year)
+            # Sum the biomass of the PLS present in more than one community
+            pls_id, inverse = np.unique(data["pls_id"], return_inverse=True)
+            cleaf, croot, cwood = (np.bincount(inverse, weights=data[k], minlength=pls_id.size).astype(np.float32)
+                                   for k in ("vp_cleaf", "vp_croot", "vp_cwood"))
+            parts["year"].append(np.full(pls_id.size, year, dtype=np.int32))
+            parts["pls_id"].append(pls_id.astype(np.int32))
+            parts["vp_cleaf"].append(cleaf)
+            parts["vp_croot"].append(croot)
+            parts["vp_cwood"].append(cwood)
+            parts["cveg"].append(cleaf + croot + cwood)
+            parts["ocp"].append(pft_area_frac(cleaf, croot, cwood))
+        columns = {k: np.concatenate(v) if v else np.zeros(0, dtype=np.float32) for k, v in parts.items()}
+        return write_table(columns, output_path / f"metacomm_biomass_{grd.xyname}", fmt,
+                           {"y": int(grd.y), "x": int(grd.x), "lat": float(grd.lat), "lon": float(grd.lon)})
+
+
+    @staticmethod
+    def export_metacomm_biomass(r: Union[region, sharded_region],
+                                output_path: Path,
+                                fmt: Optional[str] = None,
+                                nproc: Optional[int] = None) -> List[Path]:
+        """Export the annual PLS biomass of the metacommunities as one columnar table
+        per gridcell (year, pls_id, vp_cleaf, vp_croot, vp_cwood, cveg, ocp). Gridcells are exported in parallel.
+
+        Args:
+            r (Union[region, sharded_region]): a region
+            output_path (Path): output folder
+            fmt (Optional[str], optional): "parquet", "feather" or "npy". Defaults to None (parquet if pyarrow is available, else npy).
+            nproc (Optional[int], optional): number of processes. Defaults to None (r.nproc).
+
+        Returns:
+            List[Path]: the tables written
+        """
+        fmt = fmt if fmt is not None else ("parquet" if pa is not None else "npy")
+        os.makedirs(output_path, exist_ok=True)
+        nproc = max(1, min(len(r), nproc if nproc is not None else r.nproc))
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            futures = [executor.submit(table_data._metacomm_biomass_table, grd, Path(output_path), fmt)
+                       for grd in r]
+            return [future.result() for future in futures]
+
+
     @staticmethod
     def read_grd_metacom_biomass(grd:grd_mt) -> list[Dict]:
         out = []
@@ -270,7 +634,7 @@ class table_data:
         pd.concat(out).to_csv(grd.out_dir / "metacomunity_biomass.csv", index_label="pls_id")
 
 
-def main(vrs):
+def main(reg, vrs):
     data = gridded_data.aggregate_region_data(reg, vrs, (24,25))
     # data = gridded_data.aggregate_region_data(reg, variables, spin_slice=12)
     return data
@@ -278,8 +642,9 @@ def main(vrs):
 
 
 if __name__ == "__main__":
+    reg = load_results(model_results)
     variables_to_read = ("cue", "rnpp", "aresp", "photo", "csoil")
-    data = main(variables_to_read)
+    data = main(reg, variables_to_read)
     a = gridded_data.create_masked_arrays2D(data)
     table_data.make_daily_dataframe(reg, variables_to_read, spin_slice=(1,2))
     for grd in reg:
@@ -0,0 +1,372 @@
+# -*-coding:utf-8-*-
+# "CAETÊ"
+# Author:  João Paulo Darela Filho
+"""
+Copyright 2017- LabTerra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Virtual forcing views.
+
+A forcing view presents the input data of a folder created by input/pre_processing.py
+(input_data_<y>-<x>.pbz2 files and the metadata file) with a different time axis or
+transformed values, without writing new input folders. Views can be used wherever an
+input folder is accepted (region, region.update_input, grd_mt.change_input).
+
+Views can be combined. e.g. a spinup forcing that repeats the detrended 1901-1920
+counterclim period from 1801 to 1900:
+
+    counterclim = forcing_store("../input/20CRv3-ERA5/counterclim")
+    base = transform_view(subset_view(counterclim, "1901-01-01", "1920-12-31"), detrend=["tas"])
+    spinclim = cycle_view(base, "1901-01-01", "1920-12-31", "1801-01-01", "1900-12-31")
+
+Climate variables of a view are computed on access (lazy_series). A cycle view keeps
+only one cycle of data in memory. Soil data is passed through.
+"""
+
+import bz2
+import copy
+import pickle as pkl
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Collection, Dict, List, Optional, Tuple, Union
+
+import cftime
+import numpy as np
+from numpy.typing import NDArray
+
+# Time dependent variables in the input files
+climate_variables = ("hurs", "tas", "ps", "pr", "rsds", "sfcwind")
+
+metadata_pattern = "*_METADATA.pbz2"
+
+
+def _read_bz2(fpath: Union[str, Path]) -> Any:
+    with bz2.BZ2File(fpath, mode='r') as fh:
+        return pkl.load(fh)
+
+
+def _date_index(date: str, time_unit: str, calendar: str) -> int:
+    """Time index (days, based on the time unit and calendar) of a date string (e.g. 1901-01-01 or 19010101)"""
+    for fmt in ('%Y%m%d', '%Y/%m/%d', '%Y-%m-%d', '%Y.%m.%d'):
+        try:
+            dt = datetime.strptime(date, fmt)
+            break
+        except ValueError:
+            pass
+    else:
+        raise ValueError(f'No valid date format found for {date}')
+    return int(np.floor(cftime.date2num(cftime.datetime(dt.year, dt.month, dt.day, calendar=calendar),
+                                        time_unit, calendar=calendar)))
+
+
+class lazy_series:
+    """1D time series computed on access. Supports slices, integers and integer arrays.
+    np.asarray(series) materializes the whole series"""
+
+    def __init__(self, size: int, dtype: Any = np.float32) -> None:
+        self.size = int(size)
+        self.dtype = np.dtype(dtype)
+
+
+    @property
+    def shape(self) -> Tuple[int]:
+        return (self.size,)
+
+
+    @property
+    def ndim(self) -> int:
+        return 1
+
+
+    def __len__(self) -> int:
+        return self.size
+
+
+    def _values(self, idx: NDArray[np.int64]) -> NDArray:
+        raise NotImplementedError
+
+
+    def __getitem__(self, key: Any) -> Any:
+        if isinstance(key, slice):
+            return self._values(np.arange(*key.indices(self.size), dtype=np.int64))
+        if isinstance(key, (int, np.integer)):
+            if not -self.size <= key < self.size:
+                raise IndexError(f"index {key} is out of bounds for size {self.size}")
+            return self._values(np.array([key % self.size], dtype=np.int64))[0]
+        idx = np.asarray(key, dtype=np.int64)
+        return self._values(np.where(idx < 0, idx + self.size, idx))
+
+
+    def __array__(self, dtype: Any = None, copy: Any = None) -> NDArray:
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(size={self.size}, dtype={self.dtype})"
+
+
+class window_series(lazy_series):
+    """A window (size values from offset) of a series"""
+
+    def __init__(self, base: Any, offset: int, size: int) -> None:
+        super().__init__(size, base.dtype)
+        self.base = base
+        self.offset = offset
+
+
+    def _values(self, idx: NDArray[np.int64]) -> NDArray:
+        return self.base[idx + self.offset]
+
+
+class cycled_series(lazy_series):
+    """A segment repeated to fill size values"""
+
+    def __init__(self, segment: NDArray, size: int) -> None:
+        super().__init__(size, segment.dtype)
+        self.segment = segment
+
+
+    def _values(self, idx: NDArray[np.int64]) -> NDArray:
+        return self.segment[idx % self.segment.size]
+
+
+class transformed_series(lazy_series):
+    """base + offset - slope * (t - tmean). With slope = 0 only the offset is added"""
+
+    def __init__(self, base: Any, offset: float = 0.0, slope: float = 0.0, tmean: float = 0.0) -> None:
+        super().__init__(len(base), base.dtype)
+        self.base = base
+        self.offset = offset
+        self.slope = slope
+        self.tmean = tmean
+
+
+    def _values(self, idx: NDArray[np.int64]) -> NDArray:
+        values = self.base[idx] + self.offset
+        if self.slope != 0.0:
+            values = values - self.slope * (idx - self.tmean)
+        return values.astype(self.dtype, copy=False)
+
+
+class forcing_view:
+    """Base class of the forcing views"""
+
+    def read(self, fname: str) -> Dict[str, Any]:
+        """Input data of a gridcell (same keys as the input files)
+
+        Args:
+            fname (str): name of the input file of the gridcell, e.g. input_data_185-239.pbz2
+        """
+        raise NotImplementedError
+
+
+    def metadata(self) -> Tuple[Dict, Dict, Dict]:
+        """(time, lat, lon) metadata of the view. Same layout as the metadata file"""
+        raise NotImplementedError
+
+
+    def input_files(self) -> List[Path]:
+        """Input files of the gridcells in the underlying store"""
+        raise NotImplementedError
+
+
+    def time_index(self) -> NDArray[np.int64]:
+        """Daily time index of the view. As in grd_mt._set_time, only the first value
+        and the size of the time index in the metadata are used"""
+        stime = self.metadata()[0]
+        tindex = stime["time_index"][:]
+        return np.arange(tindex.size, dtype=np.int64) + int(np.floor(tindex[0]))
+
+
+    def _index_of(self, date: str) -> int:
+        """Position of a date in the time axis of the view"""
+        stime = self.metadata()[0]
+        day = _date_index(date, stime["units"], stime["calendar"])
+        tindex = self.time_index()
+        pos = day - int(tindex[0])
+        assert 0 <= pos < tindex.size, f"{date} is out of the period of the forcing data"
+        return pos
+
+
+class forcing_store(forcing_view):
+    """An input folder created by input/pre_processing.py"""
+
+    def __init__(self, folder: Union[str, Path]) -> None:
+        self.folder = Path(folder)
+        assert self.folder.exists(), f"Input folder {folder} does not exist"
+        self._metadata: Optional[Tuple[Dict, Dict, Dict]] = None
+
+
+    def read(self, fname: str) -> Dict[str, Any]:
+        return _read_bz2(self.folder / fname)
+
+
+    def metadata(self) -> Tuple[Dict, Dict, Dict]:
+        if self._metadata is None:
+            try:
+                metadata_file = next(self.folder.glob(metadata_pattern))
+            except StopIteration:
+                raise FileNotFoundError("Metadata file not found in the input data folder")
+            self._metadata = _read_bz2(metadata_file)
+        return self._metadata # type: ignore
+
+
+    def input_files(self) -> List[Path]:
+        return list(self.folder.glob("input_data_*-*.pbz2"))
+
+
+    def __repr__(self) -> str:
+        return f"forcing_store({self.folder})"
+
+
+class _derived_view(forcing_view):
+    """A view over another view"""
+
+    def __init__(self, base: Union[forcing_view, str, Path]) -> None:
+        self.base = as_view(base)
+
+
+    def input_files(self) -> List[Path]:
+        return self.base.input_files()
+
+
+    def _with_time_index(self, time_index: NDArray) -> Tuple[Dict, Dict, Dict]:
+        stime, lat, lon = self.base.metadata()
+        stime = copy.copy(stime)
+        stime["time_index"] = np.asarray(time_index, dtype=np.float64)
+        return stime, lat, lon
+
+
+class subset_view(_derived_view):
+    """The start-end period of the base forcing"""
+
+    def __init__(self, base: Union[forcing_view, str, Path], start: str, end: str) -> None:
+        """
+        Args:
+            base (Union[forcing_view, str, Path]): base view or input folder
+            start (str): first day, e.g. "1901-01-01"
+            end (str): last day, e.g. "1920-12-31"
+        """
+        super().__init__(base)
+        self.start = self.base._index_of(start)
+        self.size = self.base._index_of(end) - self.start + 1
+        assert self.size > 0, "end must be after start"
+
+
+    def read(self, fname: str) -> Dict[str, Any]:
+        data = self.base.read(fname)
+        for var in climate_variables:
+            if var not in data:
+                continue
+            arr = data[var]
+            if isinstance(arr, np.ndarray):
+                # A numpy view: no copy
+                data[var] = arr[self.start: self.start + self.size]
+            else:
+                data[var] = window_series(arr, self.start, self.size)
+        return data
+
+
+    def metadata(self) -> Tuple[Dict, Dict, Dict]:
+        return self._with_time_index(self.base.time_index()[self.start: self.start + self.size])
+
+
+class cycle_view(_derived_view):
+    """The cycle_start-cycle_end period of the base forcing repeated from start to end.
+
+    Day i of the view is day (i mod cycle length) of the cycle. Only one cycle is kept in memory.
+    """
+
+    def __init__(self, base: Union[forcing_view, str, Path], cycle_start: str, cycle_end: str,
+                 start: str, end: str) -> None:
+        """
+        Args:
+            base (Union[forcing_view, str, Path]): base view or input folder
+            cycle_start (str): first day of the cycle in the base forcing
+            cycle_end (str): last day of the cycle in the base forcing
+            start (str): first day of the view
+            end (str): last day of the view
+        """
+        super().__init__(base)
+        self.cycle_start = self.base._index_of(cycle_start)
+        self.cycle_size = self.base._index_of(cycle_end) - self.cycle_start + 1
+        assert self.cycle_size > 0, "cycle_end must be after cycle_start"
+        stime = self.base.metadata()[0]
+        self.day_zero = _date_index(start, stime["units"], stime["calendar"])
+        self.size = _date_index(end, stime["units"], stime["calendar"]) - self.day_zero + 1
+        assert self.size > 0, "end must be after start"
+
+
+    def read(self, fname: str) -> Dict[str, Any]:
+        data = self.base.read(fname)
+        for var in climate_variables:
+            if var not in data:
+                continue
+            segment = np.asarray(data[var][self.cycle_start: self.cycle_start + self.cycle_size])
+            data[var] = cycled_series(segment, self.size)
+        return data
+
+
+    def metadata(self) -> Tuple[Dict, Dict, Dict]:
+        return self._with_time_index(self.day_zero + np.arange(self.size))
+
+
+class transform_view(_derived_view):
+    """Base forcing with constant offsets and/or without a linear trend
+
+    Detrended variables keep the mean of the base period: x - slope * (t - mean(t)).
+    """
+
+    def __init__(self, base: Union[forcing_view, str, Path],
+                 offset: Optional[Dict[str, float]] = None,
+                 detrend: Collection[str] = ()) -> None:
+        """
+        Args:
+            base (Union[forcing_view, str, Path]): base view or input folder
+            offset (Optional[Dict[str, float]], optional): variable -> value added to the variable
+            (in the units of the input files, e.g. {"tas": 2.0}). Defaults to None.
+            detrend (Collection[str], optional): variables to detrend. Defaults to ().
+        """
+        super().__init__(base)
+        self.offset = dict(offset) if offset is not None else {}
+        self.detrend = set(detrend)
+        not_in = (set(self.offset) | self.detrend) - set(climate_variables)
+        assert not not_in, f"Unknown climate variables {not_in}"
+
+
+    def read(self, fname: str) -> Dict[str, Any]:
+        data = self.base.read(fname)
+        for var in set(self.offset) | self.detrend:
+            arr = data[var]
+            slope, tmean = 0.0, 0.0
+            if var in self.detrend:
+                t = np.arange(len(arr), dtype=np.float64)
+                slope = float(np.polyfit(t, np.asarray(arr, dtype=np.float64), 1)[0])
+                tmean = float(t.mean())
+            data[var] = transformed_series(arr, self.offset.get(var, 0.0), slope, tmean)
+        return data
+
+
+    def metadata(self) -> Tuple[Dict, Dict, Dict]:
+        return self.base.metadata()
+
+
+def as_view(forcing: Union[forcing_view, str, Path]) -> forcing_view:
+    """A view of an input folder (or the view itself)"""
+    if isinstance(forcing, forcing_view):
+        return forcing
+    return forcing_store(forcing)
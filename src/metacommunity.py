@@ -19,11 +19,13 @@ Copyright 2017- LabTerra
 """
 import copy
 import csv
+import hashlib
+import json
 import os
 import sys
 
 from pathlib import Path
-from typing import Callable, Dict, Union, Any, Optional
+from typing import Callable, Dict, List, Union, Any, Optional, Tuple
 from numpy.typing import NDArray
 
 from joblib import dump
@@ -46,6 +48,168 @@ from caete_module import global_par as gp
 from caete_jit import process_tuples
 
 
+class metacomm_log:
+    """Append-only columnar log of the annual state of a metacommunity.
+
+    The log is a folder with one raw binary file per column. Each year appends one row.
+    Columns are described in schema.json (dtype and number of values per row).
+    Reading a time series of one variable is a single contiguous read of one file.
+
+    Sections:
+        metacommunity: year, cveg, cleaf, croot, cwood, anpp, uptake_costs (one value per row)
+        communities: cleaf, croot, cwood, anpp, uptake_costs, shannon_* and masked (one value per community)
+        pls: id, community, vp_cleaf, vp_croot, vp_cwood, vp_ocp. Ragged, the living PLS
+             of the non masked communities. pls_count holds the number of PLS of each row.
+
+    The year column is written last. A row is valid only if its year was written. The values
+    of a row whose year was not written (an append that failed) are dropped by the next append.
+    If a year is logged more than once (e.g. a period was run again), the last row is used.
+    """
+
+    metacomm_columns: Tuple[str, ...] = ("cveg", "cleaf", "croot", "cwood", "anpp", "uptake_costs")
+    community_columns: Tuple[str, ...] = ("cleaf", "croot", "cwood", "anpp", "uptake_costs",
+                                          "shannon_entropy", "shannon_diversity", "shannon_evenness")
+    pls_columns: Tuple[str, ...] = ("vp_cleaf", "vp_croot", "vp_cwood", "vp_ocp")
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        """
+        Args:
+            path (Union[str, Path]): folder of the log
+        """
+        self.path = Path(path)
+
+
+    def _schema(self, ncomms: int) -> Dict[str, Dict[str, Any]]:
+        schema: Dict[str, Dict[str, Any]] = {"year": {"dtype": "int32", "width": 1}}
+        for name in self.metacomm_columns:
+            schema[name] = {"dtype": "float32", "width": 1}
+        for name in self.community_columns:
+            schema[f"comm_{name}"] = {"dtype": "float32", "width": ncomms}
+        schema["comm_masked"] = {"dtype": "int8", "width": ncomms}
+        schema["pls_count"] = {"dtype": "int32", "width": 1}
+        schema["pls_id"] = {"dtype": "int32", "width": 0}
+        schema["pls_community"] = {"dtype": "int16", "width": 0}
+        for name in self.pls_columns:
+            schema[f"pls_{name}"] = {"dtype": "float32", "width": 0}
+        return schema
+
+
+    def schema(self) -> Dict[str, Dict[str, Any]]:
+        """Columns of the log. width is the number of values per row (0 for ragged columns)"""
+        with open(self.path / "schema.json", "r") as fh:
+            return json.load(fh)
+
+
+    def exists(self) -> bool:
+        return (self.path / "schema.json").exists()
+
+
+    def append(self, row: Dict[str, Any]) -> None:
+        """Append one row (one year) to the log
+
+        Args:
+            row (Dict[str, Any]): maps column names to values. See metacommunity.log_row
+        """
+        if not self.exists():
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.path / "schema.json", "w") as fh:
+                json.dump(self._schema(row["comm_masked"].size), fh, indent=1)
+        schema = self.schema()
+        # Ragged columns have one value for each PLS of the row (pls_count)
+        npls = int(row["pls_count"])
+        columns: Dict[str, NDArray] = {}
+        for name, column in schema.items():
+            if name == "year":
+                continue
+            columns[name] = np.asarray(row[name], dtype=column["dtype"]).ravel()
+            assert columns[name].size == (column["width"] or npls), f"Wrong number of values for {name}"
+        self._truncate(schema)
+        for name, data in columns.items():
+            with open(self.path / f"{name}.bin", "ab") as fh:
+                data.tofile(fh)
+        # Commit the row
+        with open(self.path / "year.bin", "ab") as fh:
+            np.asarray([row["year"]], dtype=np.int32).tofile(fh)
+
+
+    def _truncate(self, schema: Dict[str, Dict[str, Any]]) -> None:
+        """Truncate the column files to the committed rows (the rows with a year)"""
+        year_file = self.path / "year.bin"
+        nbytes = year_file.stat().st_size if year_file.exists() else 0
+        nrows = nbytes // 4
+        if nbytes > nrows * 4:
+            os.truncate(year_file, nrows * 4)
+        npls = int(self._column(schema, "pls_count", nrows).sum()) if nrows else 0
+        for name, column in schema.items():
+            fpath = self.path / f"{name}.bin"
+            if name == "year" or not fpath.exists():
+                continue
+            nvalues = nrows * column["width"] if column["width"] else npls
+            size = nvalues * np.dtype(column["dtype"]).itemsize
+            if fpath.stat().st_size > size:
+                os.truncate(fpath, size)
+
+
+    def _column(self, schema: Dict[str, Dict[str, Any]], name: str, nrows: int) -> NDArray:
+        column = schema[name]
+        width = column["width"]
+        data = np.fromfile(self.path / f"{name}.bin", dtype=column["dtype"],
+                           count=nrows * width if width else -1)
+        return data.reshape(nrows, width) if width > 1 else data
+
+
+    def rows(self) -> Tuple[NDArray[np.int32], NDArray[np.intp]]:
+        """Returns the sorted logged years and the row of each year"""
+        years = np.fromfile(self.path / "year.bin", dtype=np.int32)
+        # Last occurrence of each year
+        rev_years, rev_index = np.unique(years[::-1], return_index=True)
+        return rev_years, (years.size - 1 - rev_index).astype(np.intp)
+
+
+    def years(self) -> List[int]:
+        return self.rows()[0].tolist()
+
+
+    def read(self, name: str) -> Tuple[NDArray[np.int32], NDArray]:
+        """Read the time series of a metacommunity or community column
+
+        Args:
+            name (str): column name. e.g. cveg or comm_cleaf
+
+        Returns:
+            Tuple[NDArray, NDArray]: years and values (years, [ncomms])
+        """
+        schema = self.schema()
+        assert name in schema and schema[name]["width"] > 0, f"Column {name} not available"
+        years, rows = self.rows()
+        nrows = int(rows.max()) + 1 if rows.size else 0
+        data = self._column(schema, name, nrows)
+        if np.array_equal(rows, np.arange(nrows)):
+            # Sequential run: rows are already in year order
+            return years, data
+        return years, data[rows]
+
+
+    def read_pls(self, year: int) -> Dict[str, NDArray]:
+        """Read the ragged PLS section of a year"""
+        schema = self.schema()
+        years, rows = self.rows()
+        where = np.nonzero(years == year)[0]
+        if where.size == 0:
+            raise KeyError(f"No data available for year {year}")
+        row = int(rows[where[0]])
+        counts = self._column(schema, "pls_count", row + 1)
+        start = int(counts[:row].sum())
+        count = int(counts[row])
+        out = {}
+        for name in ("pls_id", "pls_community") + tuple(f"pls_{n}" for n in self.pls_columns):
+            dtype = np.dtype(schema[name]["dtype"])
+            with open(self.path / f"{name}.bin", "rb") as fh:
+                fh.seek(start * dtype.itemsize)
+                out[name] = np.fromfile(fh, dtype=dtype, count=count)
+        return out
+
+
 class pls_table:
 
     """ Interface for the main table of plant life strategies (Plant prototypes).
@@ -54,6 +218,9 @@ class pls_table:
         representing a global set of virtual plant prototypes.
 
         Use the plsgen.py script to generate a PLS table).
+
+        The table is stored as a csv file. A binary companion (see write_binary) is kept
+        next to it and read instead of the csv while the csv is unchanged.
     """
 
     def __init__(self, array:NDArray[np.float32]) -> None:
@@ -94,18 +261,24 @@ class pls_table:
 
 
     @staticmethod
-    def read_pls_table(pls_file: Union[str, Path]) -> NDArray[np.float32]:
-        """
-        Read the standard attributes table saved in csv format.
-        Return numpy array (shape=(ntraits, npls), F_CONTIGUOUS, dtype=np.float32).
+    def binary_files(pls_file: Union[str, Path]) -> Tuple[Path, Path]:
+        """Paths of the binary companion of a csv table: the array (.npy) and its header (.json)"""
+        pls_file = Path(pls_file)
+        return pls_file.with_suffix(".npy"), pls_file.with_suffix(".json")
 
-        Args:
-            pls_file (Union[str, Path]): Path to the csv file.
 
-        Returns:
-            np.ndarray: PLS table. Shape=(ntraits, npls), F_CONTIGUOUS, dtype=np.float32
-        """
+    @staticmethod
+    def _checksum(fpath: Path) -> str:
+        sha1 = hashlib.sha1()
+        with open(fpath, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b""):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
 
+    @staticmethod
+    def _read_csv(pls_file: Union[str, Path]) -> Tuple[List[str], NDArray[np.float32]]:
+        """Read the csv table. Returns the trait names and the table (ntraits, npls)"""
         with open(pls_file, newline='') as csvfile:
             reader = csv.reader(csvfile)
             data = list(reader)
@@ -114,7 +287,109 @@ class pls_table:
         array_data = np.array(data[1:])[:, 1:].astype(np.float32)
 
         # Transpose the array and convert to Fortran-contiguous order
-        return np.asfortranarray(array_data.T)
+        return data[0][1:], np.asfortranarray(array_data.T)
+
+
+    @staticmethod
+    def write_binary(pls_file: Union[str, Path],
+                     array: Optional[NDArray[np.float32]] = None,
+                     traits: Optional[List[str]] = None) -> Path:
+        """Write the binary companion of a csv table.
+
+        The array is saved as a .npy file (float32, Fortran order, shape=(ntraits, npls)).
+        The header (.json) holds the trait names, the number of PLS and traits, and the size,
+        modification time and sha1 checksum of the csv file.
+
+        Args:
+            pls_file (Union[str, Path]): Path to the csv file.
+            array (Optional[NDArray[np.float32]], optional): the table. Read from the csv if None.
+            traits (Optional[List[str]], optional): trait names. Read from the csv if None.
+
+        Returns:
+            Path: path to the .npy file
+        """
+        pls_file = Path(pls_file)
+        if array is None or traits is None:
+            traits, array = pls_table._read_csv(pls_file)
+        array = np.asfortranarray(array, dtype=np.float32)
+        assert len(traits) == array.shape[0], "The number of trait names should be equal to the number of rows in the table"
+        npy_file, header_file = pls_table.binary_files(pls_file)
+        st = os.stat(pls_file)
+        header = {"csv": pls_file.name,
+                  "traits": list(traits),
+                  "ntraits": int(array.shape[0]),
+                  "npls": int(array.shape[1]),
+                  "dtype": "float32",
+                  "order": "F",
+                  "csv_size": st.st_size,
+                  "csv_mtime_ns": st.st_mtime_ns,
+                  "sha1": pls_table._checksum(pls_file)}
+
+        # Several processes can regenerate the files at the same time. Write to temporary files and rename
+        tmp = f".{os.getpid()}.tmp"
+        with open(npy_file.with_name(npy_file.name + tmp), "wb") as fh:
+            np.save(fh, array)
+        with open(header_file.with_name(header_file.name + tmp), "w") as fh:
+            json.dump(header, fh, indent=2)
+        os.replace(npy_file.with_name(npy_file.name + tmp), npy_file)
+        os.replace(header_file.with_name(header_file.name + tmp), header_file)
+        return npy_file
+
+
+    @staticmethod
+    def _read_binary(pls_file: Path, mmap_mode: Optional[str]) -> Optional[NDArray[np.float32]]:
+        """Read the binary companion of a csv table. Returns None if it is missing or out of date"""
+        npy_file, header_file = pls_table.binary_files(pls_file)
+        if not (npy_file.exists() and header_file.exists()):
+            return None
+        try:
+            with open(header_file) as fh:
+                header = json.load(fh)
+            if pls_file.exists():
+                st = os.stat(pls_file)
+                # The checksum is computed only if the size or the modification time changed
+                if (st.st_size, st.st_mtime_ns) != (header["csv_size"], header["csv_mtime_ns"]) and\
+                    pls_table._checksum(pls_file) != header["sha1"]:
+                    return None
+            array = np.load(npy_file, mmap_mode=mmap_mode) # type: ignore
+        except (OSError, ValueError, KeyError):
+            return None
+        if array.shape != (header["ntraits"], header["npls"]) or array.dtype != np.float32:
+            return None
+        return np.asfortranarray(array) if mmap_mode is None else array
+
+
+    @staticmethod
+    def read_pls_table(pls_file: Union[str, Path], mmap_mode: Optional[str] = None) -> NDArray[np.float32]:
+        """
+        Read the standard attributes table saved in csv format.
+        Return numpy array (shape=(ntraits, npls), F_CONTIGUOUS, dtype=np.float32).
+
+        The binary companion of the csv file (see write_binary) is read if it is up to date.
+        Otherwise the csv file is parsed and the binary companion is (re)generated.
+
+        Args:
+            pls_file (Union[str, Path]): Path to the csv file.
+            mmap_mode (Optional[str], optional): memory map the binary table (e.g. "r", see numpy.load).
+            Defaults to None (read into memory).
+
+        Returns:
+            np.ndarray: PLS table. Shape=(ntraits, npls), F_CONTIGUOUS, dtype=np.float32
+        """
+        pls_file = Path(pls_file)
+        array = pls_table._read_binary(pls_file, mmap_mode)
+        if array is not None:
+            return array
+
+        traits, array = pls_table._read_csv(pls_file)
+        try:
+            npy_file = pls_table.write_binary(pls_file, array, traits)
+        except OSError:
+            # e.g. read only folder. Keep using the csv
+            return array
+        if mmap_mode is not None:
+            return np.load(npy_file, mmap_mode=mmap_mode) # type: ignore
+        return array
 
 
 class metacommunity:
@@ -166,10 +441,8 @@ class metacommunity:
             self.mask[i] = community.masked
 
 
-    def wrapp_state(self, year:int) -> Dict[str, Any]:
-        """Returns a dictionary with the state of the metacommunity."""
-        state = {}
-        state['communities'] = {}
+    def _aggregate_state(self) -> Dict[str, float]:
+        """Metacommunity averages of the annual community variables"""
         counter = 1
         cveg = 0.0
         cleaf = 0.0
@@ -177,6 +450,54 @@ class metacommunity:
         cwood = 0.0
         anpp = 0.0
         uptake_costs = 0.0
+        for community in self.communities.values():
+            if community.masked:
+                continue
+            anpp += community.anpp
+            uptake_costs += community.uptake_costs
+            cleaf += community.cleaf
+            croot += community.croot
+            cwood += community.cwood
+            cveg += community.cleaf + community.croot + community.cwood
+            counter += 1
+        return {'cveg': cveg / counter,
+                'cleaf': cleaf / counter,
+                'croot': croot / counter,
+                'cwood': cwood / counter,
+                'anpp': anpp / counter,
+                'uptake_costs': uptake_costs / counter}
+
+
+    def log_row(self, year:int) -> Dict[str, Any]:
+        """Returns the annual state of the metacommunity as a row of the metacomm_log"""
+        row: Dict[str, Any] = self._aggregate_state()
+        row['year'] = year
+        communities = [self.communities[k] for k in sorted(self.communities)]
+        for name in metacomm_log.community_columns:
+            row[f"comm_{name}"] = np.array([getattr(c, name) for c in communities], dtype=np.float32)
+        row['comm_masked'] = np.array([c.masked for c in communities], dtype=np.int8)
+        living = [(k, c) for k, c in enumerate(communities) if not c.masked]
+        if living:
+            row['pls_id'] = np.concatenate([c.id[c.vp_lsid] for _, c in living])
+            row['pls_community'] = np.concatenate([np.full(c.vp_lsid.size, k) for k, c in living])
+            for name in metacomm_log.pls_columns:
+                row[f"pls_{name}"] = np.concatenate([getattr(c, name)[c.vp_lsid] for _, c in living])
+        else:
+            for name in ("pls_id", "pls_community") + tuple(f"pls_{n}" for n in metacomm_log.pls_columns):
+                row[name] = np.zeros(0)
+        row['pls_count'] = row['pls_id'].size
+        return row
+
+
+    def log_state(self, log: metacomm_log, year:int) -> None:
+        """Append the annual state of the metacommunity to a metacomm_log"""
+        log.append(self.log_row(year))
+
+
+    def wrapp_state(self, year:int) -> Dict[str, Any]:
+        """Returns a dictionary with the state of the metacommunity."""
+        state: Dict[str, Any] = {}
+        state['communities'] = {}
         for k, community in self.communities.items():
             if community.masked:
                 continue
@@ -201,19 +522,7 @@ class metacommunity:
             state['communities'][k]['shannon_entropy'] = community.shannon_entropy
             state['communities'][k]['shannon_diversity'] = community.shannon_diversity
             state['communities'][k]['shannon_evenness'] = community.shannon_evenness
-            anpp += community.anpp
-            uptake_costs += community.uptake_costs
-            cleaf += community.cleaf
-            croot += community.croot
-            cwood += community.cwood
-            cveg += community.cleaf + community.croot + community.cwood
-            counter += 1
-        state['cveg'] = cveg / counter
-        state['cleaf'] = cleaf / counter
-        state['croot'] = croot / counter
-        state['cwood'] = cwood / counter
-        state['anpp'] = anpp / counter
-        state['uptake_costs'] = uptake_costs / counter
+        state.update(self._aggregate_state())
         state['mask'] = self.mask
         state['year'] = year
         return state
@@ -18,9 +18,305 @@ Copyright 2017- LabTerra
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from typing import Any, Dict, List, Optional, Set, Tuple
+
 from numpy.typing import NDArray
+import cftime
 import numpy as np
 
+
+# Output variables written by gridcell_output._flush_output.
+# Name in the output -> (gridcell attribute, leading shape)
+# The time axis is always the last axis.
+daily_outputs: Dict[str, Tuple[str, Tuple[int, ...]]] = {
+    "tsoil": ("tsoil", ()),
+    "photo": ("photo", ()),
+    "aresp": ("aresp", ()),
+    "npp": ("npp", ()),
+    "lai": ("lai", ()),
+    "csoil": ("csoil", (4,)),
+    "inorg_n": ("inorg_n", ()),
+    "inorg_p": ("inorg_p", ()),
+    "sorbed_n": ("sorbed_n", ()),
+    "sorbed_p": ("sorbed_p", ()),
+    "snc": ("snc", (8,)),
+    "hresp": ("hresp", ()),
+    "rcm": ("rcm", ()),
+    "f5": ("f5", ()),
+    "wsoil": ("wsoil", ()),
+    "rm": ("rm", ()),
+    "rg": ("rg", ()),
+    "wue": ("wue", ()),
+    "cue": ("cue", ()),
+    "cdef": ("carbon_deficit", ()),
+    "nmin": ("nmin", ()),
+    "pmin": ("pmin", ()),
+    "vcmax": ("vcmax", ()),
+    "specific_la": ("specific_la", ()),
+    "c_cost": ("carbon_costs", ()),
+}
+
+# These arrays are always allocated with daily resolution because the model
+# uses them during the iteration. They are aggregated when flushed.
+iteration_outputs: Dict[str, Tuple[str, Tuple[int, ...]]] = {
+    "rnpp": ("rnpp", ()),
+    "runom": ("runom", ()),
+    "evapm": ("evapm", ()),
+    "nupt": ("nupt", (2,)),
+    "pupt": ("pupt", (3,)),
+    "litter_l": ("litter_l", ()),
+    "cwd": ("cwd", ()),
+    "litter_fr": ("litter_fr", ()),
+    "lnc": ("lnc", (6,)),
+    "ls": ("ls", ()),
+    "storage_pool": ("storage_pool", (3,)),
+}
+
+frequencies = ("daily", "monthly", "annual")
+
+
+class output_profile:
+    """Selects which variables a gridcell saves, and at which frequency.
+
+    Profiles are defined in the [output.profiles] section of caete.toml. The profile
+    given by output.profile is used by all gridcells, except the gridcells listed
+    in output.sites (profile name = list of "y-x" gridcell names).
+
+    Monthly and annual outputs are accumulated in the daily loop. Variables listed in
+    the sums field of a profile are accumulated as sums, all others as means.
+    """
+
+    def __init__(self, name: str, variables: Optional[Set[str]] = None,
+                 frequency: str = "daily", sums: Optional[Set[str]] = None,
+                 save: bool = True) -> None:
+        """
+        Args:
+            name (str): profile name
+            variables (Optional[Set[str]], optional): variables to save. None means all variables.
+            frequency (str, optional): one of daily, monthly or annual. Defaults to "daily".
+            sums (Optional[Set[str]], optional): variables accumulated as sums. Defaults to None.
+            save (bool, optional): write the outputs of the gridcell. With save = false the
+            variables are only used by the region reducers (region_reducer). Defaults to True.
+        """
+        available = set(daily_outputs) | set(iteration_outputs)
+        assert frequency in frequencies, f"Invalid frequency {frequency}. Use one of {frequencies}"
+        if variables is None:
+            variables = available | {"emaxm"}
+        not_in = set(variables) - available - {"emaxm"}
+        if not_in:
+            raise ValueError(f"Profile {name}: unknown output variable(s) {not_in}")
+        self.name = name
+        self.variables: Set[str] = set(variables)
+        self.frequency = frequency
+        self.sums: Set[str] = set(sums) if sums is not None else set()
+        self.save = save
+
+
+    @classmethod
+    def from_config(cls, output_config: Any, xyname: str) -> "output_profile":
+        """Get the output profile of a gridcell from the [output] section of caete.toml
+
+        Args:
+            output_config (Config): the output section of the configuration
+            xyname (str): gridcell name ("y-x")
+        """
+        name = getattr(output_config, "profile", None)
+        profiles = getattr(output_config, "profiles", None)
+        if name is None or profiles is None:
+            return cls("full")
+        sites = getattr(output_config, "sites", None)
+        if sites is not None:
+            for site_profile, gridcells in vars(sites).items():
+                if site_profile.startswith("_"):
+                    continue
+                if xyname in gridcells:
+                    name = site_profile
+                    break
+        profile = getattr(profiles, name, None)
+        if profile is None:
+            raise ValueError(f"Output profile {name} is not defined in the configuration file")
+        variables = getattr(profile, "variables", "all")
+        return cls(name,
+                   None if variables == "all" else set(variables),
+                   getattr(profile, "frequency", "daily"),
+                   set(getattr(profile, "sums", [])),
+                   getattr(profile, "save", True))
+
+
+    def wants(self, variable: str) -> bool:
+        return variable in self.variables
+
+
+    @staticmethod
+    def period_index(sind: int, eind: int, time_unit: str, calendar: str,
+                     frequency: str) -> Tuple[NDArray[np.int64], NDArray[np.int64]]:
+        """Map each day in the sind-eind interval to an output period
+
+        Returns:
+            Tuple[NDArray, NDArray]: the period of each day (zero based) and the
+            position (day of the interval) where each period starts
+        """
+        if frequency == "daily":
+            steps = np.arange(eind - sind + 1, dtype=np.int64)
+            return steps, steps
+        keys = output_profile.period_keys(sind, eind, time_unit, calendar, frequency)
+        _, first, period = np.unique(keys, return_index=True, return_inverse=True)
+        return period.astype(np.int64).ravel(), first.astype(np.int64)
+
+
+    @staticmethod
+    def period_keys(sind: int, eind: int, time_unit: str, calendar: str,
+                    frequency: str) -> NDArray[np.int64]:
+        """Calendar period of each day in the sind-eind interval:
+        year * 12 + month - 1 for monthly and year for annual frequency"""
+        dates = cftime.num2date(np.arange(sind, eind + 1, dtype=np.int64), time_unit, calendar=calendar)
+        if frequency == "monthly":
+            return np.array([d.year * 12 + d.month - 1 for d in dates], dtype=np.int64)
+        elif frequency == "annual":
+            return np.array([d.year for d in dates], dtype=np.int64)
+        raise ValueError(f"Invalid frequency {frequency}")
+
+
+    def __repr__(self) -> str:
+        return f"output_profile({self.name}, {self.frequency}, {len(self.variables)} variables)"
+
+
+# Entries of a partial reduction that are not variables
+_PARTIAL_META = {"keys", "start", "ndays", "area", "sums", "ngridcells"}
+
+
+class region_reducer:
+    """Area weighted regional sums and means of output variables, computed during the run.
+
+    Defined in the [output.reducers] section of caete.toml. Each gridcell reduces its flushed
+    outputs to the reducer frequency and multiplies them by the cell area (partial). The region
+    adds the partials of all gridcells after each parallel phase (region.merge_reducers).
+    The regional sum of a variable is sum(value * cell_area) and the regional mean is the sum
+    divided by the area of the region.
+
+    Reducer variables must be in the output profile of the gridcells, and the reducer frequency
+    cannot be finer than the profile frequency. Time aggregation follows the profile: variables
+    in the sums of the profile are summed over the period, all others are averaged.
+    A profile with save = false gives the regional time series without any gridcell output.
+    """
+
+    def __init__(self, variables: Set[str], frequency: str = "daily") -> None:
+        """
+        Args:
+            variables (Set[str]): variables to reduce
+            frequency (str, optional): one of daily, monthly or annual. Defaults to "daily".
+        """
+        assert frequency in frequencies, f"Invalid frequency {frequency}. Use one of {frequencies}"
+        not_in = set(variables) - set(daily_outputs) - set(iteration_outputs)
+        if not_in:
+            raise ValueError(f"Reducers: unknown output variable(s) {not_in}")
+        self.variables: Set[str] = set(variables)
+        self.frequency = frequency
+
+
+    @classmethod
+    def from_config(cls, output_config: Any) -> Optional["region_reducer"]:
+        """Get the reducers from the [output] section of caete.toml. None if there are no reducers"""
+        reducers = getattr(output_config, "reducers", None)
+        if reducers is None or not getattr(reducers, "variables", []):
+            return None
+        return cls(set(reducers.variables), getattr(reducers, "frequency", "daily"))
+
+
+    def check(self, profile: output_profile) -> None:
+        not_in = self.variables - profile.variables
+        assert not not_in, f"Reducer variables {not_in} are not in the output profile {profile.name}"
+        assert frequencies.index(self.frequency) >= frequencies.index(profile.frequency),\
+            f"Reducer frequency ({self.frequency}) is finer than the output profile frequency ({profile.frequency})"
+
+
+    def partial(self, data: Dict[str, Any], period_start: NDArray[np.int64],
+                cell_area: float, profile: output_profile) -> Dict[str, Any]:
+        """Partial reduction of the flushed outputs of one gridcell
+
+        Args:
+            data (Dict[str, Any]): spin data returned by gridcell_output._flush_output
+            period_start (NDArray[np.int64]): day (from sind) where each output period starts
+            cell_area (float): area of the gridcell (m2)
+            profile (output_profile): output profile of the gridcell
+
+        Returns:
+            Dict[str, Any]: keys (calendar period of each reducer period), ndays, area and
+            the area weighted values of each variable. Averaged variables are multiplied by
+            the number of days of each output period, so partials can be added in time and space.
+        """
+        sind, eind = int(data["sind"]), int(data["eind"])
+        period_start = np.asarray(period_start, dtype=np.int64)
+        ndays = np.diff(np.append(period_start, eind - sind + 1))
+        if self.frequency == "daily":
+            keys = sind + period_start
+        else:
+            keys = output_profile.period_keys(sind, eind, data["time_unit"], data["calendar"],
+                                              self.frequency)[period_start]
+        first = np.concatenate(([0], np.nonzero(np.diff(keys))[0] + 1))
+        out: Dict[str, Any] = {"keys": keys[first],
+                               "start": sind + period_start[first],
+                               "ndays": np.add.reduceat(ndays, first),
+                               "area": float(cell_area),
+                               "sums": tuple(sorted(self.variables & profile.sums))}
+        for name in self.variables:
+            value = np.asarray(data[name], dtype=np.float64)
+            if name not in profile.sums:
+                value = value * ndays
+            out[name] = np.add.reduceat(value, first, axis=-1) * cell_area
+        return out
+
+
+    @staticmethod
+    def merge(partials: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Add the partials (same spin) of several gridcells"""
+        merged = {k: (v.copy() if isinstance(v, np.ndarray) else v) for k, v in partials[0].items()}
+        merged["ngridcells"] = len(partials)
+        for part in partials[1:]:
+            assert np.array_equal(part["keys"], merged["keys"]), "Gridcells are not in lockstep"
+            assert part["sums"] == merged["sums"], "Gridcells aggregate the reducer variables differently"
+            for k, v in part.items():
+                if k in _PARTIAL_META and k != "area":
+                    continue
+                merged[k] = merged[k] + v
+        return merged
+
+
+    @staticmethod
+    def series(reductions: Dict[int, Dict[str, Any]]) -> Dict[str, Any]:
+        """Regional time series from the merged partials of all spins
+
+        Args:
+            reductions (Dict[int, Dict[str, Any]]): spin -> merged partials
+
+        Returns:
+            Dict[str, Any]: start (time index of the first day of each period), segment, area and
+            <var>_sum, <var>_mean for each variable. A spin that does not start the day after the
+            previous spin ends (e.g. a saved spinup repeating a period) starts a new segment.
+            Periods are never merged across segments, and start increases within each segment
+        """
+        spins = sorted(reductions)
+        assert spins, "No reductions available"
+        names = [k for k in reductions[spins[0]] if k not in _PARTIAL_META]
+        sums = set(reductions[spins[-1]]["sums"])
+        keys = np.concatenate([reductions[s]["keys"] for s in spins])
+        start = np.concatenate([reductions[s]["start"] for s in spins])
+        ndays = np.concatenate([reductions[s]["ndays"] for s in spins])
+        # A period can span two spins if the spins are contiguous in time
+        contiguous = start[1:] == start[:-1] + ndays[:-1]
+        first = np.concatenate(([0], np.nonzero((np.diff(keys) != 0) | ~contiguous)[0] + 1))
+        segment = np.concatenate(([0], np.cumsum(~contiguous)))[first]
+        ndays = np.add.reduceat(ndays, first)
+        area = reductions[spins[-1]]["area"]
+        out: Dict[str, Any] = {"start": start[first], "segment": segment, "area": area}
+        for name in names:
+            total = np.add.reduceat(np.concatenate([reductions[s][name] for s in spins], axis=-1), first, axis=-1)
+            if name not in sums:
+                total = total / ndays
+            out[f"{name}_sum"] = total
+            out[f"{name}_mean"] = total / area
+        return out
+
 class budget_output:
     """ Helper class to store the output of the daily_budget function.
     """
@@ -0,0 +1,127 @@
+# -*-coding:utf-8-*-
+# "CAETÊ"
+# Author:  João Paulo Darela Filho
+"""
+Copyright 2017- LabTerra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Per process LRU cache of decompressed spin data.
+
+Each spin file holds all variables of a spin. Reading several variables in separate calls
+(e.g. grd_mt._get_daily_data in a notebook, gridded_data.read_grd) decompresses the same
+files again. The cache keeps the decompressed spin data, up to a memory cap (output.cache_mb
+in caete.toml). Entries are keyed by file path and modification time, so a file that is
+written again (a new run) is never served from the cache.
+
+Cached arrays are read only.
+"""
+
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+
+class spin_cache:
+    """LRU cache with a memory cap for dicts of numpy arrays"""
+
+    def __init__(self, max_mb: float = 512.0) -> None:
+        """
+        Args:
+            max_mb (float, optional): memory cap in MB. 0 disables the cache. Defaults to 512.0.
+        """
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        self._data: "OrderedDict[Hashable, Tuple[Dict[str, Any], int]]" = OrderedDict()
+        self._lock = Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    @staticmethod
+    def file_key(fpath: Any, *extra: Hashable) -> Tuple:
+        """Cache key of a file: path, modification time and extra items (e.g. gridcell and spin)"""
+        st = os.stat(fpath)
+        return (os.path.abspath(fpath), st.st_mtime_ns, st.st_size) + extra
+
+
+    @staticmethod
+    def _size(data: Dict[str, Any]) -> int:
+        return sum(v.nbytes for v in data.values() if isinstance(v, np.ndarray))
+
+
+    def get(self, key: Hashable, loader: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """Get the data for key. Calls loader (and caches the result) if key is not in the cache"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        data = loader()
+        if self.max_bytes <= 0:
+            return data
+        size = self._size(data)
+        if size > self.max_bytes:
+            return data
+        for v in data.values():
+            if isinstance(v, np.ndarray):
+                v.flags.writeable = False
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = (data, size)
+                self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, old_size) = self._data.popitem(last=False)
+                self.nbytes -= old_size
+                self.evictions += 1
+        return data
+
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+
+    def stats(self) -> Dict[str, float]:
+        """Hits, misses, evictions, number of entries and memory used (MB)"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_ratio": self.hits / total if total else 0.0,
+                    "evictions": self.evictions,
+                    "entries": len(self._data),
+                    "mb": self.nbytes / 1024 ** 2,
+                    "max_mb": self.max_bytes / 1024 ** 2}
+
+
+# One cache per process
+_cache: Optional[spin_cache] = None
+
+
+def get_cache(max_mb: Optional[float] = None) -> spin_cache:
+    """Return the cache of this process. It is created in the first call
+    (with max_mb, or the default size if max_mb is None)"""
+    global _cache
+    if _cache is None:
+        _cache = spin_cache() if max_mb is None else spin_cache(max_mb)
+    return _cache
@@ -18,12 +18,16 @@ Copyright 2017- LabTerra
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-"""DEFINE SOME MODEL PARAMETERS FOR CAETÊ EXPERIMENTS"""
+"""DEFINE SOME MODEL PARAMETERS FOR CAETÊ EXPERIMENTS
+
+The global maps (masks, soil and hydraulic parameters) are opened on first access
+as read only memory maps (see __getattr__). Importing this module does not read them.
+"""
 
 from pathlib import Path
 import numpy as np
 from numpy.typing import NDArray
-from typing import Tuple
+from typing import Any, Dict, Tuple
 
 # Running in sombrero:
 # These variables point to the directory where the input data is stored.
@@ -32,10 +36,10 @@ local_input: Path = Path("../input").resolve()
 
 #masks
 # Pan-Amazon mask. Only forest dominated gridcells are considered. MAPBIOMAS 2000
-mask_am: NDArray = np.load("../input/mask/pan_amazon_05d_FORESTS_MAPBIOMASS_2000.npy")
+mask_am: NDArray
 
 # Pan-Amazon mask.
-mask_pan_am: NDArray = np.load("../input/mask/mask_raisg-360-720.npy")
+mask_pan_am: NDArray
 
 
 # Name of the base historical observed run.
@@ -53,28 +57,64 @@ pls_path: Path = Path(f"./{ATTR_FILENAME}")
 # Soil Parameters
 # Water saturation, field capacity & wilting point
 # Topsoil
-map_ws: NDArray[np.float64] = np.load("../input/soil/ws.npy")
-map_fc: NDArray[np.float64] = np.load('../input/soil/fc.npy')
-map_wp: NDArray[np.float64] = np.load('../input/soil/wp.npy')
+map_ws: NDArray[np.float64]
+map_fc: NDArray[np.float64]
+map_wp: NDArray[np.float64]
 
 # Subsoil
-map_subws: NDArray[np.float64] = np.load("../input/soil/sws.npy")
-map_subfc: NDArray[np.float64] = np.load("../input/soil/sfc.npy")
-map_subwp: NDArray[np.float64] = np.load("../input/soil/swp.npy")
+map_subws: NDArray[np.float64]
+map_subfc: NDArray[np.float64]
+map_subwp: NDArray[np.float64]
 
 tsoil:Tuple[NDArray[np.float64],
             NDArray[np.float64],
-            NDArray[np.float64]] = (map_ws, map_fc, map_wp)
+            NDArray[np.float64]] # (map_ws, map_fc, map_wp)
 
 ssoil:Tuple[NDArray[np.float64],
             NDArray[np.float64],
-            NDArray[np.float64]] = (map_subws, map_subfc, map_subwp)
+            NDArray[np.float64]] # (map_subws, map_subfc, map_subwp)
 
 # Hydraulics
-theta_sat: NDArray[np.float64] = np.load("../input/hydra/theta_sat.npy")
-psi_sat: NDArray[np.float64]  = np.load("../input/hydra/psi_sat.npy")
-soil_texture: NDArray[np.float64] = np.load("../input/hydra/soil_text.npy")
+theta_sat: NDArray[np.float64]
+psi_sat: NDArray[np.float64]
+soil_texture: NDArray[np.float64]
 
 hsoil:Tuple[NDArray[np.float64],
             NDArray[np.float64],
-            NDArray[np.float64]] = (theta_sat, psi_sat, soil_texture)
\ No newline at end of file
+            NDArray[np.float64]] # (theta_sat, psi_sat, soil_texture)
+
+# Files of the global maps. Paths are resolved at import
+_map_files: Dict[str, Path] = {
+    "mask_am": Path("../input/mask/pan_amazon_05d_FORESTS_MAPBIOMASS_2000.npy").resolve(),
+    "mask_pan_am": Path("../input/mask/mask_raisg-360-720.npy").resolve(),
+    "map_ws": Path("../input/soil/ws.npy").resolve(),
+    "map_fc": Path("../input/soil/fc.npy").resolve(),
+    "map_wp": Path("../input/soil/wp.npy").resolve(),
+    "map_subws": Path("../input/soil/sws.npy").resolve(),
+    "map_subfc": Path("../input/soil/sfc.npy").resolve(),
+    "map_subwp": Path("../input/soil/swp.npy").resolve(),
+    "theta_sat": Path("../input/hydra/theta_sat.npy").resolve(),
+    "psi_sat": Path("../input/hydra/psi_sat.npy").resolve(),
+    "soil_texture": Path("../input/hydra/soil_text.npy").resolve(),
+}
+
+_map_tuples: Dict[str, Tuple[str, str, str]] = {
+    "tsoil": ("map_ws", "map_fc", "map_wp"),
+    "ssoil": ("map_subws", "map_subfc", "map_subwp"),
+    "hsoil": ("theta_sat", "psi_sat", "soil_texture"),
+}
+
+__all__ = ["input_in_sombrero", "local_input", "BASE_RUN", "ATTR_FILENAME", "START_COND_FILENAME",
+           "output_path", "run_path", "pls_path"] + list(_map_files) + list(_map_tuples)
+
+
+def __getattr__(name: str) -> Any:
+    """Open a global map (or a tuple of maps) on first access. The result is kept in the module"""
+    if name in _map_files:
+        value = np.load(_map_files[name], mmap_mode="r")
+    elif name in _map_tuples:
+        value = tuple(__getattr__(n) for n in _map_tuples[name])
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
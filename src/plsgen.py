@@ -31,6 +31,8 @@ if sys.platform == "win32":
         raise ImportError("Could not add the DLL directory to the PATH")
 
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from math import ceil
 from typing import Tuple
 import csv
@@ -45,7 +47,8 @@ description = """ Generate and save a table of plant life strategies for CAETE.
                   The first argument is the number of PLSs to be created
                   and the second is the path to a folder used to save the file.
                   If the folder exists, a file named pls_attrs-<NUMBER>.csv will
-                  be saved there. If the folder does not exists, it will be created
+                  be saved there, with a binary copy (pls_attrs-<NUMBER>.npy/.json) that is faster to read.
+                  If the folder does not exists, it will be created
                  (can be nested folders like foo/bar/zip).The parameter NUMBER
                  is the number of PLS given by the -n (--number) flag. Optionally you can import the
                  table_gen function defined in this script and use it in your own code.
@@ -56,6 +59,8 @@ description = """ Generate and save a table of plant life strategies for CAETE.
                  table = table_gen(NUMBER)
 
                  The created object table is a numpy array with axis (NTRAITS, NPLS).
+                 Candidates are generated and screened in blocks by a pool of processes.
+                 Tables are reproducible for a given seed (-s, --seed).
                  """
 
 parser = argparse.ArgumentParser(
@@ -64,8 +69,8 @@ parser = argparse.ArgumentParser(
 )
 parser.add_argument("-n", "--number", type=int, required=True, help="Number of PLSs to generate")
 parser.add_argument("-f", "--folder", type=str, required=True, help="Path to save the output")
-
-args = parser.parse_args()
+parser.add_argument("-s", "--seed", type=int, default=None, help="Seed of the random number generator")
+parser.add_argument("-p", "--nprocs", type=int, default=None, help="Number of processes (default: number of CPUs)")
 
 CONFIG_FILE = 'plsgen.toml'
 
@@ -88,15 +93,16 @@ def vec_ranging(values, new_min, new_max):
 
     return np.array(output, dtype=np.float32)
 
+@lru_cache(maxsize=None)
 def get_parameters(config=CONFIG_FILE):
-    """ Get parameters from the pls_gen.toml file """
+    """ Get parameters from the pls_gen.toml file. The file is read once """
 
     with open(config, 'rb') as f:
         data = tl.load(f)
 
     return data
 
-def check_viability(trait_values, awood=False):
+def check_viability(trait_values, awood=False, params=None):
 
     """ Check the viability of allocation & residence time combinations.
         Some PLS combinations of allocation coefficients and residence times
@@ -105,9 +111,10 @@ def check_viability(trait_values, awood=False):
         input:
         trait_values: np.array(shape=(6,), dtype=f64) allocation and residence time combination (possible PLS)
         wood: bool  Is this a woody PLS?
+        params: dict parameters (pls_gen.toml). Read from the file if None
         output:bool True if the PLS is viable, False otherwise
     """
-    data = get_parameters()
+    data = get_parameters() if params is None else params
     lim = data["parameters"]["wood_cmin"]
     npp = data["parameters"]["wood_low_npp"]
 
@@ -134,121 +141,151 @@ def assert_data_size(dsize):
     assert diffg + diffw == dsize
     return diffg, diffw
 
-def allocation_combinations():
+def allocation_combinations(num_samples=1_000_000, rng=None):
     """ Generate allocation combinations for woody and grass plants based on Dirichlet distribution
 
+    Args:
+        num_samples (int): number of samples drawn for each life form
+        rng (np.random.Generator): random number generator. Defaults to a new generator
+
     Returns:
         _type_: Tuple[np.ndarray, np.ndarray]
     """
+    rng = np.random.default_rng() if rng is None else rng
     data = get_parameters()
     ma = data["parameters"]["minimum_allocation"]
-    num_samples = 1_000_000
-    alpha_wood = np.array([1.0, 1.0, 1.0])
-    alpha_grass = np.array([1.0, 1.0])
-    woody_comb = np.random.dirichlet(alpha_wood, num_samples)
-    grass_tmp = np.random.dirichlet(alpha_grass, num_samples)
+    woody_comb = rng.dirichlet(np.array([1.0, 1.0, 1.0]), num_samples)
+    grass_tmp = rng.dirichlet(np.array([1.0, 1.0]), num_samples)
 
     grass_comb = np.zeros((num_samples, 3))
     grass_comb[:, 0] = grass_tmp[:, 0]
-    grass_comb[:, 1] = 0.0
     grass_comb[:, 2] = grass_tmp[:, 1]
 
-    grass_final = np.array([combo for combo in grass_comb if (combo[0] > ma or combo[2] > ma)])
-    woody_final = np.array([combo for combo in woody_comb if (combo[0] > ma or combo[1] > ma or combo[2] > ma)])
+    grass_final = grass_comb[(grass_comb[:, 0] > ma) | (grass_comb[:, 2] > ma)]
+    woody_final = woody_comb[(woody_comb > ma).any(axis=1)]
 
     return woody_final, grass_final
 
-def nutrient_ratios(n, N_min, N_max, P_min, P_max):
+
+def candidate_block(nblock, woody, rng, params):
+    """ Draw a block of residence time & allocation combinations (possible PLS)
+
+    Returns:
+        np.ndarray: (n, 6) tleaf, twood, troot, aleaf, awood, aroot. n <= nblock
+    """
+    ma = params["parameters"]["minimum_allocation"]
+    rt = params["residence_time"]["woody" if woody else "grass"]
+    out = np.zeros((nblock, 6), dtype=np.float64)
+    out[:, 0] = rng.uniform(rt["leaf_min"], rt["leaf_max"], nblock)
+    out[:, 2] = rng.uniform(rt["root_min"], rt["root_max"], nblock)
+    if woody:
+        out[:, 1] = rng.uniform(rt["wood_min"], rt["wood_max"], nblock)
+        out[:, 3:] = rng.dirichlet(np.array([1.0, 1.0, 1.0]), nblock)
+        keep = (out[:, 3:] > ma).any(axis=1)
+    else:
+        grass = rng.dirichlet(np.array([1.0, 1.0]), nblock)
+        out[:, 3] = grass[:, 0]
+        out[:, 5] = grass[:, 1]
+        keep = (out[:, 3] > ma) | (out[:, 5] > ma)
+    return out[keep]
+
+
+def screen_block(nblock, woody, seed, params):
+    """ Draw a block of candidates and return the viable ones. Runs in a worker process
+
+    Args:
+        nblock (int): number of candidates
+        woody (bool): woody or grass PLS
+        seed (np.random.SeedSequence): seed of this block
+        params (dict): parameters (pls_gen.toml)
+    """
+    candidates = candidate_block(nblock, woody, np.random.default_rng(seed), params)
+    viable = np.fromiter((check_viability(c, woody, params) for c in candidates),
+                         dtype=bool, count=candidates.shape[0])
+    return candidates[viable]
+
+
+def viable_combinations(n, woody, seed, nprocs=None, block_size=1024, params=None):
+    """ Generate n viable residence time & allocation combinations
+
+    Blocks of candidates are screened in parallel. Each block has its own seed, spawned in order
+    from seed, and the viable candidates are taken in block order. The result depends only on the
+    seed, not on the number of processes.
+
+    Returns:
+        np.ndarray: (n, 6) tleaf, twood, troot, aleaf, awood, aroot
+    """
+    params = get_parameters() if params is None else params
+    nprocs = os.cpu_count() if nprocs is None else nprocs
+    found = []
+    nfound = 0
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        while nfound < n:
+            seeds = seed.spawn(nprocs)
+            for block in executor.map(screen_block, [block_size] * nprocs, [woody] * nprocs, seeds, [params] * nprocs):
+                found.append(block)
+                nfound += block.shape[0]
+            sys.stdout.write('\r%s' % (str(min(nfound, n))))
+    sys.stdout.flush()
+    print("\n")
+    if not found:
+        return np.zeros((0, 6), dtype=np.float64)
+    return np.concatenate(found, axis=0)[:n]
+
+def nutrient_ratios(n, N_min, N_max, P_min, P_max, rng=None):
+    rng = np.random.default_rng() if rng is None else rng
     sample_NP = np.zeros((n, 2))
 
-    N_C = np.random.uniform(N_min, N_max, n)
-    P_C = np.random.uniform(P_min, P_max, n)
+    N_C = rng.uniform(N_min, N_max, n)
+    P_C = rng.uniform(P_min, P_max, n)
 
     sample_NP[:, 0] = N_C
     sample_NP[:, 1] = P_C
 
     return sample_NP
 
-def table_gen(NPLS, fpath=None, ret=True):
-    """main function - generate a trait table for CAETÊ - optionally, saves it to a .csv with a header and an ID column"""
+def table_gen(NPLS, fpath=None, ret=True, seed=None, nprocs=None):
+    """main function - generate a trait table for CAETÊ - optionally, saves it to a .csv with a header and an ID column
+
+    Args:
+        NPLS (int): number of PLS
+        fpath (Path, optional): folder to save the table (pls_attrs-<NPLS>.csv)
+        ret (bool, optional): return the table
+        seed (Union[int, np.random.SeedSequence, None], optional): seed. The table is reproducible for a given seed
+        nprocs (int, optional): number of processes used to screen the candidates. Defaults to the number of CPUs
+    """
 
     assert NPLS > 1, "Number of PLSs must be greater than 1"
 
     # Read the pls_gen.toml file to get the parameters
     data = get_parameters()
 
-    rwoody = data["residence_time"]["woody"]
-    rgrass = data["residence_time"]["grass"]
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    seed_grass, seed_wood, seed_traits = seed.spawn(3)
+    rng = np.random.default_rng(seed_traits)
 
     diffg, diffw = assert_data_size(NPLS)
-    alloc_wood, alloc_grass = allocation_combinations()
 
-    alloc_w = []
-    alloc_g = []
-    r_ceil = 10000
-
-    if GRASS_FRAC == 0.0:
-        pass
-    else:
-        index0 = 0
-        rtime_leaf =  np.random.uniform(rgrass["leaf_min"], rgrass["leaf_max"], r_ceil)
-        rtime_froot = np.random.uniform(rgrass["root_min"], rgrass["root_max"], r_ceil)
+    alloc_g = np.zeros((0, 6))
+    alloc_w = np.zeros((0, 6))
+    if GRASS_FRAC > 0.0:
         print("Checking potential npp/alocation and creating grasses")
-        while index0 < diffg:
-            restime = np.zeros(shape=(3,), dtype=np.float64)
-
-            allocatio = alloc_grass[np.random.randint(0, alloc_grass.shape[0])]
-            restime[0] = rtime_leaf[np.random.randint(0, r_ceil)]
-            restime[1] = 0.0
-            restime[2] = rtime_froot[np.random.randint(0, r_ceil)]
-
-            data_to_test0 = np.concatenate((restime, allocatio), axis=0,)
-            if check_viability(data_to_test0):
-                alloc_g.append(data_to_test0)
-                index0 += 1
-            sys.stdout.write('\r%s' % (str(index0)))
-        sys.stdout.flush()
-        print("\n")
-        alloc_g = np.array(alloc_g)
-
-    if GRASS_FRAC == 1.0:
-        pass
-    else:
-        index1 = 0
-        rtime_leaf =  np.random.uniform(rwoody["leaf_min"], rwoody["leaf_max"], r_ceil)
-        rtime_froot = np.random.uniform(rwoody["root_min"], rwoody["root_max"], r_ceil)
-        rtime_wood = np.random.uniform(rwoody["wood_min"], rwoody["wood_max"], r_ceil)
+        alloc_g = viable_combinations(diffg, False, seed_grass, nprocs, params=data)
+
+    if GRASS_FRAC < 1.0:
         print("Checking potential npp/alocation and creating woody plants")
-        while index1 < diffw:
-            restime = np.zeros(shape=(3,), dtype=np.float64)
-            allocatio = alloc_wood[np.random.randint(0, alloc_wood.shape[0])]
-            restime[0] = rtime_leaf[np.random.randint(0, r_ceil)]
-            restime[1] = rtime_wood[np.random.randint(0, r_ceil)]
-            restime[2] = rtime_froot[np.random.randint(0, r_ceil)]
-            data_to_test1 = np.concatenate((restime, allocatio), axis=0,)
-            if check_viability(data_to_test1, True):
-                alloc_w.append(data_to_test1)
-                index1 += 1
-            sys.stdout.write('\r%s' % (str(index1)))
-        sys.stdout.flush()
-        print("\n")
-        alloc_w = np.array(alloc_w)
-
-    if GRASS_FRAC == 0.0:
-        alloc = alloc_w
-    elif GRASS_FRAC == 1.0:
-        alloc = alloc_g
-    else:
-        alloc = np.concatenate((alloc_g, alloc_w), axis=0,)
+        alloc_w = viable_combinations(diffw, True, seed_wood, nprocs, params=data)
+
+    alloc = np.concatenate((alloc_g, alloc_w), axis=0,)
 
     # # # COMBINATIONS
-    g1 = np.random.uniform(0.5, 20.0, NPLS)
-    resorption = np.random.uniform(0.1, 0.8, NPLS)
+    g1 = rng.uniform(0.5, 20.0, NPLS)
+    resorption = rng.uniform(0.1, 0.8, NPLS)
 
     # # C4 type
     c4 = np.zeros((NPLS,), dtype=np.float64)
-    if GRASS_FRAC > 0.0 and index0 > 1:
-        n123 = ceil(alloc_g.shape[0] * 0.50) # type: ignore
+    if GRASS_FRAC > 0.0 and diffg > 1:
+        n123 = ceil(alloc_g.shape[0] * 0.50)
         c4[0: n123 - 1] = 1.0
 
     # # Nitrogen and Phosphorus content in carbon pools
@@ -267,7 +304,7 @@ def table_gen(NPLS, fpath=None, ret=True):
     NM = nr["leaf_n2c"]["max"] #0.05
     P0 = nr["leaf_p2c"]["min"] #0.0005
     PM = nr["leaf_p2c"]["max"] #0.005
-    leaf = nutrient_ratios(NPLS, N0, NM, P0, PM)
+    leaf = nutrient_ratios(NPLS, N0, NM, P0, PM, rng)
     leaf_n2c = leaf[:, 0]
     leaf_p2c = leaf[:, 1]
 
@@ -281,7 +318,7 @@ def table_gen(NPLS, fpath=None, ret=True):
     NM = nr["wood_n2c"]["max"]# 0.005
     P0 = nr["wood_p2c"]["min"]# 7.5e-6
     PM = nr["wood_p2c"]["max"]# 0.00025
-    wood = nutrient_ratios(NPLS, N0, NM, P0, PM)
+    wood = nutrient_ratios(NPLS, N0, NM, P0, PM, rng)
     awood_n2c = wood[:, 0]
     awood_p2c = wood[:, 1]
 
@@ -306,21 +343,18 @@ def table_gen(NPLS, fpath=None, ret=True):
     P0 = nr["root_p2c"]["min"] #0.0003
     PM = nr["root_p2c"]["max"] #0.005
     # root = calc_ratios3(NPLS)
-    root = nutrient_ratios(NPLS, N0, NM, P0, PM)
+    root = nutrient_ratios(NPLS, N0, NM, P0, PM, rng)
     froot_n2c = root[:, 0]
     froot_p2c = root[:, 1]
 
     # new traits
-    pdia = np.random.uniform(0.01, 0.10, NPLS)
+    pdia = rng.uniform(0.01, 0.10, NPLS)
     np.place(pdia, test, 0.0)
-    woods = np.where(alloc[:, 4] > 0.0)[0] # type: ignore
-    # return woods
+    woods = np.where(alloc[:, 4] > 0.0)[0]
 
-    for i in woods:
-        if np.random.normal() > 0:
-            pdia[i] = 0.0
+    pdia[woods[rng.normal(size=woods.size) > 0]] = 0.0
 
-    amp = np.random.uniform(0.001, 0.999, NPLS)
+    amp = rng.uniform(0.001, 0.999, NPLS)
 
     pls_id = np.arange(NPLS)
 
@@ -347,10 +381,14 @@ def table_gen(NPLS, fpath=None, ret=True):
             writer.writerow(head)
             for x in range(pls_table.shape[1]):
                 writer.writerow(list(pls_table[:, x]))
+        # Binary companion of the csv file, read by metacommunity.pls_table.read_pls_table
+        from metacommunity import pls_table as main_table
+        main_table.write_binary(fnp, pls_table[1:], head[1:])
     if ret:
         pls_table = np.vstack(stack[1:])
         return np.asfortranarray(pls_table, dtype=np.float32)
 
 
 if  __name__ == "__main__":
-    table_gen(args.number, Path(args.folder).resolve(), False)
+    args = parser.parse_args()
+    table_gen(args.number, Path(args.folder).resolve(), False, seed=args.seed, nprocs=args.nprocs)
@@ -0,0 +1,183 @@
+# -*-coding:utf-8-*-
+# "CAETÊ"
+# Author:  João Paulo Darela Filho
+"""
+Copyright 2017- LabTerra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Spatio-temporal queries over the outputs of a region.
+
+Example:
+    q = output_query(worker.load_state_sharded("./pan_amazon_hist_result.psz"))
+    res = q.select("npp", bbox=(0.0, -10.0, -70.0, -60.0), start="1990-01-01", end="2010-12-31")
+    res["npp"]   # (gridcell, time)
+    res["coord"] # (gridcell, 2) y-x indices
+
+Gridcells are selected with the (y, x) spatial index of the region. The time window is mapped
+to the spins through the spin metadata (manifest), so only the spins that overlap the window
+are read. With the "store" output backend, variables are read directly from the region store.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Collection, Dict, List, Optional, Tuple, Union
+
+import cftime
+import numpy as np
+from numpy.typing import NDArray
+
+from caete import get_args, grd_mt, parse_date
+from _geos import define_region, config, find_coordinates_xy
+from region_store import region_store
+
+
+class output_query:
+    """Query engine over the outputs of a region (region or worker.sharded_region)"""
+
+    def __init__(self, r: Any, nthreads: int = 8) -> None:
+        """
+        Args:
+            r (Any): a region or a sharded_region
+            nthreads (int, optional): number of threads reading gridcells. Defaults to 8.
+        """
+        self.region = r
+        self.nthreads = nthreads
+        # (y, x) -> position of the gridcell in the region
+        keys = getattr(r, "keys", None)
+        if not isinstance(keys, list):
+            keys = [(grd.y, grd.x) for grd in r.gridcells]
+        self.index: Dict[Tuple[int, int], int] = {(int(y), int(x)): i for i, (y, x) in enumerate(keys)}
+        self.coords: NDArray[np.int64] = np.array(list(self.index.keys()), dtype=np.int64).reshape(-1, 2)
+
+
+    def gridcell(self, y: int, x: int) -> grd_mt:
+        """Get a gridcell by its (y, x) indices"""
+        pos = self.index.get((y, x))
+        if pos is None:
+            raise KeyError(f"Gridcell {y}-{x} is not in the region")
+        return self.region[pos]
+
+
+    def find_gridcells(self,
+                       gridlist: Optional[Collection[Tuple[int, int]]] = None,
+                       bbox: Union[Dict[str, int], Tuple[float, float, float, float], None] = None
+                       ) -> List[Tuple[int, int]]:
+        """Select gridcells by a list of (y, x) indices and/or a bounding box
+
+        Args:
+            gridlist (Optional[Collection[Tuple[int, int]]], optional): (y, x) indices. Defaults to None.
+            bbox (Union[Dict[str, int], Tuple[float, float, float, float], None], optional): a bbox
+            (ymin, ymax, xmin, xmax indices, see _geos.define_region) or (north, south, west, east) in degrees.
+            Defaults to None.
+
+        Returns:
+            List[Tuple[int, int]]: (y, x) of the selected gridcells
+        """
+        selected = self.coords
+        if gridlist is not None:
+            wanted = {(int(y), int(x)) for y, x in gridlist}
+            not_in = wanted - set(self.index)
+            assert len(not_in) == 0, f"Gridcells {not_in} are not in the region"
+            selected = np.array([yx for yx in self.index if yx in wanted], dtype=np.int64).reshape(-1, 2)
+        if bbox is not None:
+            if not isinstance(bbox, dict):
+                north, south, west, east = bbox
+                bbox = define_region(north, south, west, east, config.crs.yres, config.crs.xres) # type: ignore
+                # Include the cells at the south and east edges
+                bbox = dict(bbox, ymax=bbox["ymax"] + 1, xmax=bbox["xmax"] + 1)
+            inside = ((selected[:, 0] >= bbox["ymin"]) & (selected[:, 0] < bbox["ymax"]) &
+                      (selected[:, 1] >= bbox["xmin"]) & (selected[:, 1] < bbox["xmax"]))
+            selected = selected[inside]
+        return [(int(y), int(x)) for y, x in selected]
+
+
+    @staticmethod
+    def _window(grd: grd_mt, start: Optional[str], end: Optional[str]
+                ) -> Tuple[Union[int, Tuple[int, int], None], NDArray[np.int64], slice]:
+        """Spins that overlap a time window, their time index and the slice of the window"""
+        if start is None and end is None:
+            spin_slice = None
+        else:
+            first = grd._get_spin_metadata(1)
+            last = grd._get_spin_metadata(grd.run_counter)
+            start_str = start if start is not None else cftime.num2date(
+                first["sind"], grd.time_unit, grd.calendar).strftime("%Y-%m-%d")
+            end_str = end if end is not None else cftime.num2date(
+                last["eind"], grd.time_unit, grd.calendar).strftime("%Y-%m-%d")
+            spin_slice = grd.find_spins(start_str, end_str)
+        time_index = grd._time_index(grd._spin_range(spin_slice))
+        lo, hi = 0, time_index.size
+        if start is not None:
+            lo = int(np.searchsorted(time_index, cftime.date2num(parse_date(start), grd.time_unit, grd.calendar)))
+        if end is not None:
+            hi = int(np.searchsorted(time_index, cftime.date2num(parse_date(end), grd.time_unit, grd.calendar), side="right"))
+        return spin_slice, time_index, slice(lo, hi)
+
+
+    def select(self,
+               variables: Union[str, Collection[str]],
+               gridlist: Optional[Collection[Tuple[int, int]]] = None,
+               bbox: Union[Dict[str, int], Tuple[float, float, float, float], None] = None,
+               start: Optional[str] = None,
+               end: Optional[str] = None) -> Dict[str, Any]:
+        """Read variables for a set of gridcells and a time window
+
+        Args:
+            variables (Union[str, Collection[str]]): variable names
+            gridlist (Optional[Collection[Tuple[int, int]]], optional): (y, x) of the gridcells. Defaults to None (all).
+            bbox (Union[Dict[str, int], Tuple[float, float, float, float], None], optional): see find_gridcells. Defaults to None.
+            start (Optional[str], optional): first day of the window. e.g. "1990-01-01". Defaults to None.
+            end (Optional[str], optional): last day of the window. Defaults to None.
+
+        Returns:
+            Dict[str, Any]: one array (gridcell, [layer,] time) per variable, coord (y, x), lat, lon and time (dates)
+        """
+        names = list(dict.fromkeys(get_args(variables)))
+        keys = self.find_gridcells(gridlist, bbox)
+        assert len(keys) > 0, "No gridcells selected"
+
+        # All gridcells of a region run in lockstep. The first one defines the time axis
+        first = self.gridcell(*keys[0])
+        spin_slice, time_index, window = self._window(first, start, end)
+
+        if first.output_backend == "store":
+            out = self._select_store(first, keys, names, spin_slice, window)
+        else:
+            def read(yx: Tuple[int, int]) -> Dict[str, NDArray]:
+                # Gridcells of a sharded region are loaded by the threads
+                grd = first if yx == keys[0] else self.gridcell(*yx)
+                arrays = grd._get_daily_data(names, spin_slice)
+                return {k: v[..., window] for k, v in zip(names, [arrays] if len(names) == 1 else arrays)} # type: ignore
+
+            with ThreadPoolExecutor(max_workers=min(self.nthreads, len(keys))) as executor:
+                results = list(executor.map(read, keys))
+            out = {k: np.stack([res[k] for res in results]) for k in names}
+
+        out["coord"] = np.array(keys, dtype=np.int64)
+        latlon = np.array([find_coordinates_xy(y, x, first.yres, first.xres) for y, x in keys], dtype=np.float32)
+        out["lat"] = latlon[:, 0]
+        out["lon"] = latlon[:, 1]
+        out["time"] = cftime.num2date(time_index[window], first.time_unit, first.calendar)
+        return out
+
+
+    @staticmethod
+    def _select_store(grd: grd_mt, keys: List[Tuple[int, int]], names: List[str],
+                      spin_slice: Union[int, Tuple[int, int], None], window: slice) -> Dict[str, Any]:
+        """Read the selection from the region store (one read per variable)"""
+        fpath = Path(next(iter(grd.outputs.values())))
+        store = region_store(fpath)
+        return {k: store.read(k, keys, spin_slice)[..., window] for k in names}
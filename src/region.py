@@ -4,17 +4,19 @@ import os
 
 from pathlib import Path
 from caete import str_or_path, get_co2_concentration, read_bz2_file, print_progress, grd_mt
-from typing import Callable, Dict, List,Tuple, Union
+from typing import Any, Callable, Dict, List,Tuple, Union
 
+import cftime
 import numpy as np
+from joblib import dump
 from numpy.typing import NDArray
 
-from config import Config, fetch_config
+from config import Config, fetch_config, reload_config
 
 import metacommunity as mc
-
-# Tuples with hydrological parameters for the soil water calculations
-from parameters import hsoil, ssoil, tsoil
+from region_store import region_store, store_fname
+from output import region_reducer
+from forcing import forcing_view
 
 # Global lock. Used to lock the access to the main table of Plant Life Strategies
 lock = mp.Lock()
@@ -28,7 +30,7 @@ class region:
 
     def __init__(self,
                 name:str,
-                clim_data:Union[str,Path],
+                clim_data:Union[str,Path,forcing_view],
                 soil_data:Tuple[Tuple[NDArray[np.float64], NDArray[np.float64], NDArray[np.float64]],
                                 Tuple[NDArray[np.float64], NDArray[np.float64], NDArray[np.float64]],
                                 Tuple[NDArray[np.float64], NDArray[np.float64], NDArray[np.float64]]],
@@ -38,7 +40,7 @@ class region:
 
         Args:
             name (str): this will be the name of the region and the name of the output folder
-            clim_data (Union[str,Path]): Path for the climate data
+            clim_data (Union[str,Path,forcing_view]): Path for the climate data or a forcing view (forcing.py)
             soil_data (Tuple[Tuple[np.ndarray], Tuple[np.ndarray], Tuple[np.ndarray]]): _description_
             output_folder (Union[str, Path]): _description_
             co2 (Union[str, Path]): _description_
@@ -52,8 +54,9 @@ class region:
 
         # IO
         self.climate_files = []
-        self.input_data = str_or_path(clim_data)
-        self.soil_data = copy.deepcopy(soil_data)
+        # References to the global maps (read only memory maps, see parameters.py).
+        # The gridcells copy only their own values
+        self.soil_data = soil_data
         self.pls_table = mc.pls_table(pls_table)
 
         # calculate_matrix dimesnion size size from grid resolution
@@ -69,22 +72,29 @@ class region:
         # Number of PLS in the main table (global table)
         self.npls_main_table = self.pls_table.npls
 
-        try:
-            metadata_file = list(self.input_data.glob("*_METADATA.pbz2"))[0]
-        except:
-            raise FileNotFoundError("Metadata file not found in the input data folder")
+        if isinstance(clim_data, forcing_view):
+            # Virtual forcing: metadata and input files come from the view
+            self.input_data = clim_data
+            self.metadata = clim_data.metadata()
+            self.climate_files.extend(clim_data.input_files())
+        else:
+            self.input_data = str_or_path(clim_data)
+            try:
+                metadata_file = list(self.input_data.glob("*_METADATA.pbz2"))[0]
+            except:
+                raise FileNotFoundError("Metadata file not found in the input data folder")
 
-        try:
-            mtd = str_or_path(metadata_file, check_is_file=True)
-        except:
-            raise AssertionError("Metadata file path could not be resolved. Cannot proceed without metadata")
+            try:
+                mtd = str_or_path(metadata_file, check_is_file=True)
+            except:
+                raise AssertionError("Metadata file path could not be resolved. Cannot proceed without metadata")
 
-        # Read metadata from climate files
-        self.metadata = read_bz2_file(mtd)
-        self.stime = copy.deepcopy(self.metadata[0])
+            # Read metadata from climate files
+            self.metadata = read_bz2_file(mtd)
 
-        for file_path in self.input_data.glob("input_data_*-*.pbz2"):
-            self.climate_files.append(file_path)
+            for file_path in self.input_data.glob("input_data_*-*.pbz2"):
+                self.climate_files.append(file_path)
+        self.stime = copy.deepcopy(self.metadata[0])
 
         # This is used to define the gridcells output paths
         self.yx_indices = []
@@ -110,6 +120,14 @@ class region:
         # Some magic methods are defined to deal with this list
         self.gridcells:List[grd_mt] = []
 
+        # Output backend. With the "store" backend the gridcells append their outputs
+        # to a consolidated output store created by the region (see region_store.py)
+        self.output_backend = self.config.output.backend # type: ignore
+
+        # Online regional reductions (see output.region_reducer). spin -> partials of all gridcells
+        self.reductions: Dict[int, Dict[str, Any]] = {}
+        self.reductions_file = self.output_path / "region_reductions.pkz"
+
 
     def update_dump_directory(self, new_name:str="copy"):
         """Update the output folder for the region
@@ -126,6 +144,7 @@ class region:
             gridcell.run_counter = 0
             gridcell.outputs = {}
             gridcell.metacomm_output = {}
+            gridcell.spin_metadata = {}
 
             gridcell.out_dir  = self.output_path/Path(f"grd_{gridcell.xyname}")
             os.makedirs(gridcell.out_dir, exist_ok=True)
@@ -135,7 +154,8 @@ class region:
         """Update the input data for the region
 
         Args:
-            input_file (str | Path, optional): Folder with input data to be used. Defaults to None.
+            input_file (str | Path | forcing_view, optional): Folder with input data to be used,
+            or a forcing view (forcing.py). Defaults to None.
             co2 (str | Path, optional): Text file (tsv/csv) with annual co2 concentration. Defaults to None.
             Attributes are updated if valid values are provided
 
@@ -148,7 +168,12 @@ class region:
             self.co2_path = str_or_path(co2)
             self.co2_data = get_co2_concentration(self.co2_path)
 
-        if input_file is not None:
+        if isinstance(input_file, forcing_view):
+            # Virtual forcing: the gridcells read the data through the view
+            self.input_data = input_file
+            self.metadata = input_file.metadata()
+            self.stime = copy.deepcopy(self.metadata[0])
+        elif input_file is not None:
             # Read the climate data
             self.input_data = str_or_path(input_file)
             try:
@@ -176,8 +201,12 @@ class region:
 
 
     def _update_config(self):
-        """Update the configuration file"""
-        self.config = fetch_config("caete.toml")
+        """Read the configuration file again (e.g. after changing it between phases of an experiment).
+        The gridcells copy the values used by the run (see grd_mt._set_config). Values copied from
+        the configuration when the gridcells were set up (e.g. output profiles) are not changed"""
+        self.config = reload_config("caete.toml") # type: ignore
+        for gridcell in self.gridcells:
+            gridcell._set_config(self.config)
 
 
     def get_from_main_table(self, comm_npls, lock = lock) -> Tuple[Union[int, NDArray[np.intp]], NDArray[np.float32]]:
@@ -216,7 +245,9 @@ class region:
             gridcell_dump_directory = self.output_path/Path(f"grd_{y}-{x}") # The gridcell folder
             grd_cell = grd_mt(y, x, gridcell_dump_directory, self.get_from_main_table)
             # grd_cell = grd_mt(y, x, grd_cell.grid_filename, self.get_from_main_table)
-            grd_cell.set_gridcell(f, stime_i=self.stime, co2=self.co2_data,
+            input_fpath = self.input_data if isinstance(self.input_data, forcing_view) else f
+            tsoil, ssoil, hsoil = self.soil_data
+            grd_cell.set_gridcell(input_fpath, stime_i=self.stime, co2=self.co2_data,
                                     tsoil=tsoil, ssoil=ssoil, hsoil=hsoil)
             self.gridcells.append(grd_cell)
             self.lats[i] = grd_cell.lat
@@ -234,8 +265,10 @@ class region:
         Returns:
             _type_: _description_
         """
+        self.prepare_store()
         with mp.Pool(processes=self.nproc, maxtasksperchild=1) as p:
             self.gridcells = p.map(func, self.gridcells, chunksize=1)
+        self.merge_reducers()
         return None
 
 
@@ -249,11 +282,69 @@ class region:
         Returns:
             _type_: _description_
         """
+        self.prepare_store()
         with mp.Pool(processes=self.nproc, maxtasksperchild=1) as p:
             self.gridcells = p.starmap(func, [(gc, args) for gc in self.gridcells], chunksize=1)
+        self.merge_reducers()
         return None
 
 
+    def get_store(self, frequency: str = "daily") -> region_store:
+        """Returns the consolidated output store of the region (store backend)"""
+        fname = store_fname(self.config.output.store_name, frequency) # type: ignore
+        return region_store(self.output_path / fname,
+                            complevel=self.config.output.store_complevel) # type: ignore
+
+
+    def prepare_store(self) -> None:
+        """Create the region stores used by the gridcells, if they do not exist.
+        Called before each parallel phase. The gridcells append their spins to the
+        stores in the worker processes. Does nothing with the "pkz" backend"""
+        if self.output_backend != "store":
+            return None
+        # Gridcells with different output profiles can have different frequencies
+        frequencies = {gridcell.output_profile.frequency for gridcell in self.gridcells
+                       if gridcell.output_profile.save}
+        for frequency in sorted(frequencies):
+            store = self.get_store(frequency)
+            if not store.exists():
+                store.create(self.yx_indices, self.stime["calendar"], self.stime["units"], frequency)
+        return None
+
+
+    def merge_reducers(self) -> None:
+        """Add the reducer partials of the gridcells and save the regional reductions
+        (region_reductions.pkz in the region folder). Called after each parallel phase.
+        Does nothing if there are no reducers in the configuration"""
+        by_spin: Dict[int, List[Dict[str, Any]]] = {}
+        for gridcell in self.gridcells:
+            for spin, partial in getattr(gridcell, "reducer_partials", []):
+                by_spin.setdefault(spin, []).append(partial)
+            gridcell.reducer_partials = []
+        if not by_spin:
+            return None
+        for spin, partials in by_spin.items():
+            assert len(partials) == len(self.gridcells), f"Spin {spin}: missing reducer partials"
+            self.reductions[spin] = region_reducer.merge(partials)
+        with open(self.reductions_file, "wb") as fh:
+            dump({"calendar": self.stime["calendar"], "time_unit": self.stime["units"],
+                  "reductions": self.reductions}, fh, compress=('lz4', 6), protocol=4) # type: ignore
+        return None
+
+
+    def get_reductions(self) -> Dict[str, Any]:
+        """Regional time series computed by the reducers
+
+        Returns:
+            Dict[str, Any]: time (first day of each period), segment (contiguous run of spins,
+            see region_reducer.series), area (m2) of the region, and <var>_sum (area weighted sum)
+            and <var>_mean (area weighted mean) for each variable
+        """
+        out = region_reducer.series(self.reductions)
+        out["time"] = cftime.num2date(out.pop("start"), self.stime["units"], self.stime["calendar"])
+        return out
+
+
     # Methods to deal with model outputs
     def clean_model_state(self):
         """
@@ -269,14 +360,20 @@ class region:
         attributes_to_keep = {'calendar',
                               'time_unit',
                               'cell_area',
-                              'config',
+                              'cache_mb',
+                              'read_threads',
+                              'store_name',
                               'executed_iterations',
                               'lat',
                               'lon',
                               'ncomms',
                               'out_dir',
                               'outputs',
+                              'output_backend',
+                              'output_profile',
                               'metacomm_output',
+                              'metacomm_format',
+                              'spin_metadata',
                               'run_counter',
                               'x',
                               'xres',
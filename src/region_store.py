@@ -0,0 +1,329 @@
+# -*-coding:utf-8-*-
+# "CAETÊ"
+# Author:  João Paulo Darela Filho
+"""
+Copyright 2017- LabTerra
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Consolidated output store for a region.
+
+With the default output backend ("pkz") each gridcell writes one joblib file per spin.
+With the "store" backend (see the [output] section in caete.toml) all gridcells of a region
+append their spins to a single chunked and compressed netCDF4 (HDF5) file. The region creates
+the store before each parallel phase and each gridcell appends its data at the end of every spin,
+in the worker process. Writers take an exclusive lock on a lock file next to the store
+(<store>.lock), readers take a shared lock. Spin data never goes back to the main process.
+
+Layout of the store:
+    dimensions: gridcell (fixed), time (unlimited), spin (unlimited), <var>_layer (fixed)
+    y(gridcell), x(gridcell): indices of the gridcells
+    spin_sind(spin), spin_eind(spin): time index (calendar/time_unit) of the first and last day of each spin
+    spin_offset(spin), spin_length(spin): position of each spin in the time axis of the store
+    <var>(gridcell, time) or <var>(gridcell, <var>_layer, [<var>_layer1, ...,] time): output variables
+
+The time axis of the store is the sequence of flushed spins. Spins are numbered as the
+spin files (1, 2, ...). Gridcells of a region run in lockstep, thus one spin has the same
+position in the time axis for all gridcells.
+
+Gridcells with monthly or annual output profiles are written to a separate store
+(see store_fname). The frequency is recorded as a global attribute of the store.
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from time import sleep
+from typing import Collection, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from netCDF4 import Dataset # type: ignore
+from numpy.typing import NDArray
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+    import msvcrt
+
+# The HDF5 library is not thread safe. Serialize the access to the stores in a process
+_hdf5_lock = Lock()
+
+# Entries of the spin data that are not output arrays
+_META_KEYS = {"calendar", "time_unit", "sind", "eind", "frequency"}
+
+
+def store_fname(store_name: str, frequency: str = "daily") -> str:
+    """Name of the store file for outputs with a given frequency.
+    e.g. region_output.nc, region_output_monthly.nc"""
+    if frequency == "daily":
+        return store_name
+    stem, ext = store_name.rsplit(".", 1) if "." in store_name else (store_name, "nc")
+    return f"{stem}_{frequency}.{ext}"
+
+
+@contextmanager
+def _file_lock(fpath: Path, shared: bool = False) -> Iterator[None]:
+    """Lock a store among processes (and threads of this process).
+    Shared locks are exclusive on Windows"""
+    with _hdf5_lock, open(f"{fpath}.lock", "a+b") as fh:
+        if fcntl is not None:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    sleep(0.05)
+        try:
+            yield None
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            else:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class region_store:
+    """Consolidated store for the outputs of a region. Safe for concurrent writers and readers
+    in different processes (see _file_lock)"""
+
+    def __init__(self, fpath: Union[str, Path], complevel: int = 4, chunk_time: int = 3650) -> None:
+        """Open (or prepare to create) a region store.
+
+        Args:
+            fpath (Union[str, Path]): path to the store file (netCDF4)
+            complevel (int, optional): zlib compression level. Defaults to 4.
+            chunk_time (int, optional): chunk size along the time axis. Defaults to 3650.
+        """
+        self.fpath = Path(fpath)
+        self.complevel = complevel
+        self.chunk_time = chunk_time
+        self._index: Optional[Dict[Tuple[int, int], int]] = None
+
+
+    def exists(self) -> bool:
+        return self.fpath.exists()
+
+
+    def create(self, yx_indices: Collection[Tuple[int, int]], calendar: str, time_unit: str,
+               frequency: str = "daily") -> None:
+        """Create an empty store for the given gridcells
+
+        Args:
+            yx_indices (Collection[Tuple[int, int]]): (y, x) indices of the gridcells in the region
+            calendar (str): calendar of the time index
+            time_unit (str): units of the time index
+            frequency (str, optional): frequency of the outputs. Defaults to "daily".
+        """
+        yx = np.array(list(yx_indices), dtype=np.int32).reshape(-1, 2)
+        with _file_lock(self.fpath), Dataset(self.fpath, mode="w", format="NETCDF4") as ds:
+            ds.createDimension("gridcell", yx.shape[0])
+            ds.createDimension("time", None)
+            ds.createDimension("spin", None)
+            ds.setncattr("calendar", calendar)
+            ds.setncattr("time_unit", time_unit)
+            ds.setncattr("frequency", frequency)
+            ds.createVariable("y", "i4", ("gridcell",))[:] = yx[:, 0]
+            ds.createVariable("x", "i4", ("gridcell",))[:] = yx[:, 1]
+            for name in ("spin_sind", "spin_eind", "spin_offset", "spin_length"):
+                ds.createVariable(name, "i8", ("spin",))
+        self._index = None
+
+
+    def _gridcell_index(self, ds: Dataset) -> Dict[Tuple[int, int], int]:
+        if self._index is None:
+            ys = ds.variables["y"][:].data
+            xs = ds.variables["x"][:].data
+            self._index = {(int(y), int(x)): i for i, (y, x) in enumerate(zip(ys, xs))}
+        return self._index
+
+
+    def _create_variable(self, ds: Dataset, name: str, data: NDArray) -> None:
+        # One fixed dimension for each axis before the time axis: <name>_layer, <name>_layer1, ...
+        layers: List[str] = []
+        for axis, size in enumerate(data.shape[:-1]):
+            layers.append(f"{name}_layer" if axis == 0 else f"{name}_layer{axis}")
+            ds.createDimension(layers[-1], size)
+        dims = ("gridcell", *layers, "time")
+        chunks = (1, *data.shape[:-1], self.chunk_time)
+        ds.createVariable(name, data.dtype, dims, zlib=True, shuffle=True,
+                          complevel=self.complevel, chunksizes=chunks)
+
+
+    def _spin_position(self, ds: Dataset, spin: int, sind: int, eind: int, length: int) -> int:
+        """Return the offset in the time axis for a spin. Register the spin if necessary"""
+        nspins = len(ds.dimensions["spin"])
+        if spin <= nspins:
+            offset = int(ds.variables["spin_offset"][spin - 1])
+            assert int(ds.variables["spin_sind"][spin - 1]) == sind and\
+                   int(ds.variables["spin_length"][spin - 1]) == length,\
+                   f"Spin {spin} already registered with a different period"
+            return offset
+        assert spin == nspins + 1, f"Spins must be appended in order. Expected spin {nspins + 1}, got {spin}"
+        offset = 0
+        if nspins > 0:
+            offset = int(ds.variables["spin_offset"][nspins - 1] + ds.variables["spin_length"][nspins - 1])
+        ds.variables["spin_sind"][spin - 1] = sind
+        ds.variables["spin_eind"][spin - 1] = eind
+        ds.variables["spin_offset"][spin - 1] = offset
+        ds.variables["spin_length"][spin - 1] = length
+        return offset
+
+
+    def write(self, buffers: Dict[Tuple[int, int], List[Tuple[int, Dict]]]) -> None:
+        """Append the buffered spin data of several gridcells to the store
+
+        Args:
+            buffers (Dict[Tuple[int, int], List[Tuple[int, Dict]]]): maps (y, x) of a gridcell
+            to a list of (spin number, spin data) pairs. Spin data is the dict returned by
+            gridcell_output._flush_output
+        """
+        if not buffers:
+            return None
+        with _file_lock(self.fpath), Dataset(self.fpath, mode="a") as ds:
+            index = self._gridcell_index(ds)
+            # Register spins first so that all gridcells share the same positions
+            pending = sorted({(spin, data["sind"], data["eind"], self._length(data))
+                              for buffer in buffers.values() for spin, data in buffer})
+            positions = {spin: self._spin_position(ds, spin, sind, eind, length)
+                         for spin, sind, eind, length in pending}
+            for yx, buffer in buffers.items():
+                g = index[yx]
+                for spin, data in buffer:
+                    t0 = positions[spin]
+                    for name, value in data.items():
+                        if name in _META_KEYS:
+                            continue
+                        value = np.asarray(value)
+                        if value.size == 0:
+                            # Empty placeholders (e.g. emaxm) are not stored
+                            continue
+                        if name not in ds.variables:
+                            self._create_variable(ds, name, value)
+                        t1 = t0 + value.shape[-1]
+                        ds.variables[name][g, ..., t0:t1] = value
+        return None
+
+
+    def append(self, yx: Tuple[int, int], spin: int, data: Dict) -> None:
+        """Append the data of one spin of a gridcell to the store. Called by the
+        gridcells (in the worker processes) at the end of each spin
+
+        Args:
+            yx (Tuple[int, int]): (y, x) indices of the gridcell
+            spin (int): spin number
+            data (Dict): spin data (the dict returned by gridcell_output._flush_output)
+        """
+        if not self.exists():
+            raise FileNotFoundError(f"Region store {self.fpath} does not exist. "
+                                    "The region creates it before running the gridcells")
+        self.write({yx: [(spin, data)]})
+
+
+    @staticmethod
+    def _length(data: Dict) -> int:
+        for name, value in data.items():
+            if name in _META_KEYS:
+                continue
+            value = np.asarray(value)
+            if value.size > 0:
+                return value.shape[-1]
+        raise ValueError("No output arrays in the spin data")
+
+
+    def spins(self) -> NDArray:
+        """Return the spin index of the store as a structured array
+        with the fields spin, sind, eind, offset and length"""
+        with _file_lock(self.fpath, shared=True), Dataset(self.fpath, mode="r") as ds:
+            n = len(ds.dimensions["spin"])
+            out = np.zeros(n, dtype=[("spin", "i8"), ("sind", "i8"), ("eind", "i8"),
+                                     ("offset", "i8"), ("length", "i8")])
+            out["spin"] = np.arange(1, n + 1)
+            out["sind"] = ds.variables["spin_sind"][:]
+            out["eind"] = ds.variables["spin_eind"][:]
+            out["offset"] = ds.variables["spin_offset"][:]
+            out["length"] = ds.variables["spin_length"][:]
+        return out
+
+
+    def variables(self) -> List[str]:
+        """Names of the output variables in the store"""
+        with _file_lock(self.fpath, shared=True), Dataset(self.fpath, mode="r") as ds:
+            return [v for v in ds.variables if "gridcell" in ds.variables[v].dimensions
+                    and "time" in ds.variables[v].dimensions]
+
+
+    def read(self, variable: str,
+             gridcells: Optional[Collection[Tuple[int, int]]] = None,
+             spins: Union[int, Tuple[int, int], None] = None) -> NDArray:
+        """Read a variable for a subset of gridcells and spins
+
+        Args:
+            variable (str): variable name
+            gridcells (Optional[Collection[Tuple[int, int]]], optional): (y, x) indices of the gridcells.
+            Defaults to None (all gridcells).
+            spins (Union[int, Tuple[int, int], None], optional): a spin number or a (first, last) pair of spins.
+            Defaults to None (all spins).
+
+        Returns:
+            NDArray: array with shape (gridcell, time) or (gridcell, layer, time)
+        """
+        with _file_lock(self.fpath, shared=True), Dataset(self.fpath, mode="r") as ds:
+            index = self._gridcell_index(ds)
+            var = ds.variables[variable]
+            t0, t1 = self._time_slice(ds, spins)
+            if gridcells is None:
+                data = var[..., t0:t1]
+            else:
+                rows = [index[tuple(yx)] for yx in gridcells] # type: ignore
+                data = np.stack([var[g, ..., t0:t1] for g in rows])
+        return np.ma.getdata(data)
+
+
+    def read_spin(self, yx: Tuple[int, int], spin: int) -> Dict:
+        """Read all variables of a gridcell for one spin. Returns a dict with
+        the same layout as the spin files written by the pkz backend"""
+        with _file_lock(self.fpath, shared=True), Dataset(self.fpath, mode="r") as ds:
+            g = self._gridcell_index(ds)[tuple(yx)] # type: ignore
+            t0, t1 = self._time_slice(ds, spin)
+            out: Dict = {}
+            for name in ds.variables:
+                dims = ds.variables[name].dimensions
+                if "gridcell" in dims and "time" in dims:
+                    out[name] = np.ma.getdata(ds.variables[name][g, ..., t0:t1])
+            out["calendar"] = ds.getncattr("calendar")
+            out["time_unit"] = ds.getncattr("time_unit")
+            out["sind"] = int(ds.variables["spin_sind"][spin - 1])
+            out["eind"] = int(ds.variables["spin_eind"][spin - 1])
+            frequency = getattr(ds, "frequency", "daily")
+            if frequency != "daily":
+                out["frequency"] = frequency
+        return out
+
+
+    @staticmethod
+    def _time_slice(ds: Dataset, spins: Union[int, Tuple[int, int], None]) -> Tuple[int, int]:
+        offset = ds.variables["spin_offset"][:]
+        length = ds.variables["spin_length"][:]
+        if spins is None:
+            return 0, int(offset[-1] + length[-1])
+        if isinstance(spins, int):
+            spins = (spins, spins)
+        first, last = spins
+        assert 1 <= first <= last <= offset.size, f"Invalid spin range {spins}"
+        return int(offset[first - 1]), int(offset[last - 1] + length[last - 1])
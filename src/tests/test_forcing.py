@@ -0,0 +1,138 @@
+# Run from the src folder: python -m unittest discover -s tests
+import bz2
+import pickle as pkl
+import tempfile
+import unittest
+from pathlib import Path
+
+import cftime
+import numpy as np
+
+from forcing import climate_variables, cycle_view, forcing_store, subset_view, transform_view
+
+TIME_UNIT = "days since 1901-01-01"
+CALENDAR = "noleap"
+GRIDCELLS = [(185, 239), (186, 240)]
+NDAYS = 3 * 365
+
+
+def day(date):
+    return int(cftime.date2num(cftime.datetime(*date, calendar=CALENDAR), TIME_UNIT, CALENDAR))
+
+
+def input_data(y, x):
+    """Input data of a gridcell with the layout of input/pre_processing.py. Climate variables
+    are a linear trend plus noise, soil variables are constants"""
+    rng = np.random.default_rng(y * 1000 + x)
+    t = np.arange(NDAYS)
+    data = {var: (100.0 + 0.01 * t + rng.normal(0.0, 1.0, NDAYS)).astype(np.float32)
+            for var in climate_variables}
+    for var in ("tn", "tp", "ap", "ip", "op"):
+        data[var] = np.float32(rng.random())
+    return data
+
+
+def write_store(folder):
+    """An input folder with the metadata file and the gridcell files"""
+    stime = {"standard_name": "time", "units": TIME_UNIT, "calendar": CALENDAR,
+             "time_index": np.arange(NDAYS, dtype=np.float64)}
+    lat = {"standard_name": "latitude", "units": "degrees_north", "axis": "Y", "lat_index": None}
+    lon = {"standard_name": "longitude", "units": "degrees_east", "axis": "X", "lon_index": None}
+    with bz2.BZ2File(Path(folder) / "ISIMIP_HISTORICAL_METADATA.pbz2", mode='w') as fh:
+        pkl.dump((stime, lat, lon), fh)
+    for y, x in GRIDCELLS:
+        with bz2.BZ2File(Path(folder) / f"input_data_{y}-{x}.pbz2", mode='w') as fh:
+            pkl.dump(input_data(y, x), fh)
+    return forcing_store(folder)
+
+
+def fname(y, x):
+    return f"input_data_{y}-{x}.pbz2"
+
+
+class TestForcing(unittest.TestCase):
+
+    def check_indexing(self, series, expected):
+        """Slices, integers and integer arrays of a lazy series against the materialized array"""
+        self.assertEqual(series.shape, expected.shape)
+        np.testing.assert_array_equal(np.asarray(series), expected)
+        for key in (slice(None), slice(10, 400), slice(None, None, 7), slice(-30, None), slice(5, 5)):
+            np.testing.assert_array_equal(series[key], expected[key])
+        for i in (0, 364, 365, expected.size - 1, -1, -expected.size):
+            self.assertEqual(series[i], expected[i])
+        idx = np.array([0, 1, 364, 365, 730, expected.size - 1, -1, -365])
+        np.testing.assert_array_equal(series[idx], expected[idx])
+        with self.assertRaises(IndexError):
+            series[expected.size]
+
+
+    def check_metadata(self, view):
+        stime = view.metadata()[0]
+        for y, x in GRIDCELLS:
+            data = view.read(fname(y, x))
+            for var in climate_variables:
+                self.assertEqual(len(data[var]), stime["time_index"].size)
+        np.testing.assert_array_equal(view.time_index(), stime["time_index"])
+
+
+    def test_cycle_view(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = write_store(tmp)
+            # The second year of the store repeated over 1801-1805
+            view = cycle_view(store, "1902-01-01", "1902-12-31", "1801-01-01", "1805-12-31")
+            self.assertEqual(view.time_index()[0], day((1801, 1, 1)))
+            self.assertEqual(view.time_index().size, 5 * 365)
+            self.check_metadata(view)
+            for y, x in GRIDCELLS:
+                data = view.read(fname(y, x))
+                expected = input_data(y, x)
+                for var in climate_variables:
+                    self.check_indexing(data[var], np.tile(expected[var][365:730], 5))
+                # Soil data is passed through
+                self.assertEqual(data["tn"], expected["tn"])
+
+
+    def test_subset_view(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = write_store(tmp)
+            start, end = day((1901, 3, 1)), day((1903, 6, 30))
+            views = (subset_view(store, "1901-03-01", "1903-06-30"),
+                     # window_series over a lazy base
+                     subset_view(transform_view(store, offset={"tas": 2.0}), "1901-03-01", "1903-06-30"))
+            for view in views:
+                self.assertEqual(view.time_index()[0], start)
+                self.assertEqual(view.time_index().size, end - start + 1)
+                self.check_metadata(view)
+            for y, x in GRIDCELLS:
+                expected = input_data(y, x)
+                data = views[1].read(fname(y, x))
+                self.check_indexing(data["tas"], expected["tas"][start: end + 1] + np.float32(2.0))
+                self.check_indexing(data["pr"], expected["pr"][start: end + 1])
+                np.testing.assert_array_equal(views[0].read(fname(y, x))["pr"], expected["pr"][start: end + 1])
+
+
+    def test_transform_view(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = write_store(tmp)
+            view = transform_view(store, offset={"pr": 1.0}, detrend=["tas", "pr"])
+            self.check_metadata(view)
+            t = np.arange(NDAYS)
+            for y, x in GRIDCELLS:
+                expected = input_data(y, x)
+                data = view.read(fname(y, x))
+                tas = np.asarray(data["tas"], dtype=np.float64)
+                # The detrended series keeps the mean and has no trend
+                self.assertAlmostEqual(tas.mean(), expected["tas"].astype(np.float64).mean(), places=3)
+                self.assertAlmostEqual(np.polyfit(t, tas, 1)[0], 0.0, places=6)
+                slope = np.polyfit(t, expected["tas"].astype(np.float64), 1)[0]
+                self.assertAlmostEqual(slope, 0.01, places=3)
+                self.check_indexing(data["tas"], (expected["tas"] - slope * (t - t.mean())).astype(np.float32))
+                pr = np.asarray(data["pr"], dtype=np.float64)
+                self.assertAlmostEqual(pr.mean(), expected["pr"].astype(np.float64).mean() + 1.0, places=3)
+                np.testing.assert_array_equal(data["hurs"], expected["hurs"])
+            with self.assertRaises(AssertionError):
+                transform_view(store, detrend=["tn"])
+
+
+if __name__ == "__main__":
+    unittest.main()
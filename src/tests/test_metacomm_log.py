@@ -0,0 +1,117 @@
+# Run from the src folder: python -m unittest discover -s tests
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from caete_module import global_par as gp
+from metacommunity import metacomm_log, metacommunity
+
+NCOMMS = 3
+
+
+def log_row(year, npls):
+    """A row with the layout of metacommunity.log_row"""
+    rng = np.random.default_rng(year)
+    row = {name: np.float32(rng.random()) for name in metacomm_log.metacomm_columns}
+    row["year"] = year
+    for name in metacomm_log.community_columns:
+        row[f"comm_{name}"] = rng.random(NCOMMS, dtype=np.float32)
+    row["comm_masked"] = np.array([0, 1, 0], dtype=np.int8)
+    row["pls_id"] = np.arange(npls, dtype=np.int32) + year
+    row["pls_community"] = (np.arange(npls) % 2 * 2).astype(np.int16)
+    for name in metacomm_log.pls_columns:
+        row[f"pls_{name}"] = rng.random(npls, dtype=np.float32)
+    row["pls_count"] = npls
+    return row
+
+
+class TestMetacommLog(unittest.TestCase):
+
+    def test_append_read(self):
+        npls = {1901: 5, 1902: 0, 1903: 7, 1904: 2}
+        with tempfile.TemporaryDirectory() as tmp:
+            log = metacomm_log(Path(tmp) / "metacomm_log")
+            for year, n in npls.items():
+                log.append(log_row(year, n))
+            # 1903 is logged again (e.g. a period run twice). The last row is used
+            npls[1903] = 4
+            log.append(log_row(1903, 4) | {"cveg": np.float32(-1.0)})
+
+            self.assertEqual(log.years(), [1901, 1902, 1903, 1904])
+            years, cveg = log.read("cveg")
+            np.testing.assert_array_equal(years, [1901, 1902, 1903, 1904])
+            self.assertEqual(cveg[2], -1.0)
+            self.assertEqual(cveg[3], log_row(1904, 2)["cveg"])
+            _, comm_cleaf = log.read("comm_cleaf")
+            self.assertEqual(comm_cleaf.shape, (4, NCOMMS))
+            np.testing.assert_array_equal(comm_cleaf[0], log_row(1901, 5)["comm_cleaf"])
+
+            # Offsets of the ragged PLS section
+            for year, n in npls.items():
+                pls = log.read_pls(year)
+                expected = log_row(year, n)
+                for name in ("pls_id", "pls_community", "pls_vp_cleaf", "pls_vp_ocp"):
+                    np.testing.assert_array_equal(pls[name], expected[name])
+            with self.assertRaises(KeyError):
+                log.read_pls(1900)
+
+
+    def test_failed_append(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = metacomm_log(Path(tmp) / "metacomm_log")
+            log.append(log_row(1901, 3))
+            # Rows with a wrong number of values are rejected before anything is written
+            broken = log_row(1902, 6)
+            broken["pls_vp_cwood"] = broken["pls_vp_cwood"][:4]
+            with self.assertRaises(AssertionError):
+                log.append(broken)
+            # An append interrupted before the year is written leaves orphan values
+            orphan = log_row(1902, 6)
+            for name in ("cveg", "comm_cleaf", "pls_count", "pls_id", "pls_vp_cleaf"):
+                with open(log.path / f"{name}.bin", "ab") as fh:
+                    np.asarray(orphan[name], dtype=log.schema()[name]["dtype"]).ravel().tofile(fh)
+            self.assertEqual(log.years(), [1901])
+            log.append(log_row(1902, 2))
+
+            np.testing.assert_array_equal(log.read("anpp")[1],
+                                          [log_row(1901, 3)["anpp"], log_row(1902, 2)["anpp"]])
+            for year, n in ((1901, 3), (1902, 2)):
+                pls = log.read_pls(year)
+                for name in ("pls_id", "pls_vp_cleaf", "pls_vp_cwood"):
+                    np.testing.assert_array_equal(pls[name], log_row(year, n)[name])
+
+
+    def test_log_row(self):
+        # Rows of a metacommunity with dead PLS (only the living PLS are logged)
+        rng = np.random.default_rng(42)
+        offsets = iter(range(0, 10 * gp.npls, gp.npls))
+
+        def get_from_main_table(npls):
+            table = rng.uniform(0.0, 1.0, (gp.ntraits, npls)).astype(np.float32)
+            table[6] = 1.0  # woody PLS
+            return np.arange(npls, dtype=np.int32) + next(offsets), np.asfortranarray(table)
+
+        metacomm = metacommunity(2, get_from_main_table)
+        for k, comm in metacomm.communities.items():
+            for pos in range(5 * k, 5 * k + 5):
+                comm.kill_pls(pos)
+        with tempfile.TemporaryDirectory() as tmp:
+            log = metacomm_log(Path(tmp) / "metacomm_log")
+            metacomm.log_state(log, 1901)
+            pls = log.read_pls(1901)
+            self.assertEqual(pls["pls_id"].size, sum(c.vp_lsid.size for c in metacomm))
+            for k, comm in metacomm.communities.items():
+                self.assertFalse(np.isin(comm.id[5 * k:5 * k + 5], pls["pls_id"]).any())
+                ids = pls["pls_id"][pls["pls_community"] == k]
+                np.testing.assert_array_equal(ids, comm.id[comm.vp_lsid])
+                for name in metacomm_log.pls_columns:
+                    values = pls[f"pls_{name}"][pls["pls_community"] == k]
+                    # The log stores float32 values
+                    np.testing.assert_array_equal(values, getattr(comm, name)[comm.vp_lsid].astype(np.float32))
+                    self.assertTrue(np.all(values > 0.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+# Run from the src folder: python -m unittest discover -s tests
+import unittest
+
+import cftime
+import numpy as np
+
+from output import output_profile, region_reducer
+
+TIME_UNIT = "days since 1901-01-01"
+CALENDAR = "noleap"
+
+
+def day(date):
+    return int(cftime.date2num(cftime.datetime(*date, calendar=CALENDAR), TIME_UNIT, CALENDAR))
+
+
+def partial(reducer, profile, start, end, cell_area):
+    """Partial reduction of a spin with daily outputs (npp = 1 and wsoil = day index)"""
+    sind, eind = day(start), day(end)
+    days = np.arange(sind, eind + 1, dtype=np.float32)
+    data = {"npp": np.ones_like(days), "wsoil": days, "sind": sind, "eind": eind,
+            "time_unit": TIME_UNIT, "calendar": CALENDAR}
+    return reducer.partial(data, np.arange(days.size), cell_area, profile)
+
+
+class TestRegionReducer(unittest.TestCase):
+
+    def setUp(self):
+        self.profile = output_profile("test", {"npp", "wsoil"}, "daily", sums={"npp"})
+        self.reducer = region_reducer({"npp", "wsoil"}, "monthly")
+
+
+    def reductions(self, periods, areas=(1.0, 3.0)):
+        return {spin: region_reducer.merge([partial(self.reducer, self.profile, start, end, area)
+                                            for area in areas])
+                for spin, (start, end) in enumerate(periods, start=1)}
+
+
+    def test_merge_contiguous_spins(self):
+        # February continues in the second spin
+        out = region_reducer.series(self.reductions([((1901, 1, 1), (1901, 2, 10)),
+                                                     ((1901, 2, 11), (1901, 3, 31))]))
+        np.testing.assert_array_equal(out["start"], [day((1901, m, 1)) for m in (1, 2, 3)])
+        np.testing.assert_array_equal(out["segment"], [0, 0, 0])
+        self.assertEqual(out["area"], 4.0)
+        np.testing.assert_allclose(out["npp_sum"], [31 * 4.0, 28 * 4.0, 31 * 4.0])
+        np.testing.assert_allclose(out["npp_mean"], [31.0, 28.0, 31.0])
+        feb = np.arange(day((1901, 2, 1)), day((1901, 2, 28)) + 1)
+        np.testing.assert_allclose(out["wsoil_mean"][1], feb.mean())
+
+
+    def test_repeated_periods(self):
+        # A spinup saved twice and a spin that starts after a gap
+        out = region_reducer.series(self.reductions([((1901, 1, 1), (1901, 2, 10)),
+                                                     ((1901, 1, 1), (1901, 2, 10)),
+                                                     ((1901, 2, 20), (1901, 3, 5))]))
+        starts = [day(d) for d in ((1901, 1, 1), (1901, 2, 1), (1901, 1, 1), (1901, 2, 1),
+                                   (1901, 2, 20), (1901, 3, 1))]
+        np.testing.assert_array_equal(out["start"], starts)
+        np.testing.assert_array_equal(out["segment"], [0, 0, 1, 1, 2, 2])
+        np.testing.assert_allclose(out["npp_mean"], [31.0, 10.0, 31.0, 10.0, 9.0, 5.0])
+        for segment in range(3):
+            self.assertTrue(np.all(np.diff(out["start"][out["segment"] == segment]) > 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+# Run from the src folder: python -m unittest discover -s tests
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from region_store import region_store
+
+
+def spin_data(yx, spin, sind, ndays):
+    """Spin data with the layout of gridcell_output._flush_output"""
+    seed = yx[0] * 1000 + yx[1] * 10 + spin
+    rng = np.random.default_rng(seed)
+    return {"npp": rng.random(ndays, dtype=np.float32),
+            "cleaf": rng.random((3, ndays), dtype=np.float32),
+            "uptake": rng.random((2, 3, ndays), dtype=np.float32),
+            "emaxm": np.array([]),
+            "calendar": "noleap", "time_unit": "days since 1901-01-01",
+            "sind": sind, "eind": sind + ndays - 1}
+
+
+def append_spins(fpath, yx, spins):
+    store = region_store(fpath)
+    for spin, sind, ndays in spins:
+        store.append(yx, spin, spin_data(yx, spin, sind, ndays))
+
+
+class TestRegionStore(unittest.TestCase):
+
+    def test_round_trip(self):
+        gridcells = [(185, 240), (186, 240), (186, 241)]
+        spins = [(1, 0, 365), (2, 365, 730)]
+        with tempfile.TemporaryDirectory() as tmp:
+            fpath = Path(tmp) / "region_output.nc"
+            store = region_store(fpath, chunk_time=100)
+            with self.assertRaises(FileNotFoundError):
+                store.append(gridcells[0], 1, spin_data(gridcells[0], 1, 0, 365))
+            store.create(gridcells, "noleap", "days since 1901-01-01")
+
+            # Concurrent writers, one per gridcell
+            with ProcessPoolExecutor(max_workers=3) as executor:
+                for future in [executor.submit(append_spins, fpath, yx, spins) for yx in gridcells]:
+                    future.result()
+
+            index = store.spins()
+            np.testing.assert_array_equal(index["offset"], [0, 365])
+            np.testing.assert_array_equal(index["length"], [365, 730])
+            np.testing.assert_array_equal(index["eind"], [364, 1094])
+            self.assertEqual(set(store.variables()), {"npp", "cleaf", "uptake"})
+
+            for yx in gridcells:
+                for spin, sind, ndays in spins:
+                    expected = spin_data(yx, spin, sind, ndays)
+                    data = store.read_spin(yx, spin)
+                    for name in ("npp", "cleaf", "uptake"):
+                        np.testing.assert_array_equal(data[name], expected[name])
+                    self.assertEqual((data["sind"], data["eind"]), (expected["sind"], expected["eind"]))
+                    self.assertNotIn("frequency", data)
+
+            npp = store.read("npp", gridcells=[gridcells[2], gridcells[0]], spins=(1, 2))
+            self.assertEqual(npp.shape, (2, 1095))
+            np.testing.assert_array_equal(npp[0, 365:], spin_data(gridcells[2], 2, 365, 730)["npp"])
+            self.assertEqual(store.read("uptake", spins=2).shape, (3, 2, 3, 730))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# Run from the src folder: python -m unittest discover -s tests
+import tempfile
+import unittest
+from pathlib import Path
+
+import cftime
+import numpy as np
+from joblib import dump
+
+from caete import grd_mt
+
+TIME_UNIT = "days since 1901-01-01"
+CALENDAR = "noleap"
+
+
+def day(date):
+    return int(cftime.date2num(cftime.datetime(*date, calendar=CALENDAR), TIME_UNIT, CALENDAR))
+
+
+def gridcell_with_spins(folder, periods):
+    """A gridcell with saved daily outputs (npp and a 2D csoil) for a list of (start, end) dates.
+    The values are the day index, thus repeated periods have the same values"""
+    grd = grd_mt.__new__(grd_mt)
+    grd.time_unit, grd.calendar = TIME_UNIT, CALENDAR
+    grd.out_dir = Path(folder)
+    grd.output_backend = "pkz"
+    grd.cache_mb, grd.read_threads = 0, 1
+    grd.spin_metadata, grd.outputs = {}, {}
+    for spin, (start, end) in enumerate(periods, start=1):
+        sind, eind = day(start), day(end)
+        days = np.arange(sind, eind + 1, dtype=np.float32)
+        fpath = Path(folder) / f"spin{spin:04d}.pkz"
+        dump({"npp": days, "csoil": np.stack((days, -days)), "calendar": CALENDAR,
+              "time_unit": TIME_UNIT, "sind": sind, "eind": eind}, fpath)
+        grd.outputs[fpath.name] = fpath
+    grd.run_counter = len(periods)
+    return grd
+
+
+class TestResample(unittest.TestCase):
+
+    def test_spin_boundary(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # February continues in the second spin
+            grd = gridcell_with_spins(tmp, [((1901, 1, 1), (1901, 2, 10)), ((1901, 2, 11), (1901, 3, 31))])
+            npp, time = grd.resample("npp", "monthly", "sum", return_time=True)
+            feb = np.arange(day((1901, 2, 1)), day((1901, 2, 28)) + 1)
+            self.assertEqual(npp.shape, (3,))
+            self.assertEqual(npp[1], feb.sum())
+            self.assertEqual([t.month for t in time], [1, 2, 3])
+            csoil = grd.resample("csoil", "monthly", "mean")
+            self.assertEqual(csoil.shape, (2, 3))
+            np.testing.assert_allclose(csoil[:, 1], [feb.mean(), -feb.mean()])
+            np.testing.assert_allclose(grd.resample("npp", "annual", "mean"), [np.arange(0, 90).mean()])
+            self.assertEqual(grd.resample("npp", "annual", "max")[0], 89)
+
+
+    def test_repeated_periods(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # A spinup saved twice: the periods of the spins are not merged
+            grd = gridcell_with_spins(tmp, [((1901, 1, 1), (1901, 1, 31)), ((1901, 1, 1), (1901, 1, 31)),
+                                            ((1901, 1, 20), (1901, 2, 5))])
+            npp, time = grd.resample("npp", "monthly", "mean", return_time=True)
+            np.testing.assert_allclose(npp, [15.0, 15.0, 24.5, 33.0])
+            self.assertEqual([(t.month, t.day) for t in time], [(1, 1), (1, 1), (1, 20), (2, 1)])
+            np.testing.assert_array_equal(grd.resample("npp", "annual", "sum"),
+                                          [465.0, 465.0, np.arange(19, 36).sum()])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,103 @@
 
 import gc
 import pickle as pkl
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Tuple, Union, Any, List
+from typing import Dict, Iterator, Optional, Tuple, Union, Any, List
 import numpy as np
 from numpy.typing import NDArray
 import zstandard as zstd
 from caete import grd_mt
 
+# Sharded region files: magic, zstd compressed records and an index at the end of the file
+SHARD_MAGIC = b"CAETESHD"
+# Footer: offset and size of the index + magic
+_FOOTER = struct.Struct("<QQ8s")
+
+
+class sharded_region:
+    """Lazy reader for a region saved with worker.save_state_sharded.
+
+    The file holds a header (the region object without gridcells) and one compressed
+    record per gridcell. Gridcells are loaded only when accessed. Attributes not defined
+    here are read from the header, so this object can be used as a region in most read-only
+    functions (iteration, len, r[i], r.get_crs(), ...).
+    Pickling only stores the file path (it can be sent to worker processes).
+    """
+
+    def __init__(self, fname: Union[str, Path]) -> None:
+        self.fname = Path(fname)
+        with open(self.fname, 'rb') as fh:
+            fh.seek(-_FOOTER.size, 2)
+            offset, size, magic = _FOOTER.unpack(fh.read(_FOOTER.size))
+            assert magic == SHARD_MAGIC, f"{self.fname} is not a sharded region file"
+        self.index: Dict[str, Any] = self._read_record(offset, size)
+        self.keys: List[Tuple[int, int]] = [tuple(k) for k in self.index["order"]] # type: ignore
+        self._header = None
+
+
+    def _read_record(self, offset: int, size: int) -> Any:
+        with open(self.fname, 'rb') as fh:
+            fh.seek(offset)
+            data = fh.read(size)
+        return pkl.loads(zstd.ZstdDecompressor().decompress(data))
+
+
+    @property
+    def header(self) -> Any:
+        """The region object without gridcells"""
+        if self._header is None:
+            self._header = self._read_record(*self.index["header"])
+        return self._header
+
+
+    def get(self, y: int, x: int) -> grd_mt:
+        """Load the gridcell with indices (y, x)"""
+        record = self.index["gridcells"].get((y, x))
+        if record is None:
+            raise KeyError(f"Gridcell {y}-{x} is not in {self.fname}")
+        return self._read_record(*record)
+
+
+    def load(self, subset: Optional[List[Tuple[int, int]]] = None) -> Any:
+        """Load the region with all gridcells or a subset of (y, x) gridcells"""
+        keys = self.keys if subset is None else [tuple(k) for k in subset]
+        region = self._read_record(*self.index["header"])
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            region.gridcells = list(executor.map(lambda k: self.get(*k), keys))
+        return region
+
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+    def __iter__(self) -> Iterator[grd_mt]:
+        for key in self.keys:
+            yield self.get(*key)
+
+
+    def __getitem__(self, index: Union[int, Tuple[int, int]]) -> grd_mt:
+        if isinstance(index, tuple):
+            return self.get(*index)
+        return self.get(*self.keys[index])
+
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__") or name in ("fname", "index", "keys", "_header"):
+            raise AttributeError(name)
+        return getattr(self.header, name)
+
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"fname": self.fname}
+
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["fname"])
+
+
 class worker:
 
     """Worker functions used to run the model in parallel"""
@@ -171,6 +261,66 @@ class worker:
                 pkl.dump(region, compressor_writer)
 
 
+    @staticmethod
+    def save_state_sharded(region: Any, fname: Union[str, Path], level: int = 19, threads: int = 4):
+        """Save a region as a sharded file: a header (the region without gridcells) and
+        one zstd compressed record per gridcell, with an offset index at the end of the file.
+        Use worker.load_state_sharded to read it lazily.
+
+        Args:
+            region (Any): region to be saved
+            fname (Union[str, Path]): filename
+            level (int, optional): zstd compression level. Defaults to 19.
+            threads (int, optional): number of threads compressing gridcells. Defaults to 4.
+
+        Returns:
+            None: None
+        """
+        def compress(obj: Any) -> bytes:
+            return zstd.ZstdCompressor(level=level).compress(pkl.dumps(obj, protocol=pkl.HIGHEST_PROTOCOL))
+
+        gridcells = region.gridcells
+        region.gridcells = []
+        try:
+            header = compress(region)
+        finally:
+            region.gridcells = gridcells
+
+        index: Dict[str, Any] = {"order": [], "gridcells": {}}
+        with open(fname, 'wb') as fh:
+            fh.write(SHARD_MAGIC)
+            index["header"] = (fh.tell(), len(header))
+            fh.write(header)
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                # Records are written in the gridcell order
+                for gridcell, record in zip(gridcells, executor.map(compress, gridcells)):
+                    key = (int(gridcell.y), int(gridcell.x))
+                    index["order"].append(key)
+                    index["gridcells"][key] = (fh.tell(), len(record))
+                    fh.write(record)
+            index_record = compress(index)
+            offset = fh.tell()
+            fh.write(index_record)
+            fh.write(_FOOTER.pack(offset, len(index_record), SHARD_MAGIC))
+
+
+    @staticmethod
+    def load_state_sharded(fname:Union[str, Path]) -> sharded_region:
+        """Open a region saved with save_state_sharded. Gridcells are loaded on access
+
+        Args:
+            fname (Union[str, Path]): filename of the sharded region
+        """
+        return sharded_region(fname)
+
+
+    @staticmethod
+    def is_sharded(fname:Union[str, Path]) -> bool:
+        """True if the file was written by save_state_sharded"""
+        with open(fname, 'rb') as fh:
+            return fh.read(len(SHARD_MAGIC)) == SHARD_MAGIC
+
+
     @staticmethod
     def load_state_zstd(fname:Union[str, Path]):
         """Used to load a region object from a zstd compressed file